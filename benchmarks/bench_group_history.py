@@ -0,0 +1,92 @@
+"""Statements issued per group history refresh: per-message username lookups vs. one join
+
+Run from the repository root:
+
+    python benchmarks/bench_group_history.py
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chat_db
+
+# The group history query before usernames were joined in
+UNJOINED_HISTORY_QUERY = """
+    SELECT sender_id, message, file_path, file_type, timestamp, edited, deleted, id
+    FROM messages
+    WHERE conversation_id = ? AND deleted = FALSE AND id > ?
+    ORDER BY id
+"""
+
+
+def seed(conn, members, messages):
+    """One group with the given number of members and messages"""
+    cursor = conn.cursor()
+    cursor.executemany("INSERT INTO users (username, password) VALUES (?, ?)",
+                       [(f"user{i}", 'x') for i in range(members)])
+    cursor.execute("INSERT INTO groups (name, created_by) VALUES ('bench', 1)")
+    group_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO group_members (group_id, user_id) VALUES (?, ?)",
+                       [(group_id, user_id) for user_id in range(1, members + 1)])
+    conversation_id = chat_db.group_conversation_id(group_id)
+    rng = random.Random(42)
+    cursor.executemany("""
+        INSERT INTO messages (sender_id, group_id, conversation_id, message, timestamp)
+        VALUES (?, ?, ?, ?, '2024-01-01 12:00:00')
+    """, [(rng.randint(1, members), group_id, conversation_id, f"message {i}") for i in range(messages)])
+    conn.commit()
+    return conversation_id
+
+
+def refresh_unjoined(conn, conversation_id):
+    """The old render loop: history, then one username query per message"""
+    cursor = conn.cursor()
+    cursor.execute(UNJOINED_HISTORY_QUERY, (conversation_id, 0))
+    names = []
+    for msg in cursor.fetchall():
+        cursor.execute("SELECT username FROM users WHERE id = ?", (msg[0],))
+        names.append(cursor.fetchone()[0])
+    return names
+
+
+def refresh_joined(conn, conversation_id):
+    """History with usernames joined in"""
+    cursor = conn.cursor()
+    cursor.execute(chat_db.HISTORY_QUERY, (conversation_id, 0))
+    return [msg[8] for msg in cursor.fetchall()]
+
+
+def measure(conn, refresh, conversation_id):
+    statements = []
+    conn.set_trace_callback(statements.append)
+    start = time.perf_counter()
+    refresh(conn, conversation_id)
+    elapsed = time.perf_counter() - start
+    conn.set_trace_callback(None)
+    return len(statements), elapsed
+
+
+def main():
+    print(f"{'messages':>10} {'queries before':>15} {'queries after':>14} {'ms before':>10} {'ms after':>9}")
+    for messages in (100, 1000, 10000):
+        with tempfile.TemporaryDirectory() as directory:
+            conn = sqlite3.connect(os.path.join(directory, 'bench.db'))
+            chat_db.migrate(conn)
+            conversation_id = seed(conn, members=50, messages=messages)
+
+            before_queries, before_time = measure(conn, refresh_unjoined, conversation_id)
+            after_queries, after_time = measure(conn, refresh_joined, conversation_id)
+            assert refresh_unjoined(conn, conversation_id) == refresh_joined(conn, conversation_id)
+            conn.close()
+
+        print(f"{messages:>10} {before_queries:>15} {after_queries:>14} "
+              f"{before_time * 1000:>10.1f} {after_time * 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""Latency and throughput of the messaging hot paths on synthetic data
+
+Times the service calls behind the UI's busiest actions: sending messages (one at a
+time, in pipelined bursts and through the local outbox), loading history pages,
+searching, building the group list and the unread badges, and filtering users. The
+database comes from datagen.py, so runs with the same arguments are comparable.
+
+Run from the repository root:
+
+    python benchmarks/bench_hot_paths.py --output results.json
+    python benchmarks/bench_hot_paths.py --baseline results.json --threshold 0.25
+
+With --baseline the run is compared metric by metric against an earlier results file
+and the script exits with status 1 if any metric got worse by more than the threshold.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import datagen
+from chat_index import SubstringIndex
+from chat_outbox import Outbox
+from chat_service import ChatService
+
+# Direction of each reported statistic: True if larger numbers are better
+STATISTICS = {'p50_ms': False, 'p99_ms': False, 'ops_per_sec': True}
+
+# Messages per timed call of send_pipelined
+SEND_BURST = 100
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def summarize(durations):
+    """Latency statistics in milliseconds for a list of durations in seconds"""
+    durations = sorted(durations)
+    total = sum(durations)
+    return {
+        'runs': len(durations),
+        'p50_ms': round(percentile(durations, 0.50) * 1000, 4),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 4),
+        'mean_ms': round(total / len(durations) * 1000, 4),
+        'ops_per_sec': round(len(durations) / total, 1) if total else None,
+    }
+
+
+def timed(calls):
+    """Run each call once and return the durations"""
+    durations = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def pick_conversations(rng, data, count):
+    """Conversation indexes chosen with the same skew as the generated traffic"""
+    return rng.choices(range(len(data['conversations'])), cum_weights=data['conversation_weights'], k=count)
+
+
+def bench_send(service, data, rng, runs):
+    """send_message into popular conversations, as the sender would"""
+    def send(index):
+        conversation_id = data['conversations'][index]
+        members = data['conversation_members'][index]
+        sender_id = rng.choice(members)
+        if conversation_id.startswith('g:'):
+            return lambda: service.send_message(sender_id, "benchmark message", group_id=int(conversation_id[2:]))
+        receiver_id = members[1] if sender_id == members[0] else members[0]
+        return lambda: service.send_message(sender_id, "benchmark message", receiver_id=receiver_id)
+
+    return timed([send(index) for index in pick_conversations(rng, data, runs)])
+
+
+def bench_send_pipelined(service, data, rng, runs):
+    """Bursts of SEND_BURST queue_message calls, as a bot or importer would send them"""
+    def burst(index):
+        conversation_id = data['conversations'][index]
+        members = data['conversation_members'][index]
+        if conversation_id.startswith('g:'):
+            recipient = {'group_id': int(conversation_id[2:])}
+        else:
+            recipient = {'receiver_id': members[1]}
+        return lambda: [future.result() for future in
+                        [service.queue_message(members[0], "benchmark message", **recipient)
+                         for _ in range(SEND_BURST)]]
+
+    return timed([burst(index) for index in pick_conversations(rng, data, max(runs // 10, 1))])
+
+
+def bench_outbox_add(service, data, rng, runs):
+    """Outbox.add, the wait after pressing Send; the outbox sends in the background meanwhile"""
+    sender_id = rng.choices(data['users'], cum_weights=data['user_weights'])[0]
+    receivers = [user_id for user_id in data['users'] if user_id != sender_id]
+    with tempfile.TemporaryDirectory() as directory:
+        outbox = Outbox(service, sender_id, path=os.path.join(directory, 'outbox.db'))
+        try:
+            return timed([lambda receiver_id=rng.choice(receivers): outbox.add("benchmark message",
+                                                                              receiver_id=receiver_id)
+                          for _ in range(runs)])
+        finally:
+            outbox.close()
+
+
+def bench_latest_page(service, data, rng, runs):
+    """The page shown when a conversation is opened"""
+    conversations = [data['conversations'][index] for index in pick_conversations(rng, data, runs)]
+    return timed([lambda conversation_id=conversation_id: service.history_page(conversation_id)
+                  for conversation_id in conversations])
+
+
+def bench_older_page(service, data, rng, runs):
+    """Scrolling back one page from the latest one"""
+    calls = []
+    for index in pick_conversations(rng, data, runs):
+        conversation_id = data['conversations'][index]
+        page = service.history_page(conversation_id)
+        if page:
+            calls.append(lambda conversation_id=conversation_id, before_id=page[0].id:
+                         service.history_page(conversation_id, before_id=before_id))
+    return timed(calls)
+
+
+def bench_search(service, data, rng, runs):
+    """Message search for a common word by a chatty user"""
+    users = rng.choices(data['users'], cum_weights=data['user_weights'], k=runs)
+    # Searches need at least three characters
+    words = [word for word in datagen.WORDS if len(word) >= 3]
+    return timed([lambda user_id=user_id, word=rng.choice(words): service.search_messages(user_id, word)
+                  for user_id in users])
+
+
+def bench_group_list(service, data, rng, runs):
+    """The group sidebar of a user (refresh_groups)"""
+    users = rng.choices(data['users'], cum_weights=data['user_weights'], k=runs)
+    return timed([lambda user_id=user_id: service.list_groups(user_id) for user_id in users])
+
+
+def bench_unread_counts(service, data, rng, runs):
+    """The sidebar's unread badges of a user (refresh_unread)"""
+    users = rng.choices(data['users'], cum_weights=data['user_weights'], k=runs)
+    return timed([lambda user_id=user_id: service.unread_counts(user_id) for user_id in users])
+
+
+def bench_user_filter(service, data, rng, runs):
+    """Typing into the user search box (apply_filter on the in-memory index)"""
+    index = SubstringIndex()
+    index.update(dict(service.list_users()))
+    return timed([lambda search=str(rng.randint(0, 99)): index.search(search) for _ in range(runs)])
+
+
+BENCHMARKS = {
+    'send_message': bench_send,
+    'send_pipelined': bench_send_pipelined,
+    'outbox_add': bench_outbox_add,
+    'history_latest_page': bench_latest_page,
+    'history_older_page': bench_older_page,
+    'search_messages': bench_search,
+    'group_list': bench_group_list,
+    'unread_counts': bench_unread_counts,
+    'user_filter': bench_user_filter,
+}
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        data = datagen.generate(path, users=args.users, groups=args.groups, messages=args.messages,
+                                attachment_ratio=args.attachment_ratio, seed=args.seed)
+        service = ChatService(path, attachments_dir=os.path.join(directory, 'attachments'))
+        try:
+            metrics = {}
+            for name, benchmark in BENCHMARKS.items():
+                if args.only and name not in args.only:
+                    continue
+                rng = random.Random(f"{args.seed}-{name}")
+                # One untimed pass warms the page cache and the user directory
+                benchmark(service, data, rng, min(args.runs, 20))
+                metrics[name] = summarize(benchmark(service, data, rng, args.runs))
+        finally:
+            service.close()
+
+    return {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'users': args.users,
+            'groups': args.groups,
+            'messages': args.messages,
+            'attachment_ratio': args.attachment_ratio,
+            'seed': args.seed,
+            'runs': args.runs,
+        },
+        'metrics': metrics,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every statistic against a baseline; return the regressions"""
+    regressions = []
+    print(f"{'metric':<22} {'statistic':<12} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, current in results['metrics'].items():
+        previous = baseline.get('metrics', {}).get(name)
+        if previous is None:
+            continue
+        for statistic, higher_is_better in STATISTICS.items():
+            old, new = previous.get(statistic), current.get(statistic)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > threshold:
+                regressions.append((name, statistic, old, new))
+                flag = '  REGRESSION'
+            print(f"{name:<22} {statistic:<12} {old:>12.3f} {new:>12.3f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--attachment-ratio', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--runs', type=int, default=500, help="timed calls per benchmark")
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help="run only these benchmarks")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="compare against an earlier results file")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="relative slowdown that counts as a regression (default 0.25)")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) above {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
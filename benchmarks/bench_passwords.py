@@ -0,0 +1,98 @@
+"""Calibrate the password hashing cost to a target latency on this host
+
+Times chat_passwords.hash_password for increasing scrypt cost factors (or PBKDF2
+iteration counts where scrypt is unavailable) and reports the largest cost whose
+median hashing time stays within the target. Pass the result to ChatService as
+password_cost; existing hashes are upgraded on their next login.
+
+Run from the repository root:
+
+    python benchmarks/bench_passwords.py --target-ms 50
+    python benchmarks/bench_passwords.py --target-ms 100 --output passwords.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chat_passwords
+
+
+def median_ms(cost, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        chat_passwords.hash_password('benchmark password', cost)
+        durations.append(time.perf_counter() - start)
+    return round(statistics.median(durations) * 1000, 2)
+
+
+def candidate_costs(r, p):
+    """Costs in increasing order: scrypt n doubling, or PBKDF2 iterations growing by half"""
+    if chat_passwords.HAS_SCRYPT:
+        n = 2 ** 10
+        while n <= 2 ** 22:
+            yield {'n': n, 'r': r, 'p': p}
+            n *= 2
+    else:
+        iterations = 10000
+        while iterations <= 10 ** 8:
+            yield {'iterations': iterations}
+            iterations = iterations * 3 // 2
+
+
+def calibrate(target_ms, runs, r=8, p=1):
+    """Time candidate costs until one exceeds the target; return (chosen cost, measurements)"""
+    measurements = []
+    chosen = None
+    for cost in candidate_costs(r, p):
+        elapsed = median_ms(cost, runs)
+        measurements.append({'cost': cost, 'median_ms': elapsed})
+        if elapsed > target_ms:
+            break
+        chosen = cost
+    return chosen, measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--target-ms', type=float, default=50, help="hashing time to aim for (default 50)")
+    parser.add_argument('--runs', type=int, default=5, help="timed hashes per cost")
+    parser.add_argument('-r', type=int, default=8, help="scrypt block size")
+    parser.add_argument('-p', type=int, default=1, help="scrypt parallelism")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    chosen, measurements = calibrate(args.target_ms, args.runs, args.r, args.p)
+    for measurement in measurements:
+        print(f"{json.dumps(measurement['cost']):<36} {measurement['median_ms']:>10.2f} ms")
+    if chosen is None:
+        print(f"Even the cheapest cost takes longer than {args.target_ms} ms")
+    else:
+        print(f"password_cost={json.dumps(chosen)}")
+
+    if args.output:
+        results = {
+            'meta': {
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'algorithm': 'scrypt' if chat_passwords.HAS_SCRYPT else 'pbkdf2_sha256',
+                'target_ms': args.target_ms,
+                'runs': args.runs,
+            },
+            'chosen': chosen,
+            'measurements': measurements,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
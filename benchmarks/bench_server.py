@@ -0,0 +1,362 @@
+"""Load test of chat_server on localhost with thousands of concurrent connections
+
+Starts a server on a fresh database, opens --connections client connections and
+registers and logs in a user on each. Then every connection sends --messages direct
+messages to random other users while the others stay connected and receive the
+events, and a few members of one large group send to it, so every message fans out
+to all --group-members connections. --slow of those members stop reading during the
+fan-out; the server must drop or resync them without slowing the senders down.
+Finally every connection sends --heartbeats presence heartbeats, which the server
+answers from memory without touching the database. Reports request latency, throughput, events delivered and the server's CPU time and
+memory.
+
+Run from the repository root:
+
+    python benchmarks/bench_server.py --connections 2000 --messages 5
+    python benchmarks/bench_server.py --listen 127.0.0.1:8799 --workers 4 --output server.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chat_protocol
+from bench_hot_paths import summarize
+
+# Cheap hashes: registering thousands of users should not dominate the run
+BENCH_PASSWORD_COST = {'n': 2 ** 10, 'r': 8, 'p': 1}
+
+
+def raise_file_limit():
+    """Allow as many open sockets as the hard limit permits"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_worker(database, listen, broker, reuse_port):
+    """Server process: a ChatServer with cheap password hashes"""
+    from chat_server import ChatServer
+    from chat_service import ChatService
+
+    raise_file_limit()
+    service = ChatService(database, attachments_dir=os.path.join(os.path.dirname(database), 'attachments'),
+                          password_cost=BENCH_PASSWORD_COST)
+    server = ChatServer(service, broker)
+    try:
+        asyncio.run(server.serve(listen, reuse_port=reuse_port))
+    finally:
+        server.close()
+        service.close()
+
+
+def serve(database, listen, workers):
+    """One worker, or a broker and several workers sharing the port"""
+    import chat_db
+    from chat_server import run_broker
+
+    if workers == 1:
+        run_worker(database, listen, None, False)
+        return
+    db = chat_db.ConnectionManager(database)
+    chat_db.migrate(db.writer())
+    db.close()
+    broker = os.path.join(os.path.dirname(database), 'broker.sock')
+    processes = [multiprocessing.Process(target=run_broker, args=(broker,))]
+    processes += [multiprocessing.Process(target=run_worker, args=(database, listen, broker, True))
+                  for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def process_tree(pid):
+    """pid and the pids of all its descendants"""
+    pids = [pid]
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            for child in f.read().split():
+                pids += process_tree(int(child))
+    except OSError:
+        pass
+    return pids
+
+
+def process_usage(pid):
+    """(CPU seconds, resident MiB) of a process and its children, from /proc"""
+    cpu = rss = 0
+    try:
+        for member in process_tree(pid):
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            with open(f'/proc/{member}/status') as f:
+                rss += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        return None, None
+    return cpu, round(rss / 1024, 1)
+
+
+class BenchConnection:
+    """A raw protocol connection; responses are matched to requests by id"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.next_id = 0
+        self.pending = {}
+        self.events = 0
+        self.resyncs = 0
+        self.closed = False
+        self.reading = asyncio.Event()
+        self.reading.set()
+
+    async def open(self, address):
+        kind, *where = chat_protocol.parse_address(address)
+        if kind == 'tcp':
+            self.reader, self.writer = await asyncio.open_connection(*where)
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(where[0])
+        self.task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                # Cleared to simulate a client that stops reading
+                await self.reading.wait()
+                frame, codec = await chat_protocol.read_frame(self.reader)
+                if frame is None:
+                    break
+                if frame.get('event') == 'resync':
+                    self.resyncs += 1
+                elif 'event' in frame:
+                    self.events += 1
+                else:
+                    self.pending.pop(frame['id']).set_result(frame)
+        except ConnectionError:
+            pass
+        self.closed = True
+
+    async def request(self, op, **args):
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        self.writer.write(chat_protocol.encode_frame({'id': self.next_id, 'op': op, 'args': args}, self.codec))
+        response = await future
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['result']
+
+    async def timed(self, durations, op, **args):
+        start = time.perf_counter()
+        result = await self.request(op, **args)
+        durations.append(time.perf_counter() - start)
+        return result
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+async def wait_for_server(address, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            probe = BenchConnection(chat_protocol.JSON)
+            await probe.open(address)
+            probe.close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def measure(server_pid, coroutine):
+    """(elapsed seconds, server CPU share) of running a coroutine"""
+    cpu_before = process_usage(server_pid)[0]
+    start = time.perf_counter()
+    await coroutine
+    elapsed = time.perf_counter() - start
+    cpu_after = process_usage(server_pid)[0]
+    cpu_share = round((cpu_after - cpu_before) / elapsed, 2) if cpu_before is not None else None
+    return elapsed, cpu_share
+
+
+async def load(args, server_pid):
+    codec = chat_protocol.CODECS[args.codec]
+    connections = [BenchConnection(codec) for _ in range(args.connections)]
+    results = {}
+
+    start = time.perf_counter()
+    # Opened in batches so the listen backlog is not overrun
+    for offset in range(0, len(connections), 500):
+        await asyncio.gather(*(c.open(args.listen) for c in connections[offset:offset + 500]))
+    results['connect'] = {'seconds': round(time.perf_counter() - start, 2)}
+
+    durations = []
+    start = time.perf_counter()
+    user_ids = await asyncio.gather(*(
+        c.timed(durations, 'register', username=f'user{i}', password='password') for i, c in enumerate(connections)))
+    await asyncio.gather(*(
+        c.timed(durations, 'login', username=f'user{i}', password='password') for i, c in enumerate(connections)))
+    results['register+login'] = dict(summarize(durations), seconds=round(time.perf_counter() - start, 2))
+
+    async def send_direct(connection, own_id, durations):
+        for _ in range(args.messages):
+            receiver_id = random.choice(user_ids)
+            while receiver_id == own_id:
+                receiver_id = random.choice(user_ids)
+            await connection.timed(durations, 'send', message='benchmark message', receiver_id=receiver_id)
+
+    durations = []
+    elapsed, cpu_share = await measure(server_pid, asyncio.gather(*(
+        send_direct(c, user_id, durations) for c, user_id in zip(connections, user_ids))))
+    results['send'] = dict(summarize(durations), seconds=round(elapsed, 2), server_cpu_share=cpu_share,
+                           messages_per_sec=round(len(durations) / elapsed, 1))
+
+    # Every message reaches its sender and its receiver
+    await asyncio.sleep(0.5)
+    results['events'] = {'delivered': sum(c.events for c in connections),
+                         'expected': 2 * args.connections * args.messages}
+
+    durations = []
+    start = time.perf_counter()
+    await asyncio.gather(*(c.timed(durations, 'messages_since', after_id=0, limit=50) for c in connections))
+    results['messages_since'] = dict(summarize(durations), seconds=round(time.perf_counter() - start, 2))
+
+    # Group fan-out: members[0] creates the group, slow members stop reading, senders post
+    members = connections[:args.group_members]
+    group_id = await members[0].request('create_group', name='benchmark')
+    for user_id in user_ids[1:args.group_members]:
+        await members[0].request('add_group_member', group_id=group_id, user_id=user_id)
+    slow = members[1:1 + args.slow]
+    senders = members[1 + args.slow:1 + args.slow + args.group_senders]
+    fast = [c for c in members if c not in slow]
+    for c in slow:
+        c.reading.clear()
+    events_before = sum(c.events for c in fast)
+    text = 'x' * args.message_size
+
+    async def send_group(connection, durations):
+        for _ in range(args.group_messages):
+            await connection.timed(durations, 'send', message=text, group_id=group_id)
+
+    durations = []
+    elapsed, cpu_share = await measure(server_pid, asyncio.gather(*(send_group(c, durations) for c in senders)))
+    sent = len(durations)
+    # Let the fast members read everything before counting
+    for _ in range(100):
+        if sum(c.events for c in fast) - events_before >= sent * len(fast):
+            break
+        await asyncio.sleep(0.1)
+    delivered = sum(c.events for c in fast) - events_before
+    results['group fan-out'] = dict(summarize(durations), seconds=round(elapsed, 2), server_cpu_share=cpu_share,
+                                    members=len(members), messages_per_sec=round(sent / elapsed, 1),
+                                    events_per_sec=round(sent * len(members) / elapsed, 1),
+                                    delivered_to_fast=delivered, expected_for_fast=sent * len(fast))
+
+    # Slow members read again: each is either resynced or was disconnected
+    for c in slow:
+        c.reading.set()
+    await asyncio.sleep(1)
+    results['slow consumers'] = {'count': len(slow), 'resynced': sum(1 for c in slow if c.resyncs),
+                                 'disconnected': sum(1 for c in slow if c.closed),
+                                 'max_events_received': max((c.events for c in slow), default=0)}
+
+    # Presence: heartbeats keep every user online and only refresh an in-memory deadline
+    async def heartbeat(connection, durations):
+        for _ in range(args.heartbeats):
+            await connection.timed(durations, 'heartbeat')
+
+    durations = []
+    connected = [c for c in connections if not c.closed]
+    elapsed, cpu_share = await measure(server_pid, asyncio.gather(*(
+        heartbeat(c, durations) for c in connected)))
+    results['heartbeat'] = dict(summarize(durations), seconds=round(elapsed, 2), server_cpu_share=cpu_share,
+                                heartbeats_per_sec=round(len(durations) / elapsed, 1))
+
+    results['server'] = {'rss_mib': process_usage(server_pid)[1]}
+    for c in connections:
+        c.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=5, help="direct messages sent by each connection")
+    parser.add_argument('--group-members', type=int, default=500)
+    parser.add_argument('--group-senders', type=int, default=10)
+    parser.add_argument('--group-messages', type=int, default=100, help="messages sent by each group sender")
+    parser.add_argument('--message-size', type=int, default=200, help="characters per group message")
+    parser.add_argument('--heartbeats', type=int, default=5, help="presence heartbeats sent by each connection")
+    parser.add_argument('--slow', type=int, default=10, help="group members that stop reading")
+    parser.add_argument('--listen', help="host:port or Unix socket path (default: a socket in a temp dir)")
+    parser.add_argument('--workers', type=int, default=1, help="server processes; needs a TCP --listen")
+    parser.add_argument('--codec', choices=sorted(chat_protocol.CODECS), default='json')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--serve', nargs=2, metavar=('DATABASE', 'LISTEN'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(*args.serve, args.workers)
+        return
+
+    raise_file_limit()
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        args.listen = args.listen or os.path.join(directory, 'chat.sock')
+        if args.workers > 1 and chat_protocol.parse_address(args.listen)[0] != 'tcp':
+            parser.error("several workers can only share a TCP port")
+        # In its own session, so the server and its workers are stopped together
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve',
+                                   os.path.join(directory, 'bench.db'), args.listen, '--workers', str(args.workers)],
+                                  start_new_session=True)
+        try:
+            asyncio.run(wait_for_server(args.listen))
+            # Workers start at slightly different times; let all of them listen
+            time.sleep(0.5 if args.workers > 1 else 0)
+            results = asyncio.run(load(args, server.pid))
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait()
+
+    results = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'connections': args.connections,
+            'messages': args.messages,
+            'group_members': args.group_members,
+            'slow': args.slow,
+            'heartbeats': args.heartbeats,
+            'workers': args.workers,
+            'codec': args.codec,
+            'transport': chat_protocol.parse_address(args.listen)[0],
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Seeded synthetic chat data for benchmarks
+
+Builds a database with users, groups and messages whose shape resembles a real chat:
+a few conversations and senders account for most of the traffic (Zipf-like skew),
+group sizes vary widely, message lengths are long-tailed and a fraction of messages
+carry attachments. The same arguments and seed always produce the same database.
+
+Run from the repository root to write a database file:
+
+    python benchmarks/datagen.py bench.db --users 1000 --groups 100 --messages 200000
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import chat_db
+from chat_passwords import hash_password
+
+PASSWORD = 'password'
+
+WORDS = ('hello hi hey thanks ok sure yes no maybe later today tomorrow meeting lunch coffee '
+         'project deadline release build test deploy review merge branch bug fix issue ticket '
+         'call chat group team plan idea design draft update status report notes file photo '
+         'video link weekend morning evening great awesome cool sorry please check done wait').split()
+
+FILE_TYPES = (('image', '.jpg', 6), ('document', '.pdf', 3), ('video', '.mp4', 1))
+
+
+def zipf_weights(count, exponent):
+    """Cumulative weights where rank r has weight 1 / r**exponent"""
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, count + 1)))
+
+
+def message_text(rng):
+    """A few words, occasionally a long message"""
+    length = min(int(rng.lognormvariate(1.8, 0.7)) + 1, 80)
+    return ' '.join(rng.choice(WORDS) for _ in range(length))
+
+
+def generate(path, users=200, groups=20, messages=20000, direct_pairs=None, attachment_ratio=0.05,
+             skew=1.1, seed=1234, batch_size=5000):
+    """Create (or extend) a chat database at path; return a summary of what was generated
+
+    The summary holds the user ids, group ids and conversation ids together with their
+    cumulative popularity weights, so benchmarks can pick conversations with the same skew.
+    """
+    rng = random.Random(seed)
+    direct_pairs = direct_pairs if direct_pairs is not None else users * 3
+
+    conn = sqlite3.connect(path)
+    chat_db.migrate(conn)
+    cursor = conn.cursor()
+
+    # Users; all share one password so benchmarks can log in
+    first_user = (cursor.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0]) + 1
+    password = hash_password(PASSWORD)
+    cursor.executemany("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
+                       [(f"user{seed}_{i}", password, f"user{i}@example.com") for i in range(users)])
+    user_ids = list(range(first_user, first_user + users))
+    user_weights = zipf_weights(users, skew)
+
+    # Groups; sizes are long-tailed between 3 members and the whole user base
+    group_ids = []
+    group_members = {}
+    for i in range(groups):
+        size = max(3, min(users, int(rng.paretovariate(1.2) * 3)))
+        members = rng.sample(user_ids, size)
+        cursor.execute("INSERT INTO groups (name, description, created_by) VALUES (?, ?, ?)",
+                       (f"group{seed}_{i}", f"Synthetic group {i}", members[0]))
+        group_id = cursor.lastrowid
+        cursor.executemany("INSERT INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, ?)",
+                           [(group_id, user_id, user_id == members[0]) for user_id in members])
+        group_ids.append(group_id)
+        group_members[group_id] = members
+
+    # Direct conversations between pairs of users, chatty users taking part more often
+    pairs = set()
+    while len(pairs) < min(direct_pairs, users * (users - 1) // 2):
+        a, b = rng.choices(user_ids, cum_weights=user_weights, k=2)
+        if a != b:
+            pairs.add((min(a, b), max(a, b)))
+    pairs = sorted(pairs)
+
+    # Every conversation gets a popularity rank; a handful carry most of the messages
+    conversations = [('direct', pair) for pair in pairs] + [('group', group_id) for group_id in group_ids]
+    rng.shuffle(conversations)
+    conversation_weights = zipf_weights(len(conversations), skew)
+
+    file_types = [(file_type, ext) for file_type, ext, weight in FILE_TYPES for _ in range(weight)]
+    start = datetime.datetime(2024, 1, 1)
+    seconds = 90 * 24 * 3600 / max(messages, 1)
+
+    batch = []
+    for i in range(messages):
+        kind, key = rng.choices(conversations, cum_weights=conversation_weights)[0]
+        if kind == 'direct':
+            sender_id = rng.choice(key)
+            receiver_id = key[1] if sender_id == key[0] else key[0]
+            group_id = None
+            conversation_id = chat_db.direct_conversation_id(*key)
+        else:
+            sender_id = rng.choice(group_members[key])
+            receiver_id = None
+            group_id = key
+            conversation_id = chat_db.group_conversation_id(key)
+
+        file_path = file_type = None
+        if rng.random() < attachment_ratio:
+            file_type, ext = rng.choice(file_types)
+            file_path = os.path.join('attachments', f"{i}_{file_type}{ext}")
+            text = f"Sent a {file_type}"
+        else:
+            text = message_text(rng)
+
+        timestamp = (start + datetime.timedelta(seconds=i * seconds)).strftime('%Y-%m-%d %H:%M:%S')
+        batch.append((sender_id, receiver_id, group_id, conversation_id, text, file_path, file_type, timestamp))
+        if len(batch) >= batch_size:
+            insert_messages(cursor, batch)
+            batch = []
+    insert_messages(cursor, batch)
+    conn.commit()
+    conn.close()
+
+    return {
+        'users': user_ids,
+        'user_weights': user_weights,
+        'groups': group_ids,
+        'group_members': group_members,
+        'conversations': [conversation_id_of(kind, key) for kind, key in conversations],
+        'conversation_members': [key if kind == 'direct' else group_members[key]
+                                 for kind, key in conversations],
+        'conversation_weights': conversation_weights,
+    }
+
+
+def conversation_id_of(kind, key):
+    if kind == 'direct':
+        return chat_db.direct_conversation_id(*key)
+    return chat_db.group_conversation_id(key)
+
+
+def insert_messages(cursor, rows):
+    cursor.executemany("""
+        INSERT INTO messages (sender_id, receiver_id, group_id, conversation_id, message, file_path,
+                              file_type, timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help="database file to create or extend")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--attachment-ratio', type=float, default=0.05)
+    parser.add_argument('--skew', type=float, default=1.1)
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    summary = generate(args.path, users=args.users, groups=args.groups, messages=args.messages,
+                       attachment_ratio=args.attachment_ratio, skew=args.skew, seed=args.seed)
+    print(f"{args.path}: {len(summary['users'])} users, {len(summary['groups'])} groups, "
+          f"{len(summary['conversations'])} conversations, {args.messages} messages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Linux ioctl that makes a file share the extents of another (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+
+def reflink(source_path, target_path):
+    """Create target_path as a copy-on-write clone of source_path; False if unsupported"""
+    if fcntl is None:
+        return False
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            return True
+        except OSError:
+            return False
+
+
+def link_or_copy(source_path, target_path):
+    """Give target_path the content of source_path, sharing it on disk when possible
+
+    Tries a hardlink, then a reflink, and only then falls back to a plain copy.
+    """
+    try:
+        os.link(source_path, target_path)
+        return
+    except FileExistsError:
+        # Stored concurrently under the same name; the content is identical
+        return
+    except OSError:
+        pass
+
+    temp_path = f"{target_path}.{uuid.uuid4().hex}.part"
+    try:
+        if not reflink(source_path, temp_path):
+            shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class BlobStore:
+    """Content-addressed store for attachment files
+
+    A file lives at root/<aa>/<bb>/<sha256>/<original name>, where aa and bb are the first
+    hex digits of its SHA-256 digest. All names in one digest directory have the same
+    content and are hardlinked (or reflinked) to each other, so identical files take disk
+    space once no matter how often or under which name they are sent. The digest is
+    computed while the file is copied, and re-sending an unchanged file from the same
+    path skips reading it altogether.
+    """
+
+    def __init__(self, root, chunk_size=1024 * 1024, remembered_sources=1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.remembered_sources = remembered_sources
+
+        # (source path, size, mtime) -> digest of files stored earlier
+        self.source_digests = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def blob_dir(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def source_key(self, source_path):
+        stat = os.stat(source_path)
+        return os.path.abspath(source_path), stat.st_size, stat.st_mtime_ns
+
+    def known_digest(self, source_path):
+        """Digest of an unchanged file already stored from the same path, if still stored"""
+        key = self.source_key(source_path)
+        with self.lock:
+            digest = self.source_digests.get(key)
+            if digest is None:
+                return None
+            self.source_digests.move_to_end(key)
+        return digest if self.stored_copy(digest) else None
+
+    def remember(self, source_path, digest):
+        key = self.source_key(source_path)
+        with self.lock:
+            self.source_digests[key] = digest
+            self.source_digests.move_to_end(key)
+            while len(self.source_digests) > self.remembered_sources:
+                self.source_digests.popitem(last=False)
+
+    def stored_copy(self, digest):
+        """Path of any stored file with this digest, or None"""
+        try:
+            names = [name for name in os.listdir(self.blob_dir(digest)) if not name.endswith('.part')]
+        except FileNotFoundError:
+            return None
+        return os.path.join(self.blob_dir(digest), names[0]) if names else None
+
+    def store(self, source_path, on_progress=None):
+        """Store a file under its original name; return (stored path, digest, size)
+
+        on_progress(copied, total) is called after every chunk copied.
+        """
+        file_name = os.path.basename(source_path)
+        total = os.path.getsize(source_path)
+
+        digest = self.known_digest(source_path)
+        if digest is not None:
+            target_path = os.path.join(self.blob_dir(digest), file_name)
+            if not os.path.exists(target_path):
+                link_or_copy(self.stored_copy(digest), target_path)
+            if on_progress:
+                on_progress(total, total)
+            return target_path, digest, total
+
+        # Copy and hash in one pass into a temporary file on the same filesystem
+        os.makedirs(self.root, exist_ok=True)
+        temp_path = os.path.join(self.root, f".{uuid.uuid4().hex}.part")
+        hasher = hashlib.sha256()
+        try:
+            with open(source_path, 'rb') as source, open(temp_path, 'wb') as target:
+                copied = 0
+                while True:
+                    chunk = source.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    hasher.update(chunk)
+                    target.write(chunk)
+                    copied += len(chunk)
+                    if on_progress:
+                        on_progress(copied, total)
+            shutil.copystat(source_path, temp_path)
+
+            digest = hasher.hexdigest()
+            os.makedirs(self.blob_dir(digest), exist_ok=True)
+            target_path = os.path.join(self.blob_dir(digest), file_name)
+            existing_path = self.stored_copy(digest)
+            if existing_path is None:
+                os.replace(temp_path, target_path)
+            else:
+                # Known content: keep a single copy on disk
+                os.remove(temp_path)
+                if existing_path != target_path:
+                    link_or_copy(existing_path, target_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        self.remember(source_path, digest)
+        return target_path, digest, copied
+
+    def remove(self, file_path):
+        """Delete a stored name, and its digest directory once it is empty"""
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+        # Digest directory and the two shard levels above it
+        directory = os.path.dirname(file_path)
+        for _ in range(3):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
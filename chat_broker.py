@@ -0,0 +1,131 @@
+"""Relay between chat server workers on one host
+
+    python chat_broker.py /tmp/chat-broker.sock
+
+Several chat_server workers can serve the same database (see chat_server --workers).
+Each connects to the broker over a Unix socket; whatever one worker sends is relayed
+to all the others, so events reach the clients connected to any worker. Frames are
+relayed as they are, without decoding them. Worker commands are:
+
+    {"op": "publish", "conversation_id": "g:3", "event": {...}}
+    {"op": "join", "user_id": 7, "conversation_id": "g:3"}
+    {"op": "resync"}
+    {"op": "presence", "worker": "<uuid>", "online": [4, 7], "offline": [2]}
+
+"presence" carries the users a worker saw come online (or all of its online users,
+re-announced every HEARTBEAT_INTERVAL and after reconnecting) and those that went
+offline there; the others count them online until PRESENCE_TTL after the last mention.
+
+A worker that falls more than BROKER_BUFFER_LIMIT behind is disconnected rather than
+allowed to hold up the others; it reconnects and asks every client to resync.
+"""
+import argparse
+import asyncio
+import os
+
+import chat_protocol
+
+# Bytes queued for one worker before it is disconnected as too slow
+BROKER_BUFFER_LIMIT = 8 * 1024 * 1024
+
+# Seconds between attempts to reach the broker
+RECONNECT_DELAY = 0.5
+
+
+class Broker:
+    def __init__(self):
+        self.peers = set()  # StreamWriters of the connected workers
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.accept, path)
+        async with server:
+            await server.serve_forever()
+
+    async def accept(self, reader, writer):
+        self.peers.add(writer)
+        try:
+            while True:
+                frame = await chat_protocol.read_raw_frame(reader)
+                if frame is None:
+                    break
+                self.relay(frame, writer)
+        except (ConnectionError, chat_protocol.ProtocolError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+
+    def relay(self, frame, sender):
+        for peer in list(self.peers):
+            if peer is sender:
+                continue
+            if peer.transport.get_write_buffer_size() > BROKER_BUFFER_LIMIT:
+                self.peers.discard(peer)
+                peer.transport.abort()
+                continue
+            peer.write(frame)
+
+
+class BrokerLink:
+    """A worker's connection to the broker, re-established whenever it drops
+
+    on_command(command) is called for every command relayed from another worker and
+    on_reconnect() after each reconnection, as commands may have been lost meanwhile.
+    """
+
+    def __init__(self, path, on_command, on_reconnect):
+        self.path = path
+        self.on_command = on_command
+        self.on_reconnect = on_reconnect
+        self.writer = None
+
+    async def run(self):
+        connected_before = False
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+            except OSError:
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            if connected_before:
+                self.send({'op': 'resync'})
+                self.on_reconnect()
+            connected_before = True
+            try:
+                while True:
+                    command, codec = await chat_protocol.read_frame(reader)
+                    if command is None:
+                        break
+                    self.on_command(command)
+            except (ConnectionError, chat_protocol.ProtocolError):
+                pass
+            self.writer.close()
+            self.writer = None
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    def send(self, command):
+        """Relay a command to the other workers; dropped while disconnected"""
+        writer = self.writer
+        if writer is None or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > BROKER_BUFFER_LIMIT:
+            # Behind on the broker: start over and let every client resync
+            writer.transport.abort()
+            return
+        writer.write(chat_protocol.encode_frame(command))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help="Unix socket to listen on")
+    args = parser.parse_args()
+    try:
+        asyncio.run(Broker().serve(args.path))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
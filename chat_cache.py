@@ -0,0 +1,133 @@
+import collections
+import sys
+
+
+def row_cost(row):
+    """Approximate bytes taken by a display row: the dict and its strings"""
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row.values() if isinstance(value, str))
+
+
+class CachedConversation:
+    """The newest display rows of one conversation, in ascending id order"""
+
+    def __init__(self, rows, has_older):
+        self.rows = list(rows)
+        self.has_older = has_older
+        self.cost = sum(row_cost(row) for row in self.rows)
+
+    def last_id(self):
+        return self.rows[-1]['id'] if self.rows else 0
+
+
+class HistoryCache:
+    """Recent history of the conversations opened lately, ready to show without the database
+
+    Each conversation keeps its newest max_rows display rows (already formatted by the
+    application). Conversations are dropped least recently opened first once the rows
+    take more than memory_budget bytes. The cache is kept current by feeding it new
+    messages and edits as the application learns about them; rows of a single message
+    are found through an index by message id, so edits and deletes touch only that row.
+    """
+
+    def __init__(self, memory_budget=8 * 1024 * 1024, max_rows=200):
+        self.memory_budget = memory_budget
+        self.max_rows = max_rows
+
+        self.conversations = collections.OrderedDict()  # conversation id -> CachedConversation
+        self.message_conversations = {}  # message id -> conversation id
+        self.memory_used = 0
+
+    def __contains__(self, conversation_id):
+        return conversation_id in self.conversations
+
+    def has_message(self, message_id):
+        return message_id in self.message_conversations
+
+    def get(self, conversation_id):
+        """(rows, has_older) of a cached conversation, or None"""
+        entry = self.conversations.get(conversation_id)
+        if entry is None:
+            return None
+        self.conversations.move_to_end(conversation_id)
+        return list(entry.rows), entry.has_older
+
+    def put(self, conversation_id, rows, has_older):
+        """Cache the latest rows of a conversation, replacing what was cached"""
+        self.discard(conversation_id)
+        entry = self.conversations[conversation_id] = CachedConversation(rows, has_older)
+        for row in entry.rows:
+            self.message_conversations[row['id']] = conversation_id
+        self.memory_used += entry.cost
+        self.trim(conversation_id, entry)
+        self.evict()
+
+    def append_rows(self, conversation_id, rows):
+        """Add new messages to a cached conversation; rows already cached are skipped"""
+        entry = self.conversations.get(conversation_id)
+        if entry is None:
+            return
+        rows = [row for row in rows if row['id'] > entry.last_id()]
+        for row in rows:
+            entry.rows.append(row)
+            entry.cost += row_cost(row)
+            self.memory_used += row_cost(row)
+            self.message_conversations[row['id']] = conversation_id
+        self.trim(conversation_id, entry)
+        self.evict()
+
+    def update_row(self, row):
+        """Replace the cached row of an edited message"""
+        entry = self.conversations.get(self.message_conversations.get(row['id']))
+        if entry is None:
+            return
+        for index, cached in enumerate(entry.rows):
+            if cached['id'] == row['id']:
+                difference = row_cost(row) - row_cost(cached)
+                entry.rows[index] = row
+                entry.cost += difference
+                self.memory_used += difference
+                return
+
+    def remove_row(self, message_id):
+        """Drop the cached row of a deleted message"""
+        conversation_id = self.message_conversations.pop(message_id, None)
+        entry = self.conversations.get(conversation_id)
+        if entry is None:
+            return
+        for index, cached in enumerate(entry.rows):
+            if cached['id'] == message_id:
+                del entry.rows[index]
+                entry.cost -= row_cost(cached)
+                self.memory_used -= row_cost(cached)
+                return
+
+    def discard(self, conversation_id):
+        entry = self.conversations.pop(conversation_id, None)
+        if entry is None:
+            return
+        for row in entry.rows:
+            self.message_conversations.pop(row['id'], None)
+        self.memory_used -= entry.cost
+
+    def clear(self):
+        self.conversations.clear()
+        self.message_conversations.clear()
+        self.memory_used = 0
+
+    def trim(self, conversation_id, entry):
+        """Keep only the newest max_rows rows of a conversation"""
+        excess = len(entry.rows) - self.max_rows
+        if excess <= 0:
+            return
+        for row in entry.rows[:excess]:
+            self.message_conversations.pop(row['id'], None)
+            entry.cost -= row_cost(row)
+            self.memory_used -= row_cost(row)
+        del entry.rows[:excess]
+        entry.has_older = True
+
+    def evict(self):
+        """Drop the least recently used conversations while over budget, keeping the newest"""
+        while self.memory_used > self.memory_budget and len(self.conversations) > 1:
+            conversation_id = next(iter(self.conversations))
+            self.discard(conversation_id)
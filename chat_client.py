@@ -0,0 +1,315 @@
+"""Client of chat_server with the interface of chat_service.ChatService
+
+The UIs use a ChatClient exactly like a local ChatService. Calls block until the
+server answers (at most REQUEST_TIMEOUT seconds), except the *_async ones, which
+return Futures. Once the connection is lost every call raises ConnectionError. The
+connection runs on an asyncio loop in a background thread; events pushed by the
+server wake the client's notifier, so waiting on it works as with a local database.
+After a "resync" event (the server dropped events because the client fell behind)
+every waiter on ANY_CONVERSATION is woken to catch up through
+messages_since()/changes_since().
+
+Once logged in, the connection acts as that user: the user ids the ChatService
+methods take (sender_id, owner_id, ...) are accepted for compatibility but the
+server always uses the logged-in user.
+
+Presence is kept current by the server's "presence" events, so online_users() needs
+no round trip, and heartbeat() sends nothing while other requests keep the user online.
+"""
+import asyncio
+import base64
+import concurrent.futures
+import itertools
+import os
+import threading
+import time
+
+import chat_db
+import chat_protocol
+from chat_events import ChangeNotifier
+from chat_presence import HEARTBEAT_INTERVAL
+from chat_service import (ATTACHMENT_WORKERS, ATTACHMENTS_DIR, MAX_ATTACHMENT_SIZE, ChatError, Message,
+                          SearchPage, SearchResult)
+
+# Attachment bytes per upload_chunk request; base64 keeps frames well under the limit
+UPLOAD_CHUNK_SIZE = 512 * 1024
+
+# Seconds a blocking call waits for its response before giving up on the server
+REQUEST_TIMEOUT = 30.0
+
+
+class RemoteUserDirectory(chat_db.UserDirectory):
+    """chat_db.UserDirectory loaded from the server"""
+
+    def __init__(self, client):
+        super().__init__(None)
+        self.client = client
+
+    def load(self):
+        self.usernames = dict(self.client.call('list_users'))
+        self.missing.clear()
+
+    def has_new_users(self):
+        # ChatClient.list_users() asks the server every time instead
+        return False
+
+
+class ChatClient:
+    def __init__(self, address, attachments_dir=ATTACHMENTS_DIR, codec='json'):
+        self.address = address
+        self.attachments_dir = attachments_dir
+        self.codec = chat_protocol.CODECS[codec]
+        self.request_ids = itertools.count(1)
+        self.pending = {}  # request id -> asyncio Future of the response
+        self.reader = None
+        self.writer = None
+        self.read_task = None
+        self.closed = False  # set once the connection is lost; later requests fail at once
+        self.last_request = 0.0  # time.monotonic() of the latest request
+
+        # Users online, kept current by presence events once followed
+        self.online = frozenset()
+        self.presence_stale = True
+
+        self.users = RemoteUserDirectory(self)
+        # Only woken by server events; there is no database to watch
+        self.notifier = ChangeNotifier(None)
+
+        self.upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS,
+                                                                 thread_name_prefix='upload')
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, name='chat-client', daemon=True)
+        self.loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self.connect(), self.loop).result()
+
+    async def connect(self):
+        kind, *where = chat_protocol.parse_address(self.address)
+        if kind == 'tcp':
+            self.reader, self.writer = await asyncio.open_connection(*where)
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(where[0])
+        self.read_task = self.loop.create_task(self.read_loop())
+
+    async def disconnect(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None:
+            self.read_task.cancel()
+            await asyncio.gather(self.read_task, return_exceptions=True)
+
+    async def read_loop(self):
+        try:
+            while True:
+                frame, codec = await chat_protocol.read_frame(self.reader)
+                if frame is None:
+                    break
+                if frame.get('event') == 'resync':
+                    # Events were dropped; waiters on any conversation fetch what they missed
+                    self.presence_stale = True
+                    self.notifier.notify()
+                    continue
+                if frame.get('event') == 'presence':
+                    if frame.get('snapshot'):
+                        self.online = frozenset(frame['online'])
+                    else:
+                        self.online = (self.online | set(frame['online'])) - set(frame['offline'])
+                    continue
+                if 'event' in frame:
+                    self.notifier.notify(frame['conversation_id'])
+                    continue
+                future = self.pending.pop(frame.get('id'), None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except (ConnectionError, chat_protocol.ProtocolError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection to the chat server was lost"))
+            self.pending.clear()
+            # Waiters wake up, and their next request reports the lost connection
+            self.notifier.notify()
+
+    async def request(self, op, args):
+        if self.closed or self.writer.is_closing():
+            raise ConnectionError("Connection to the chat server was lost")
+        request_id = next(self.request_ids)
+        self.last_request = time.monotonic()
+        future = self.loop.create_future()
+        self.pending[request_id] = future
+        try:
+            self.writer.write(chat_protocol.encode_frame({'id': request_id, 'op': op, 'args': args}, self.codec))
+            await self.writer.drain()
+            response = await future
+        finally:
+            # Cancelled by a timed-out call, or the write failed
+            self.pending.pop(request_id, None)
+        if not response['ok']:
+            if response.get('user_error'):
+                raise ChatError(response['error'])
+            raise RuntimeError(f"Server error in {op}: {response['error']}")
+        return response['result']
+
+    def call_async(self, op, **args):
+        """Send a request; return a concurrent Future of its result"""
+        return asyncio.run_coroutine_threadsafe(self.request(op, args), self.loop)
+
+    def call(self, op, **args):
+        """Send a request and wait for its result, at most REQUEST_TIMEOUT seconds"""
+        future = self.call_async(op, **args)
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise ConnectionError(f"The chat server did not answer {op} within {REQUEST_TIMEOUT:g} seconds") from None
+
+    def start(self):
+        """Nothing to start: changes arrive as server events"""
+
+    def close(self):
+        self.upload_pool.shutdown(wait=True, cancel_futures=True)
+        asyncio.run_coroutine_threadsafe(self.disconnect(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.loop.close()
+
+    # Accounts
+
+    def register_async(self, username, password, email='', confirm_password=None):
+        return self.call_async('register', username=username, password=password, email=email,
+                               confirm_password=confirm_password)
+
+    def login_async(self, username, password):
+        return self.call_async('login', username=username, password=password)
+
+    # Presence
+
+    def heartbeat(self, user_id):
+        """Keep the user online; nothing is sent if another request went out recently"""
+        if time.monotonic() - self.last_request >= HEARTBEAT_INTERVAL:
+            self.call_async('heartbeat')
+
+    def go_offline(self, user_id):
+        """Log the connection out; the user goes offline unless logged in elsewhere"""
+        self.presence_stale = True
+        return self.call_async('logout')
+
+    def online_users(self):
+        """Ids of the users online; none are known while disconnected"""
+        if self.closed:
+            return frozenset()
+        if self.presence_stale:
+            self.presence_stale = False
+            try:
+                # The snapshot event arrives before the response
+                self.call('presence')
+            except ConnectionError:
+                self.presence_stale = True
+                return frozenset()
+        return self.online
+
+    def list_users(self, exclude_id=None, search=''):
+        return [(user_id, username) for user_id, username in self.call('list_users', search=search)
+                if user_id != exclude_id]
+
+    # Groups
+
+    def create_group(self, owner_id, name, description=''):
+        return self.call('create_group', name=name, description=description)
+
+    def add_group_member(self, group_id, user_id, is_admin=False):
+        self.call('add_group_member', group_id=group_id, user_id=user_id, is_admin=is_admin)
+
+    def list_groups(self, user_id, search=''):
+        return [tuple(row) for row in self.call('list_groups', search=search)]
+
+    def get_group_name(self, group_id):
+        return self.call('get_group_name', group_id=group_id)
+
+    # Messages
+
+    def send_message(self, sender_id, message, receiver_id=None, group_id=None, client_id=None):
+        return self.call('send', message=message, receiver_id=receiver_id, group_id=group_id, client_id=client_id)
+
+    def queue_message(self, sender_id, message, receiver_id=None, group_id=None, client_id=None):
+        return self.call_async('send', message=message, receiver_id=receiver_id, group_id=group_id,
+                               client_id=client_id)
+
+    def attach_file(self, sender_id, source_path, message='', receiver_id=None, group_id=None,
+                    on_progress=None):
+        """Upload a file in chunks and send it as a message; return the message id"""
+        total = os.path.getsize(source_path)
+        if total > MAX_ATTACHMENT_SIZE:
+            raise ChatError("File size too large! Maximum size is 50MB.")
+
+        upload_id = self.call('upload_start', file_name=os.path.basename(source_path), size=total)
+        try:
+            copied = 0
+            with open(source_path, 'rb') as f:
+                while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                    self.call('upload_chunk', upload_id=upload_id, data=base64.b64encode(chunk).decode())
+                    copied += len(chunk)
+                    if on_progress is not None:
+                        on_progress(copied, total)
+        except BaseException:
+            self.call_async('upload_cancel', upload_id=upload_id)
+            raise
+        return self.call('upload_finish', upload_id=upload_id, message=message, receiver_id=receiver_id,
+                         group_id=group_id)
+
+    def attach_file_async(self, sender_id, source_path, message='', receiver_id=None, group_id=None,
+                          on_progress=None):
+        return self.upload_pool.submit(self.attach_file, sender_id, source_path, message,
+                                       receiver_id=receiver_id, group_id=group_id, on_progress=on_progress)
+
+    def history(self, conversation_id, after_id=0):
+        return [Message(*row) for row in self.call('history', conversation_id=conversation_id, after_id=after_id)]
+
+    def history_page(self, conversation_id, before_id=None, after_id=None, limit=50):
+        rows = self.call('history_page', conversation_id=conversation_id, before_id=before_id,
+                         after_id=after_id, limit=limit)
+        return [Message(*row) for row in rows]
+
+    def get_message(self, message_id):
+        row = self.call('get_message', message_id=message_id)
+        return Message(*row) if row else None
+
+    def edit_message(self, user_id, message_id, message):
+        self.call('edit', message_id=message_id, message=message)
+
+    def delete_message(self, user_id, message_id):
+        self.call('delete', message_id=message_id)
+
+    def latest_message_id(self):
+        return self.call('latest_message_id')
+
+    def messages_since(self, after_id, limit=500, user_id=None):
+        """Messages after after_id in the logged-in user's conversations"""
+        return [(Message(*row), conversation_id)
+                for row, conversation_id in self.call('messages_since', after_id=after_id, limit=limit)]
+
+    def change_marker(self):
+        return self.call('change_marker')
+
+    def changes_since(self, seq, user_id=None):
+        return [tuple(change) for change in self.call('changes_since', seq=seq)]
+
+    def mark_read(self, user_id, conversation_id, message_id=None):
+        return self.call_async('mark_read', conversation_id=conversation_id, message_id=message_id)
+
+    def unread_counts(self, user_id):
+        return self.call('unread_counts')
+
+    def total_unread(self, user_id):
+        return sum(self.unread_counts(user_id).values())
+
+    def search_messages(self, user_id, text, limit=20, offset=0):
+        results, truncated = self.call('search', text=text, limit=limit, offset=offset)
+        return SearchPage([SearchResult(Message(*message), conversation_id, snippet, score)
+                           for message, conversation_id, snippet, score in results], truncated)
+
+    def subscribe(self, *conversation_ids):
+        """Receive events of conversations beyond the user's own direct messages and groups"""
+        self.call('subscribe', conversation_ids=list(conversation_ids))
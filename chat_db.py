@@ -0,0 +1,809 @@
+import os
+import sqlite3
+import threading
+import urllib.parse
+
+DATABASE_PATH = 'chat_app.db'
+
+# Hot queries, kept here so the application and the query plan check use the same SQL
+
+# A message row as used by the views, with the sender's username joined in so that
+# rendering never looks up users one message at a time
+MESSAGE_COLUMNS = """
+    m.sender_id, m.message, m.file_path, m.file_type, m.timestamp, m.edited, m.deleted, m.id,
+    u.username
+"""
+
+MESSAGE_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.id = ?
+"""
+
+HISTORY_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.conversation_id = ? AND m.deleted = FALSE AND m.id > ?
+    ORDER BY m.id
+"""
+
+# Keyset pagination for the chat view; the two descending queries return newest first
+LATEST_PAGE_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.conversation_id = ? AND m.deleted = FALSE
+    ORDER BY m.id DESC
+    LIMIT ?
+"""
+
+OLDER_PAGE_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.conversation_id = ? AND m.deleted = FALSE AND m.id < ?
+    ORDER BY m.id DESC
+    LIMIT ?
+"""
+
+NEWER_PAGE_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.conversation_id = ? AND m.deleted = FALSE AND m.id > ?
+    ORDER BY m.id
+    LIMIT ?
+"""
+
+# Every message newer than a given id, for keeping cached conversations current
+FEED_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}, m.conversation_id
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.id > ? AND m.deleted = FALSE
+    ORDER BY m.id
+    LIMIT ?
+"""
+
+# The same for one user: only the conversations they take part in. The id range is
+# walked in order and each new row checked, so the cost depends on the new rows only.
+USER_FEED_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}, m.conversation_id
+    FROM messages m LEFT JOIN users u ON u.id = m.sender_id
+    WHERE m.id > ? AND m.deleted = FALSE
+      AND (m.sender_id = ? OR m.receiver_id = ?
+           OR m.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+    ORDER BY m.id
+    LIMIT ?
+"""
+
+USER_CHANGES_QUERY = """
+    SELECT c.seq, c.message_id
+    FROM message_changes c JOIN messages m ON m.id = c.message_id
+    WHERE c.seq > ?
+      AND (m.sender_id = ? OR m.receiver_id = ?
+           OR m.group_id IN (SELECT group_id FROM group_members WHERE user_id = ?))
+    ORDER BY c.seq
+"""
+
+# Full-text search; the query limits both the text and the participants (see
+# PARTICIPANTS_SQL). The newest matches, up to a window, stream off the index in rowid
+# order without touching the rest, so common search terms are as fast as rare ones.
+SEARCH_QUERY = f"""
+    SELECT {MESSAGE_COLUMNS}, m.conversation_id
+    FROM messages_fts
+    JOIN messages m ON m.id = messages_fts.rowid
+    LEFT JOIN users u ON u.id = m.sender_id
+    WHERE messages_fts MATCH ?
+    ORDER BY messages_fts.rowid DESC
+    LIMIT ?
+"""
+
+# The sidebar's group list: the user's memberships come off idx_group_members_user and
+# each group is a primary key lookup, with the member count stored on the row
+GROUP_LIST_QUERY = """
+    SELECT g.id, g.name, g.description, g.member_count
+    FROM group_members gm
+    JOIN groups g ON g.id = gm.group_id
+    WHERE gm.user_id = ? AND LOWER(g.name) LIKE ?
+    ORDER BY g.name
+"""
+
+# Unread messages per conversation of a user: one primary key range over the user's read
+# cursors and a primary key lookup of each conversation's counter (see create_read_cursors)
+UNREAD_COUNTS_QUERY = """
+    SELECT c.conversation_id, s.message_count - c.read_count
+    FROM read_cursors c
+    JOIN conversation_stats s ON s.conversation_id = c.conversation_id
+    WHERE c.user_id = ? AND s.message_count > c.read_count
+"""
+
+# Moves a read cursor forward to a message id (capped at the latest message). Only the
+# live messages after that id are counted, so reading up to the latest counts nothing.
+MARK_READ_QUERY = """
+    UPDATE read_cursors
+    SET last_read_id = target.id,
+        read_count = target.message_count - (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.conversation_id = target.conversation_id AND m.deleted = FALSE AND m.id > target.id)
+    FROM (SELECT conversation_id, message_count, min(?, last_message_id) AS id
+          FROM conversation_stats WHERE conversation_id = ?) AS target
+    WHERE read_cursors.user_id = ? AND read_cursors.conversation_id = target.conversation_id
+      AND read_cursors.last_read_id < target.id
+"""
+
+
+def direct_conversation_id(user_a, user_b):
+    """Conversation key of the direct messages between two users, in either direction"""
+    return f"u:{min(user_a, user_b)}:{max(user_a, user_b)}"
+
+
+def group_conversation_id(group_id):
+    """Conversation key of a group chat"""
+    return f"g:{group_id}"
+
+
+def create_base_schema(cursor):
+    """Migration 1: users, groups, group members and messages"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            email TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS groups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            description TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (created_by) REFERENCES users (id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS group_members (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            group_id INTEGER,
+            user_id INTEGER,
+            joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_admin BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (group_id) REFERENCES groups (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            UNIQUE(group_id, user_id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER,
+            receiver_id INTEGER,
+            group_id INTEGER,
+            message TEXT,
+            file_path TEXT,
+            file_type TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            edited BOOLEAN DEFAULT FALSE,
+            deleted BOOLEAN DEFAULT FALSE,
+            FOREIGN KEY (sender_id) REFERENCES users (id),
+            FOREIGN KEY (receiver_id) REFERENCES users (id),
+            FOREIGN KEY (group_id) REFERENCES groups (id)
+        )
+    ''')
+
+
+def add_group_id_column(cursor):
+    """Migration 2: databases created by main.py have no messages.group_id"""
+    cursor.execute("PRAGMA table_info(messages)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'group_id' not in columns:
+        cursor.execute("ALTER TABLE messages ADD COLUMN group_id INTEGER REFERENCES groups (id)")
+
+
+def create_change_log(cursor):
+    """Migration 3: log of edits and soft deletes for incremental refresh"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id INTEGER NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_log_changes
+        AFTER UPDATE OF message, edited, deleted ON messages
+        BEGIN
+            INSERT INTO message_changes (message_id) VALUES (NEW.id);
+        END
+    ''')
+
+
+def create_message_indexes(cursor):
+    """Migration 4: covering indexes for the direct message, group and unread paths"""
+    # Direct messages, keyed by the (sender, receiver) pair of the conversation
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_conversation
+        ON messages (sender_id, receiver_id, group_id, deleted, id)
+    ''')
+
+    # Group history; partial so direct messages (group_id IS NULL) never pick it
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_group
+        ON messages (group_id, deleted, id)
+        WHERE group_id IS NOT NULL
+    ''')
+
+    # Incoming messages newer than a given id
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_unread
+        ON messages (receiver_id, deleted, id, sender_id)
+    ''')
+
+
+# SQL equivalent of direct_conversation_id()/group_conversation_id() for a messages row
+CONVERSATION_ID_SQL = """
+    CASE WHEN group_id IS NOT NULL THEN 'g:' || group_id
+         ELSE 'u:' || min(sender_id, receiver_id) || ':' || max(sender_id, receiver_id)
+    END
+"""
+
+
+def add_conversation_id(cursor):
+    """Migration 5: canonical conversation key so every history read is one index range"""
+    cursor.execute("ALTER TABLE messages ADD COLUMN conversation_id TEXT")
+    cursor.execute(f"UPDATE messages SET conversation_id = {CONVERSATION_ID_SQL}")
+
+    # Keep rows written by older clients consistent
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fill_conversation_id
+        AFTER INSERT ON messages
+        WHEN NEW.conversation_id IS NULL
+        BEGIN
+            UPDATE messages SET conversation_id = {CONVERSATION_ID_SQL} WHERE id = NEW.id;
+        END
+    ''')
+
+    # One index serves history and unread for direct messages and groups alike
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_history
+        ON messages (conversation_id, deleted, id, sender_id)
+    ''')
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_conversation")
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_group")
+    cursor.execute("DROP INDEX IF EXISTS idx_messages_unread")
+
+
+def create_attachment_files(cursor):
+    """Migration 6: reference counts of the files in the content-addressed attachment store"""
+    # One row per stored name; names with the same digest share their content on disk
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachment_files (
+            file_path TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Messages referencing a stored file hold one reference each until soft-deleted
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_add_attachment_ref
+        AFTER INSERT ON messages
+        WHEN NEW.file_path IS NOT NULL AND NOT NEW.deleted
+        BEGIN
+            UPDATE attachment_files SET refcount = refcount + 1 WHERE file_path = NEW.file_path;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_release_attachment_ref
+        AFTER UPDATE OF deleted ON messages
+        WHEN NEW.file_path IS NOT NULL AND NEW.deleted AND NOT OLD.deleted
+        BEGIN
+            UPDATE attachment_files SET refcount = refcount - 1 WHERE file_path = NEW.file_path;
+        END
+    ''')
+
+
+# Who can see a messages row, as delimited tokens for the search index: "[g<group id>]"
+# for group messages, "[u<sender id>] [u<receiver id>]" for direct messages
+PARTICIPANTS_SQL = """
+    CASE WHEN {row}group_id IS NOT NULL THEN '[g' || {row}group_id || ']'
+         ELSE '[u' || {row}sender_id || '] [u' || {row}receiver_id || ']'
+    END
+"""
+
+
+def create_message_search(cursor):
+    """Migration 7: trigram full-text index of the text of live messages"""
+    # The index reads its content from this view instead of storing the text twice
+    cursor.execute(f'''
+        CREATE VIEW IF NOT EXISTS messages_search_content AS
+        SELECT id, message, {PARTICIPANTS_SQL.format(row='')} AS participants
+        FROM messages
+    ''')
+
+    # The trigram tokenizer makes any substring of three or more characters searchable.
+    # Indexing the participants lets a search be limited to the user's conversations
+    # inside the index, instead of filtering every match afterwards.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(message, participants, content='messages_search_content', content_rowid='id',
+                   tokenize='trigram')
+    ''')
+    cursor.execute(f'''
+        INSERT INTO messages_fts (rowid, message, participants)
+        SELECT id, message, {PARTICIPANTS_SQL.format(row='')} FROM messages
+        WHERE deleted = FALSE AND message IS NOT NULL
+    ''')
+
+    # Only live messages are indexed; an entry is removed with the exact values it was added with
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert
+        AFTER INSERT ON messages
+        WHEN NOT NEW.deleted AND NEW.message IS NOT NULL
+        BEGIN
+            INSERT INTO messages_fts (rowid, message, participants)
+            VALUES (NEW.id, NEW.message, {PARTICIPANTS_SQL.format(row='NEW.')});
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update
+        AFTER UPDATE OF message, deleted ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message, participants)
+            SELECT 'delete', OLD.id, OLD.message, {PARTICIPANTS_SQL.format(row='OLD.')}
+            WHERE NOT OLD.deleted AND OLD.message IS NOT NULL;
+            INSERT INTO messages_fts (rowid, message, participants)
+            SELECT NEW.id, NEW.message, {PARTICIPANTS_SQL.format(row='NEW.')}
+            WHERE NOT NEW.deleted AND NEW.message IS NOT NULL;
+        END
+    ''')
+
+
+def add_group_stats(cursor):
+    """Migration 8: member count and last activity stored on groups, kept up to date by triggers"""
+    cursor.execute("ALTER TABLE groups ADD COLUMN member_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE groups ADD COLUMN last_activity TIMESTAMP")
+    cursor.execute('''
+        UPDATE groups SET
+            member_count = (SELECT COUNT(*) FROM group_members WHERE group_id = groups.id),
+            last_activity = COALESCE(
+                (SELECT timestamp FROM messages
+                 WHERE conversation_id = 'g:' || groups.id
+                 ORDER BY id DESC LIMIT 1),
+                created_at)
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS group_members_count_insert
+        AFTER INSERT ON group_members
+        BEGIN
+            UPDATE groups SET member_count = member_count + 1 WHERE id = NEW.group_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS group_members_count_delete
+        AFTER DELETE ON group_members
+        BEGIN
+            UPDATE groups SET member_count = member_count - 1 WHERE id = OLD.group_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS group_members_count_move
+        AFTER UPDATE OF group_id ON group_members
+        WHEN NEW.group_id IS NOT OLD.group_id
+        BEGIN
+            UPDATE groups SET member_count = member_count - 1 WHERE id = OLD.group_id;
+            UPDATE groups SET member_count = member_count + 1 WHERE id = NEW.group_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_group_activity
+        AFTER INSERT ON messages
+        WHEN NEW.group_id IS NOT NULL
+        BEGIN
+            UPDATE groups SET last_activity = NEW.timestamp WHERE id = NEW.group_id;
+        END
+    ''')
+
+    # The groups of a user; UNIQUE(group_id, user_id) only serves lookups by group
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_group_members_user
+        ON group_members (user_id, group_id)
+    ''')
+
+
+def add_message_client_ids(cursor):
+    """Migration 9: sender-chosen message ids, so a message resent after a lost reply is stored once"""
+    cursor.execute("ALTER TABLE messages ADD COLUMN client_id TEXT")
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_id
+        ON messages (sender_id, client_id) WHERE client_id IS NOT NULL
+    ''')
+
+
+# Counts a live message into its conversation; the sender has read everything up to it and
+# the receiver of a direct message gets a cursor (members of a group have one already)
+COUNT_MESSAGE_SQL = """
+    INSERT INTO conversation_stats (conversation_id, message_count, last_message_id)
+    VALUES (NEW.conversation_id, 1, NEW.id)
+    ON CONFLICT (conversation_id) DO UPDATE SET message_count = message_count + 1, last_message_id = NEW.id;
+    INSERT INTO read_cursors (user_id, conversation_id, last_read_id, read_count)
+    SELECT NEW.sender_id, conversation_id, NEW.id, message_count
+    FROM conversation_stats WHERE conversation_id = NEW.conversation_id
+    ON CONFLICT (user_id, conversation_id) DO UPDATE
+    SET last_read_id = excluded.last_read_id, read_count = excluded.read_count;
+    INSERT OR IGNORE INTO read_cursors (user_id, conversation_id)
+    SELECT NEW.receiver_id, NEW.conversation_id WHERE NEW.group_id IS NULL AND NEW.receiver_id IS NOT NULL;
+"""
+
+# A new member has read the group's history
+GROUP_CURSOR_SQL = """
+    INSERT OR IGNORE INTO read_cursors (user_id, conversation_id, last_read_id, read_count)
+    SELECT NEW.user_id, 'g:' || NEW.group_id, COALESCE(MAX(last_message_id), 0), COALESCE(MAX(message_count), 0)
+    FROM conversation_stats WHERE conversation_id = 'g:' || NEW.group_id;
+"""
+
+
+def count_history_as_read(cursor, first_message_id=0):
+    """Count the live messages from first_message_id on and mark them read by every participant
+
+    Does in bulk what the read cursor triggers do row by row, for messages stored before
+    the triggers existed or while an import had them dropped. Participants who already had
+    unread messages in a conversation keep them, and the new messages are unread too.
+    """
+    # Cursors that had read everything move past the new messages
+    cursor.execute('''
+        UPDATE read_cursors SET last_read_id = n.last_message_id, read_count = read_count + n.message_count
+        FROM (
+            SELECT m.conversation_id, COUNT(*) AS message_count, MAX(m.id) AS last_message_id,
+                   COALESCE(s.message_count, 0) AS earlier_count
+            FROM messages m LEFT JOIN conversation_stats s ON s.conversation_id = m.conversation_id
+            WHERE m.id >= ? AND m.deleted = FALSE AND m.conversation_id IS NOT NULL
+            GROUP BY m.conversation_id
+        ) n
+        WHERE read_cursors.conversation_id = n.conversation_id AND read_cursors.read_count = n.earlier_count
+    ''', (first_message_id,))
+
+    cursor.execute('''
+        INSERT INTO conversation_stats (conversation_id, message_count, last_message_id)
+        SELECT conversation_id, COUNT(*), MAX(id) FROM messages
+        WHERE id >= ? AND deleted = FALSE AND conversation_id IS NOT NULL
+        GROUP BY conversation_id
+        ON CONFLICT (conversation_id) DO UPDATE
+        SET message_count = message_count + excluded.message_count,
+            last_message_id = max(last_message_id, excluded.last_message_id)
+    ''', (first_message_id,))
+
+    # Both sides of every direct conversation, and the members of every group with messages
+    cursor.execute('''
+        INSERT OR IGNORE INTO read_cursors (user_id, conversation_id, last_read_id, read_count)
+        SELECT p.user_id, p.conversation_id, s.last_message_id, s.message_count
+        FROM (
+            SELECT sender_id AS user_id, conversation_id FROM messages
+            WHERE id >= ? AND group_id IS NULL AND sender_id IS NOT NULL AND conversation_id IS NOT NULL
+            UNION
+            SELECT receiver_id, conversation_id FROM messages
+            WHERE id >= ? AND group_id IS NULL AND receiver_id IS NOT NULL AND conversation_id IS NOT NULL
+            UNION
+            SELECT user_id, 'g:' || group_id FROM group_members
+            WHERE group_id IN (SELECT group_id FROM messages WHERE id >= ? AND group_id IS NOT NULL)
+        ) p JOIN conversation_stats s ON s.conversation_id = p.conversation_id
+    ''', (first_message_id, first_message_id, first_message_id))
+
+
+def create_read_cursors(cursor):
+    """Migration 10: read cursors and unread counts, kept up to date by triggers
+
+    conversation_stats holds the number of live messages in each conversation and
+    read_cursors how many of them a participant had read when they last read it, so an
+    unread count is one subtraction. A new message updates one counter and the sender's
+    cursor however large the group is; reading moves one cursor.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_stats (
+            conversation_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_id INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    # read_count: the live messages up to and including last_read_id
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS read_cursors (
+            user_id INTEGER NOT NULL,
+            conversation_id TEXT NOT NULL,
+            last_read_id INTEGER NOT NULL DEFAULT 0,
+            read_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, conversation_id)
+        ) WITHOUT ROWID
+    ''')
+    # The cursors a deleted message had been counted as read by
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_read_cursors_conversation
+        ON read_cursors (conversation_id, last_read_id)
+    ''')
+
+    # Existing history starts out read; every member has a cursor, even in silent groups
+    cursor.execute('''
+        INSERT OR IGNORE INTO read_cursors (user_id, conversation_id)
+        SELECT user_id, 'g:' || group_id FROM group_members
+    ''')
+    count_history_as_read(cursor)
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_count_unread
+        AFTER INSERT ON messages
+        WHEN NOT NEW.deleted AND NEW.conversation_id IS NOT NULL
+        BEGIN
+            {COUNT_MESSAGE_SQL}
+        END
+    ''')
+    # Rows inserted without a conversation id are counted once messages_fill_conversation_id sets it
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_count_unread_filled
+        AFTER UPDATE OF conversation_id ON messages
+        WHEN NOT NEW.deleted AND OLD.conversation_id IS NULL AND NEW.conversation_id IS NOT NULL
+        BEGIN
+            {COUNT_MESSAGE_SQL}
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_uncount_deleted
+        AFTER UPDATE OF deleted ON messages
+        WHEN NEW.deleted AND NOT OLD.deleted AND NEW.conversation_id IS NOT NULL
+        BEGIN
+            UPDATE conversation_stats SET message_count = message_count - 1
+            WHERE conversation_id = NEW.conversation_id;
+            UPDATE read_cursors SET read_count = read_count - 1
+            WHERE conversation_id = NEW.conversation_id AND last_read_id >= NEW.id;
+        END
+    ''')
+
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS group_members_cursor_insert
+        AFTER INSERT ON group_members
+        BEGIN
+            {GROUP_CURSOR_SQL}
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS group_members_cursor_delete
+        AFTER DELETE ON group_members
+        BEGIN
+            DELETE FROM read_cursors WHERE user_id = OLD.user_id AND conversation_id = 'g:' || OLD.group_id;
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS group_members_cursor_move
+        AFTER UPDATE OF group_id ON group_members
+        WHEN NEW.group_id IS NOT OLD.group_id
+        BEGIN
+            DELETE FROM read_cursors WHERE user_id = OLD.user_id AND conversation_id = 'g:' || OLD.group_id;
+            {GROUP_CURSOR_SQL}
+        END
+    ''')
+
+
+def create_presence(cursor):
+    """Migration 11: latest heartbeat of each user, for presence without a chat server
+
+    One small row per user, rewritten in place and without secondary indexes, so a
+    heartbeat costs a single page write. Reading it scans one row per user.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS presence (
+            user_id INTEGER PRIMARY KEY,
+            last_seen REAL NOT NULL
+        )
+    ''')
+
+
+# Schema version N is reached by applying MIGRATIONS[N - 1]; only ever append
+MIGRATIONS = [
+    create_base_schema,
+    add_group_id_column,
+    create_change_log,
+    create_message_indexes,
+    add_conversation_id,
+    create_attachment_files,
+    create_message_search,
+    add_group_stats,
+    add_message_client_ids,
+    create_read_cursors,
+    create_presence,
+]
+
+
+def get_schema_version(conn):
+    """Return the schema version stored in the database file"""
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+# The schema and queries use FTS5 trigram (3.34), UPDATE ... FROM (3.33) and RETURNING (3.35)
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+
+def migrate(conn):
+    """Upgrade the database in place to the latest schema version"""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        required = '.'.join(map(str, MIN_SQLITE_VERSION))
+        raise RuntimeError(f"Python is using SQLite {sqlite3.sqlite_version}; this application needs {required} or later")
+    version = get_schema_version(conn)
+
+    if version > len(MIGRATIONS):
+        raise RuntimeError(f"Database schema version {version} is newer than this application supports")
+
+    cursor = conn.cursor()
+    for target_version in range(version + 1, len(MIGRATIONS) + 1):
+        # Each step is applied atomically together with its version bump
+        cursor.execute("BEGIN")
+        try:
+            MIGRATIONS[target_version - 1](cursor)
+            cursor.execute(f"PRAGMA user_version = {target_version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return get_schema_version(conn)
+
+
+def prune_change_log(conn, keep='-1 day'):
+    """Drop change log entries only useful to clients that ran at the time"""
+    conn.execute("DELETE FROM message_changes WHERE changed_at < datetime('now', ?)", (keep,))
+    conn.commit()
+
+
+class ConnectionManager:
+    """Hands out one tuned SQLite connection per thread, with separate read-only ones
+
+    The database runs in WAL mode, so readers see a consistent snapshot and never
+    block the single writer; concurrent writers wait up to busy_timeout instead of
+    failing with "database is locked".
+    """
+
+    def __init__(self, path=DATABASE_PATH, busy_timeout=5000, cache_size=-16384,
+                 mmap_size=256 * 1024 * 1024):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size  # Negative values are KiB
+        self.mmap_size = mmap_size
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _open(self, read_only):
+        if read_only:
+            uri = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, timeout=self.busy_timeout / 1000,
+                                   check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000,
+                                   check_same_thread=False)
+            # Persistent in the database file; a no-op once set
+            conn.execute("PRAGMA journal_mode = WAL")
+
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def writer(self):
+        """Read-write connection owned by the calling thread"""
+        conn = getattr(self._local, 'writer', None)
+        if conn is None:
+            conn = self._local.writer = self._open(read_only=False)
+        return conn
+
+    def reader(self):
+        """Read-only connection owned by the calling thread, for history and search"""
+        conn = getattr(self._local, 'reader', None)
+        if conn is None:
+            conn = self._local.reader = self._open(read_only=True)
+        return conn
+
+    def close(self):
+        """Close the connections of every thread"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+class UserDirectory:
+    """Cache of usernames by user id, loaded in bulk
+
+    Call invalidate() after registering or renaming a user. Users registered by
+    another client are picked up too: lookups of unknown ids reload the whole
+    directory once, and users() reloads when the newest user id has changed.
+    """
+
+    def __init__(self, conn_factory):
+        self.conn_factory = conn_factory
+        self.usernames = None
+        self.missing = set()
+
+    def load(self):
+        cursor = self.conn_factory().cursor()
+        cursor.execute("SELECT id, username FROM users ORDER BY id")
+        self.usernames = dict(cursor.fetchall())
+        self.missing.clear()
+
+    def has_new_users(self):
+        """Whether users were registered since the directory was loaded, by any client"""
+        cursor = self.conn_factory().cursor()
+        # The last row of the rowid b-tree; no scan
+        newest = cursor.execute("SELECT MAX(id) FROM users").fetchone()[0]
+        return newest is not None and newest not in self.usernames
+
+    def invalidate(self):
+        self.usernames = None
+
+    def get(self, user_id, default="Unknown"):
+        if self.usernames is None or (user_id not in self.usernames and user_id not in self.missing):
+            self.load()
+            if user_id not in self.usernames:
+                # Don't reload again for ids that simply don't exist
+                self.missing.add(user_id)
+        return self.usernames.get(user_id, default)
+
+    def users(self):
+        """All (id, username) pairs in registration order"""
+        if self.usernames is None or self.has_new_users():
+            self.load()
+        return list(self.usernames.items())
+
+
+def check_query_plans(conn):
+    """Assert that every hot query is served by its index instead of a table scan"""
+    hot_queries = {
+        'message': (MESSAGE_QUERY, (1,), 'INTEGER PRIMARY KEY'),
+        'dm history': (HISTORY_QUERY, (direct_conversation_id(1, 2), 0), 'idx_messages_history'),
+        'group history': (HISTORY_QUERY, (group_conversation_id(1), 0), 'idx_messages_history'),
+        'latest page': (LATEST_PAGE_QUERY, (group_conversation_id(1), 50), 'idx_messages_history'),
+        'older page': (OLDER_PAGE_QUERY, (group_conversation_id(1), 100, 50), 'idx_messages_history'),
+        'newer page': (NEWER_PAGE_QUERY, (group_conversation_id(1), 100, 50), 'idx_messages_history'),
+        'unread counts': (UNREAD_COUNTS_QUERY, (1,), 'PRIMARY KEY'),
+        'mark read': (MARK_READ_QUERY, (100, group_conversation_id(1), 1), 'idx_messages_history'),
+        'feed': (FEED_QUERY, (100, 500), 'INTEGER PRIMARY KEY'),
+        'user feed': (USER_FEED_QUERY, (100, 1, 1, 1, 500), 'idx_group_members_user'),
+        'group list': (GROUP_LIST_QUERY, (1, '%%'), 'idx_group_members_user'),
+    }
+    # Lists of a single user's groups are short; sorting them by name is fine
+    sorted_after = {'group list'}
+
+    problems = []
+    for name, (query, params, index) in hot_queries.items():
+        plan = conn.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+        details = [row[-1] for row in plan]
+        # Pages must come straight off the index, not be sorted afterwards
+        if name not in sorted_after and any(detail.startswith('USE TEMP B-TREE FOR ORDER BY')
+                                            for detail in details):
+            problems.append(f"{name}: sorts with a temporary b-tree")
+        # Every table access must be an index search, and messages must use the expected index
+        for detail in details:
+            if detail.startswith('SCAN '):
+                problems.append(f"{name}: {detail}")
+        if not any(index in detail for detail in details):
+            problems.append(f"{name}: {index} not used")
+
+    assert not problems, "Unexpected query plans:\n" + "\n".join(problems)
+
+
+if __name__ == "__main__":
+    # Build the schema from scratch and verify the hot query plans
+    conn = sqlite3.connect(':memory:')
+    print(f"Migrated to schema version {migrate(conn)}")
+    check_query_plans(conn)
+    print("Query plans OK")
@@ -0,0 +1,105 @@
+import threading
+
+# Counter that moves with every change, for waiters interested in all conversations
+ANY_CONVERSATION = '*'
+
+
+class ChangeNotifier:
+    """Wakes up waiters when a conversation changes
+
+    Writes made in this process call notify() and wake waiters immediately. Writes
+    made by other processes sharing the database are detected by a watcher thread
+    that polls PRAGMA data_version, which only changes when another connection
+    commits. The poll interval backs off while nothing happens and snaps back to
+    the minimum on activity, so idle clients cost next to nothing.
+    """
+
+    def __init__(self, db, min_interval=0.025, max_interval=0.5, backoff=1.5):
+        self.db = db
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+
+        self.condition = threading.Condition()
+        self.versions = {}  # conversation id -> change counter
+        self.interval = min_interval
+        self.commits = 0  # commits by other connections seen so far, in any table
+
+        self.running = False
+        self.stop_event = threading.Event()
+        self.watch_thread = None
+
+    def version(self, conversation_id):
+        """Current change counter of a conversation"""
+        with self.condition:
+            return self.versions.get(conversation_id, 0)
+
+    def notify(self, *conversation_ids):
+        """Record that conversations changed and wake everyone waiting on them"""
+        with self.condition:
+            for conversation_id in conversation_ids + (ANY_CONVERSATION,):
+                self.versions[conversation_id] = self.versions.get(conversation_id, 0) + 1
+            self.condition.notify_all()
+        # Activity here makes changes elsewhere likely too
+        self.interval = self.min_interval
+
+    def wait(self, conversation_id, seen_version, timeout=None):
+        """Block until the conversation's counter moves past seen_version; return the counter"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.versions.get(conversation_id, 0) != seen_version,
+                                    timeout)
+            return self.versions.get(conversation_id, 0)
+
+    def start(self):
+        """Start watching the database for commits from other processes"""
+        if self.watch_thread is None or not self.watch_thread.is_alive():
+            self.stop_event.clear()
+            self.watch_thread = threading.Thread(target=self.watch_loop, daemon=True)
+            self.watch_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def watch_loop(self):
+        conn = self.db.reader()
+        cursor = conn.cursor()
+
+        # Only changes after startup are interesting
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        last_message_id = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM message_changes")
+        last_change_seq = cursor.fetchone()[0]
+        data_version = cursor.execute("PRAGMA data_version").fetchone()[0]
+
+        while not self.stop_event.wait(self.interval):
+            current_version = cursor.execute("PRAGMA data_version").fetchone()[0]
+            if current_version == data_version:
+                self.interval = min(self.interval * self.backoff, self.max_interval)
+                continue
+            data_version = current_version
+            self.interval = self.min_interval
+            self.commits += 1
+
+            # New messages and edits/deletes since the last look, by conversation
+            cursor.execute("""
+                SELECT conversation_id, MAX(id) FROM messages
+                WHERE id > ?
+                GROUP BY conversation_id
+            """, (last_message_id,))
+            new_messages = cursor.fetchall()
+            cursor.execute("""
+                SELECT MAX(c.seq), m.conversation_id
+                FROM message_changes c JOIN messages m ON m.id = c.message_id
+                WHERE c.seq > ?
+                GROUP BY m.conversation_id
+            """, (last_change_seq,))
+            changes = cursor.fetchall()
+
+            changed = {conversation_id for conversation_id, max_id in new_messages}
+            changed.update(conversation_id for seq, conversation_id in changes)
+            if new_messages:
+                last_message_id = max(max_id for conversation_id, max_id in new_messages)
+            if changes:
+                last_change_seq = max(seq for seq, conversation_id in changes)
+            if changed:
+                self.notify(*changed)
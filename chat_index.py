@@ -0,0 +1,59 @@
+import collections
+
+
+def name_grams(folded_name):
+    """Every substring of one to three characters"""
+    return {folded_name[start:start + length]
+            for length in (1, 2, 3)
+            for start in range(len(folded_name) - length + 1)}
+
+
+class SubstringIndex:
+    """In-memory case-insensitive substring search over short names (users, groups)
+
+    Every name is indexed by all its substrings of up to three characters, so queries of
+    one to three characters are a single set lookup, and longer queries only check the
+    names containing all of their three-character pieces.
+    """
+
+    def __init__(self):
+        self.names = {}  # key -> casefolded name
+        self.grams = collections.defaultdict(set)  # substring -> keys
+
+    def add(self, key, name):
+        self.remove(key)
+        folded_name = name.casefold()
+        self.names[key] = folded_name
+        for gram in name_grams(folded_name):
+            self.grams[gram].add(key)
+
+    def remove(self, key):
+        folded_name = self.names.pop(key, None)
+        if folded_name is None:
+            return
+        for gram in name_grams(folded_name):
+            keys = self.grams[gram]
+            keys.discard(key)
+            if not keys:
+                del self.grams[gram]
+
+    def update(self, names):
+        """Bring the index in line with a complete {key: name} mapping, touching only changes"""
+        for key in [key for key in self.names if key not in names]:
+            self.remove(key)
+        for key, name in names.items():
+            if self.names.get(key) != name.casefold():
+                self.add(key, name)
+
+    def search(self, text):
+        """Set of the keys whose name contains text"""
+        text = text.casefold()
+        if not text:
+            return set(self.names)
+        if len(text) <= 3:
+            return set(self.grams.get(text, ()))
+
+        # Start from the rarest piece; every match must contain all of them
+        pieces = sorted((self.grams.get(text[start:start + 3], set()) for start in range(len(text) - 2)), key=len)
+        candidates = pieces[0].intersection(*pieces[1:])
+        return {key for key in candidates if text in self.names[key]}
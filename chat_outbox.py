@@ -0,0 +1,180 @@
+import collections
+import concurrent.futures
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import chat_db
+from chat_service import ChatError
+
+OUTBOX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox.db')
+
+# Messages handed to the service at once; a local service commits them together
+DRAIN_BATCH = 32
+
+# Seconds to wait for the service to confirm a message before sending it again
+SEND_TIMEOUT = 30.0
+
+# A message not yet confirmed by the service
+OutboxEntry = collections.namedtuple('OutboxEntry', ['client_id', 'sender_id', 'receiver_id', 'group_id',
+                                                     'conversation_id', 'message', 'created_at'])
+
+
+class Outbox:
+    """Messages saved on this machine until the chat service has stored them
+
+    add() writes a message to a local SQLite file and returns at once; a background
+    thread sends the saved messages of one user in order. Each message carries a
+    client id generated here, which the service uses to store it only once, so a
+    message is simply sent again whenever the outcome of an attempt is unknown:
+    after a lost connection, an unanswered request (send_timeout), a locked database
+    or an application crash (messages still saved are sent after the next login).
+
+    The callbacks run on the outbox thread:
+        on_sent(entry, message_id)    the service stored the message
+        on_failed(entry, error)       the service refused it (a ChatError); it is discarded
+        on_retry(entry, error, delay) an attempt failed and is repeated after delay seconds
+    """
+
+    def __init__(self, service, user_id, path=OUTBOX_PATH, on_sent=None, on_failed=None, on_retry=None,
+                 retry_delay=0.25, max_retry_delay=10.0, send_timeout=SEND_TIMEOUT):
+        self.service = service
+        self.user_id = user_id
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.on_retry = on_retry
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.send_timeout = send_timeout
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                client_id TEXT NOT NULL UNIQUE,
+                sender_id INTEGER NOT NULL,
+                receiver_id INTEGER,
+                group_id INTEGER,
+                conversation_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        ''')
+        self.conn.commit()
+        self.lock = threading.Lock()
+
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='outbox', daemon=True)
+        self.thread.start()
+
+    def add(self, message, receiver_id=None, group_id=None):
+        """Save a message for sending; return its OutboxEntry once it is on disk"""
+        if group_id is not None:
+            conversation_id = chat_db.group_conversation_id(group_id)
+        else:
+            conversation_id = chat_db.direct_conversation_id(self.user_id, receiver_id)
+        entry = OutboxEntry(uuid.uuid4().hex, self.user_id, receiver_id, group_id, conversation_id, message,
+                            time.time())
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO outbox (client_id, sender_id, receiver_id, group_id, conversation_id, message, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', entry)
+            self.conn.commit()
+        self.wakeup.set()
+        return entry
+
+    def pending(self, limit=None):
+        """The user's unsent messages, oldest first"""
+        with self.lock:
+            cursor = self.conn.execute('''
+                SELECT client_id, sender_id, receiver_id, group_id, conversation_id, message, created_at
+                FROM outbox WHERE sender_id = ? ORDER BY seq LIMIT ?
+            ''', (self.user_id, -1 if limit is None else limit))
+            return [OutboxEntry(*row) for row in cursor.fetchall()]
+
+    def discard(self, entry):
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE client_id = ?", (entry.client_id,))
+            self.conn.commit()
+
+    def close(self, wait=True):
+        """Stop sending; unsent messages stay saved for the next session
+
+        Without wait, the thread finishes its current attempt on its own. Use that on
+        the thread the callbacks hand their work to, which must not block on them.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        if wait:
+            self.thread.join()
+
+    def run(self):
+        delay = self.retry_delay
+        try:
+            while not self.stopping:
+                self.wakeup.clear()
+                entries = self.pending(DRAIN_BATCH)
+                if not entries:
+                    self.wakeup.wait()
+                    continue
+
+                error, entry = self.send(entries)
+                if error is None:
+                    delay = self.retry_delay
+                    continue
+                if self.on_retry is not None:
+                    self.on_retry(entry, error, delay)
+                # Woken early by close() only; new messages wait behind the failed one
+                self.stop_wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        finally:
+            with self.lock:
+                self.conn.close()
+
+    def stop_wait(self, delay):
+        deadline = time.monotonic() + delay
+        while not self.stopping and time.monotonic() < deadline:
+            self.wakeup.wait(deadline - time.monotonic())
+            self.wakeup.clear()
+
+    def send(self, entries):
+        """Send entries in order; return (error, entry) of the first to fail for a retry, else (None, None)"""
+        futures = []
+        for entry in entries:
+            try:
+                future = self.service.queue_message(self.user_id, entry.message, receiver_id=entry.receiver_id,
+                                                    group_id=entry.group_id, client_id=entry.client_id)
+            except ChatError as error:
+                self.discard(entry)
+                if self.on_failed is not None:
+                    self.on_failed(entry, error)
+                continue
+            except Exception as error:
+                return error, entry
+            futures.append((entry, future))
+
+        for entry, future in futures:
+            try:
+                message_id = future.result(self.send_timeout)
+            except concurrent.futures.TimeoutError as error:
+                # The message may still be stored; its client id makes the resend harmless
+                future.cancel()
+                return error, entry
+            except ChatError as error:
+                self.discard(entry)
+                if self.on_failed is not None:
+                    self.on_failed(entry, error)
+                continue
+            except Exception as error:
+                # Later messages may have been stored too; resending them is harmless
+                return error, entry
+            self.discard(entry)
+            if self.on_sent is not None:
+                self.on_sent(entry, message_id)
+        return None, None
@@ -0,0 +1,75 @@
+import base64
+import hashlib
+import hmac
+import os
+
+# Default scrypt cost: 2**14 blocks of 128 * r bytes, i.e. 16 MiB and roughly 50 ms per
+# hash on a current desktop. benchmarks/bench_passwords.py calibrates it for a host.
+SCRYPT_COST = {'n': 2 ** 14, 'r': 8, 'p': 1}
+
+# Used where hashlib lacks scrypt (OpenSSL builds without it)
+PBKDF2_ITERATIONS = 600000
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+HAS_SCRYPT = hasattr(hashlib, 'scrypt')
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+def scrypt(password, salt, n, r, p):
+    # The default memory limit of 32 MiB is too small for larger cost factors
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES,
+                          maxmem=128 * r * (n + p + 2) + 1024 * 1024)
+
+
+def hash_password(password, cost=None):
+    """Salted, memory-hard hash of a password, with its parameters encoded in the result
+
+    The format is "scrypt$n=<n>,r=<r>,p=<p>$<salt>$<key>" (base64), or
+    "pbkdf2_sha256$<iterations>$<salt>$<key>" where scrypt is unavailable. As every hash
+    carries its own salt and cost, costs can be raised without invalidating old hashes.
+    """
+    salt = os.urandom(SALT_BYTES)
+    if HAS_SCRYPT:
+        cost = cost or SCRYPT_COST
+        key = scrypt(password, salt, cost['n'], cost['r'], cost['p'])
+        return f"scrypt$n={cost['n']},r={cost['r']},p={cost['p']}${b64encode(salt)}${b64encode(key)}"
+    iterations = (cost or {}).get('iterations', PBKDF2_ITERATIONS)
+    key = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations, KEY_BYTES)
+    return f"pbkdf2_sha256${iterations}${b64encode(salt)}${b64encode(key)}"
+
+
+def verify_password(password, stored):
+    """Whether password matches a stored hash of any supported format"""
+    try:
+        if stored.startswith('scrypt$'):
+            _, params, salt, key = stored.split('$')
+            cost = dict(item.split('=') for item in params.split(','))
+            computed = scrypt(password, b64decode(salt), int(cost['n']), int(cost['r']), int(cost['p']))
+        elif stored.startswith('pbkdf2_sha256$'):
+            _, iterations, salt, key = stored.split('$')
+            computed = hashlib.pbkdf2_hmac('sha256', password.encode(), b64decode(salt), int(iterations),
+                                           KEY_BYTES)
+        else:
+            # Unsalted SHA-256 hex digest of accounts created by older versions
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+    except (ValueError, KeyError):
+        return False
+    return hmac.compare_digest(b64encode(computed), key)
+
+
+def needs_rehash(stored, cost=None):
+    """Whether a stored hash was made with another algorithm or cost than hash_password(cost=cost) uses"""
+    if HAS_SCRYPT:
+        cost = cost or SCRYPT_COST
+        return not stored.startswith(f"scrypt$n={cost['n']},r={cost['r']},p={cost['p']}$")
+    iterations = (cost or {}).get('iterations', PBKDF2_ITERATIONS)
+    return not stored.startswith(f"pbkdf2_sha256${iterations}$")
@@ -0,0 +1,64 @@
+"""Who is online, from heartbeats that expire after a time to live
+
+Clients heartbeat every HEARTBEAT_INTERVAL seconds and count as online until
+PRESENCE_TTL seconds after the latest one, so a client that crashes or loses its
+network goes offline on its own, while one missed heartbeat goes unnoticed.
+"""
+import collections
+import math
+import time
+
+# Seconds a heartbeat keeps its user online
+PRESENCE_TTL = 60.0
+
+# Seconds between the heartbeats of a client; a TTL spans three of them
+HEARTBEAT_INTERVAL = PRESENCE_TTL / 3
+
+
+class PresenceTracker:
+    """Users online until PRESENCE_TTL after their latest heartbeat, held in memory
+
+    A heartbeat moves its user to the end of an ordered dict. Every deadline is the
+    heartbeat time plus the same TTL, so the dict is in deadline order and expire()
+    only ever looks at the users that have expired, however many are online.
+    Not thread-safe; chat_server uses it from its event loop only.
+    """
+
+    def __init__(self, ttl=PRESENCE_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.deadlines = collections.OrderedDict()  # user id -> time they go offline
+
+    def heartbeat(self, user_id):
+        """Keep a user online for another TTL; return True if they were offline
+
+        A user whose TTL ran out counts as offline even before expire() removes them.
+        """
+        was_online = self.is_online(user_id)
+        self.deadlines[user_id] = self.clock() + self.ttl
+        self.deadlines.move_to_end(user_id)
+        return not was_online
+
+    def leave(self, user_id):
+        """Take a user offline now; return True unless expire() already took them offline"""
+        return self.deadlines.pop(user_id, None) is not None
+
+    def expire(self):
+        """Take the users whose TTL ran out offline; return their ids"""
+        now = self.clock()
+        expired = []
+        while self.deadlines:
+            user_id, deadline = next(iter(self.deadlines.items()))
+            if deadline > now:
+                break
+            del self.deadlines[user_id]
+            expired.append(user_id)
+        return expired
+
+    def is_online(self, user_id):
+        return self.deadlines.get(user_id, -math.inf) > self.clock()
+
+    def online(self):
+        """Ids of the users online"""
+        now = self.clock()
+        return [user_id for user_id, deadline in self.deadlines.items() if deadline > now]
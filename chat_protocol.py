@@ -0,0 +1,94 @@
+"""Wire protocol between chat_server and chat_client
+
+Every frame is a 5-byte header, the body length as a 4-byte big-endian integer and a
+codec byte (b'J' for JSON, b'M' for MessagePack), followed by the body: one object.
+
+    request   {"id": 7, "op": "send", "args": {"message": "hi", "receiver_id": 2}}
+    response  {"id": 7, "ok": true, "result": 42}
+              {"id": 7, "ok": false, "error": "...", "user_error": true}
+    event     {"event": "message", "conversation_id": "u:1:2", "message": [...]}
+              {"event": "changed", "conversation_id": "g:3", "message": [...]}
+              {"event": "presence", "online": [4], "offline": [2, 9]}
+
+Responses carry the id of their request; events, pushed for subscribed conversations
+when a message is sent ("message") or edited or deleted ("changed"), carry none.
+Connections following presence get a "presence" event with "snapshot": true and
+everyone online, then one per batch of users coming online or going offline.
+
+The server answers in the codec of each request. Messages travel as lists in the
+field order of chat_service.Message.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:  # Optional; JSON is always available
+    msgpack = None
+
+HEADER = struct.Struct('>IB')
+MAX_FRAME_SIZE = 4 * 1024 * 1024
+
+JSON = ord('J')
+MSGPACK = ord('M')
+CODECS = {'json': JSON, 'msgpack': MSGPACK}
+
+
+class ProtocolError(Exception):
+    """The other side sent something that is not a valid frame"""
+
+
+def encode_frame(obj, codec=JSON):
+    if codec == MSGPACK:
+        body = msgpack.packb(obj)
+    else:
+        body = json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode()
+    return HEADER.pack(len(body), codec) + body
+
+
+async def read_raw_frame(reader):
+    """The next frame as bytes, header included, or None at end of stream
+
+    Raises ProtocolError if the stream ends inside a frame.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except EOFError:
+        return None
+    length, codec = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the limit of {MAX_FRAME_SIZE}")
+    try:
+        return header + await reader.readexactly(length)
+    except EOFError:
+        raise ProtocolError(f"Stream ended inside a frame of {length} bytes") from None
+
+
+def decode_frame(frame):
+    """(object, codec) of a frame read by read_raw_frame()"""
+    codec = frame[HEADER.size - 1]
+    body = frame[HEADER.size:]
+    try:
+        if codec == JSON:
+            return json.loads(body), codec
+        if codec == MSGPACK and msgpack is not None:
+            return msgpack.unpackb(body, raw=False), codec
+    except ValueError as error:  # Includes JSONDecodeError and msgpack's format errors
+        raise ProtocolError(f"Invalid frame body: {error}") from None
+    raise ProtocolError(f"Unsupported codec {codec!r}")
+
+
+async def read_frame(reader):
+    """(object, codec) of the next frame, or (None, None) at end of stream"""
+    frame = await read_raw_frame(reader)
+    if frame is None:
+        return None, None
+    return decode_frame(frame)
+
+
+def parse_address(address):
+    """('tcp', host, port) for "host:port", ('unix', path) for anything else"""
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return 'tcp', host or '127.0.0.1', int(port)
+    return 'unix', address
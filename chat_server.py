@@ -0,0 +1,569 @@
+"""Chat server: one process owning the database, serving clients over a socket
+
+    python chat_server.py --listen 127.0.0.1:8765
+    python chat_server.py --listen /tmp/chat.sock
+
+Clients (chat_client.ChatClient) log in over the connection and then act as that
+user; the server checks that they only read and write conversations they take part
+in. Connections subscribed to a conversation are sent an event whenever a message is
+sent, edited or deleted in it. See chat_protocol for the wire format.
+
+Events are never allowed to hold up the sender: a connection whose client reads too
+slowly stops receiving them and is sent a "resync" event once it has caught up (its
+client then fetches what it missed), or is disconnected if it does not catch up.
+
+    python chat_server.py --listen 127.0.0.1:8765 --workers 4
+
+runs four worker processes on one port, relaying events through chat_broker.
+
+Presence is held in memory: any request keeps its user online for PRESENCE_TTL
+seconds (clients with nothing else to ask send "heartbeat"), and connections that
+asked for "presence" are sent only the changes, batched per sweep. Nothing about
+presence is written to the database.
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import uuid
+
+import chat_db
+import chat_protocol
+from chat_broker import Broker, BrokerLink
+from chat_presence import HEARTBEAT_INTERVAL, PresenceTracker
+from chat_service import ATTACHMENTS_DIR, MAX_ATTACHMENT_SIZE, ChatError, ChatService
+
+# Blocking database calls run here, so the event loop only ever waits on sockets
+DATABASE_WORKERS = 4
+
+# Event bytes queued for one connection before it stops receiving events
+SEND_BUFFER_LIMIT = 256 * 1024
+
+# Seconds a connection may take to work through its queued events before it is dropped
+CATCH_UP_TIMEOUT = 10
+
+# Seconds between looks for expired heartbeats
+PRESENCE_SWEEP_INTERVAL = 1.0
+
+# Subscription key of the connections that follow presence changes
+PRESENCE_CHANNEL = 'presence'
+
+
+def user_channel(user_id):
+    """Subscription key of everything addressed to one user"""
+    return f"user:{user_id}"
+
+
+class Session:
+    """One client connection and the user logged in on it"""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.user_id = None
+        self.codec = chat_protocol.JSON  # Of the latest request; events are sent in it
+        self.channels = set()
+        self.uploads = {}  # upload id -> open temporary file
+        self.lagging = False
+        # drain() then waits until a lagging client has read most of its queued events
+        writer.transport.set_write_buffer_limits(high=SEND_BUFFER_LIMIT)
+
+    async def run(self):
+        try:
+            while True:
+                request, codec = await chat_protocol.read_frame(self.reader)
+                if request is None:
+                    break
+                await self.handle(request, codec)
+        except (ConnectionError, chat_protocol.ProtocolError):
+            pass
+        finally:
+            self.server.unsubscribe_all(self)
+            for upload in self.uploads.values():
+                upload.close()
+                shutil.rmtree(os.path.dirname(upload.name), ignore_errors=True)
+            self.writer.close()
+
+    async def handle(self, request, codec):
+        """Run one request and send its response; requests of a session run in order"""
+        self.codec = codec
+        request_id = request.get('id')
+        handler = self.server.handlers.get(request.get('op'))
+        try:
+            if handler is None:
+                raise ChatError(f"Unknown operation: {request.get('op')!r}")
+            if self.user_id is None and request['op'] not in ('login', 'register'):
+                raise ChatError("Please log in first!")
+            result = await handler(self, **request.get('args', {}))
+            response = {'id': request_id, 'ok': True, 'result': result}
+        except ChatError as error:
+            response = {'id': request_id, 'ok': False, 'error': str(error), 'user_error': True}
+        except Exception as error:
+            response = {'id': request_id, 'ok': False, 'error': f"{type(error).__name__}: {error}"}
+        if self.user_id is not None:
+            self.server.seen(self.user_id)
+        self.send(response, codec)
+
+    def send(self, obj, codec=chat_protocol.JSON):
+        if not self.writer.is_closing():
+            self.writer.write(chat_protocol.encode_frame(obj, codec))
+
+    def push(self, frame):
+        """Queue an encoded event, unless the client is too far behind to take more"""
+        if self.lagging or self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > SEND_BUFFER_LIMIT:
+            self.lagging = True
+            asyncio.get_running_loop().create_task(self.catch_up())
+            return
+        self.writer.write(frame)
+
+    async def catch_up(self):
+        """Wait for the client to read its queued events, then tell it to resync"""
+        try:
+            await asyncio.wait_for(self.writer.drain(), CATCH_UP_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.writer.transport.abort()
+            return
+        except ConnectionError:
+            return
+        self.lagging = False
+        self.send({'event': 'resync'}, self.codec)
+
+
+class ChatServer:
+    """Serves a ChatService to socket clients with asyncio"""
+
+    def __init__(self, service, broker=None):
+        self.service = service
+        # Relays events to and from other workers on the same database
+        self.broker = BrokerLink(broker, self.on_broker_command, self.on_broker_reconnect) if broker else None
+        self.sessions = set()
+        # Users with a session here, and those with one on each other worker, by worker id
+        self.presence = PresenceTracker()
+        self.remote_presence = collections.defaultdict(PresenceTracker)
+        self.worker_id = uuid.uuid4().hex
+        self.database_pool = concurrent.futures.ThreadPoolExecutor(max_workers=DATABASE_WORKERS,
+                                                                   thread_name_prefix='database')
+        self.subscribers = collections.defaultdict(set)  # channel -> sessions
+        self.upload_dir = os.path.join(service.attachments_dir, '.uploads')
+        self.handlers = {name[3:]: getattr(self, name) for name in dir(self) if name.startswith('op_')}
+
+    async def serve(self, address, backlog=4096, reuse_port=False):
+        """Listen on "host:port" or a Unix socket path until cancelled
+
+        With reuse_port, several workers listen on the same TCP port and the kernel
+        spreads the connections over them.
+        """
+        if self.broker is not None:
+            asyncio.get_running_loop().create_task(self.broker.run())
+        asyncio.get_running_loop().create_task(self.presence_loop())
+        kind, *where = chat_protocol.parse_address(address)
+        if kind == 'tcp':
+            server = await asyncio.start_server(self.accept, *where, backlog=backlog, reuse_port=reuse_port)
+        else:
+            if os.path.exists(where[0]):
+                os.remove(where[0])
+            server = await asyncio.start_unix_server(self.accept, where[0], backlog=backlog)
+        async with server:
+            await server.serve_forever()
+
+    async def accept(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        try:
+            await session.run()
+        finally:
+            self.sessions.discard(session)
+            if session.user_id is not None:
+                self.left(session.user_id)
+
+    async def call(self, function, *args, **kwargs):
+        """Run a blocking service call on the database pool"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.database_pool, functools.partial(function, *args, **kwargs))
+
+    async def check_access(self, session, conversation_id):
+        if not await self.call(self.service.can_access, session.user_id, conversation_id):
+            raise ChatError("You are not part of this conversation!")
+
+    @staticmethod
+    def conversation_id(session, receiver_id, group_id):
+        """Conversation a message sent by the session's user goes to"""
+        if group_id is not None:
+            return chat_db.group_conversation_id(group_id)
+        return chat_db.direct_conversation_id(session.user_id, receiver_id)
+
+    # Subscriptions
+
+    def subscribe(self, session, channel):
+        self.subscribers[channel].add(session)
+        session.channels.add(channel)
+
+    def unsubscribe(self, session, channel):
+        sessions = self.subscribers.get(channel)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del self.subscribers[channel]
+        session.channels.discard(channel)
+
+    def unsubscribe_all(self, session):
+        for channel in list(session.channels):
+            self.unsubscribe(session, channel)
+
+    def publish(self, conversation_id, event):
+        """Send an event to the conversation's sessions here and on the other workers"""
+        self.deliver(conversation_id, event)
+        if self.broker is not None:
+            self.broker.send({'op': 'publish', 'conversation_id': conversation_id, 'event': event})
+
+    def deliver(self, conversation_id, event):
+        """Send an event to every session subscribed to the conversation or its users
+
+        The event is encoded once per codec and the same bytes are queued for every
+        session, without waiting for any of them.
+        """
+        channels = [conversation_id]
+        if conversation_id.startswith('u:'):
+            channels += [user_channel(user_id) for user_id in conversation_id[2:].split(':')]
+        sessions = set()
+        for channel in channels:
+            sessions.update(self.subscribers.get(channel, ()))
+        self.push_event(sessions, dict(event, conversation_id=conversation_id))
+
+    def push_event(self, sessions, event):
+        frames = {}
+        for session in sessions:
+            frame = frames.get(session.codec)
+            if frame is None:
+                frame = frames[session.codec] = chat_protocol.encode_frame(event, session.codec)
+            session.push(frame)
+
+    def join(self, user_id, conversation_id):
+        """Subscribe the user's connected sessions to a conversation they were added to"""
+        for session in list(self.subscribers.get(user_channel(user_id), ())):
+            self.subscribe(session, conversation_id)
+
+    def resync_all(self):
+        """Tell every client to fetch what it may have missed"""
+        for session in list(self.sessions):
+            if session.user_id is not None:
+                session.push(chat_protocol.encode_frame({'event': 'resync'}, session.codec))
+
+    def on_broker_command(self, command):
+        if command['op'] == 'publish':
+            self.deliver(command['conversation_id'], command['event'])
+        elif command['op'] == 'join':
+            self.join(command['user_id'], command['conversation_id'])
+        elif command['op'] == 'resync':
+            self.resync_all()
+        elif command['op'] == 'presence':
+            self.on_remote_presence(command)
+
+    def on_broker_reconnect(self):
+        self.resync_all()
+        self.announce_presence()
+
+    # Presence
+
+    def is_online(self, user_id):
+        return self.presence.is_online(user_id) or any(tracker.is_online(user_id)
+                                                       for tracker in self.remote_presence.values())
+
+    def seen(self, user_id):
+        """A request of the user arrived; keep them online"""
+        was_online = self.is_online(user_id)
+        if self.presence.heartbeat(user_id):
+            if self.broker is not None:
+                self.broker.send({'op': 'presence', 'worker': self.worker_id, 'online': [user_id]})
+            if not was_online:
+                self.presence_changed(online=[user_id])
+
+    def left(self, user_id):
+        """A session of the user ended; they go offline with their last one"""
+        if self.subscribers.get(user_channel(user_id)):
+            return
+        if self.presence.leave(user_id):
+            if self.broker is not None:
+                self.broker.send({'op': 'presence', 'worker': self.worker_id, 'offline': [user_id]})
+            if not self.is_online(user_id):
+                self.presence_changed(offline=[user_id])
+
+    def presence_changed(self, online=(), offline=()):
+        if online or offline:
+            self.push_event(self.subscribers.get(PRESENCE_CHANNEL, ()),
+                            {'event': 'presence', 'online': list(online), 'offline': list(offline)})
+
+    def announce_presence(self):
+        """Tell the other workers who is online here; their view of it expires otherwise"""
+        if self.broker is not None:
+            self.broker.send({'op': 'presence', 'worker': self.worker_id, 'online': self.presence.online()})
+
+    def on_remote_presence(self, command):
+        tracker = self.remote_presence[command['worker']]
+        online, offline = [], []
+        for user_id in command.get('online', ()):
+            if not self.is_online(user_id):
+                online.append(user_id)
+            tracker.heartbeat(user_id)
+        for user_id in command.get('offline', ()):
+            if tracker.leave(user_id) and not self.is_online(user_id):
+                offline.append(user_id)
+        self.presence_changed(online, offline)
+
+    async def presence_loop(self):
+        """Take users whose heartbeats expired offline, and re-announce ours to the other workers"""
+        loop = asyncio.get_running_loop()
+        announced = loop.time()
+        while True:
+            await asyncio.sleep(PRESENCE_SWEEP_INTERVAL)
+            expired = set(self.presence.expire())
+            if expired and self.broker is not None:
+                self.broker.send({'op': 'presence', 'worker': self.worker_id, 'offline': list(expired)})
+            for worker_id, tracker in list(self.remote_presence.items()):
+                expired.update(tracker.expire())
+                if not tracker.deadlines:
+                    del self.remote_presence[worker_id]
+            self.presence_changed(offline=[user_id for user_id in expired if not self.is_online(user_id)])
+
+            if loop.time() - announced >= HEARTBEAT_INTERVAL:
+                announced = loop.time()
+                self.announce_presence()
+
+    async def publish_message(self, message_id, event='message', conversation_id=None):
+        message = await self.call(self.service.get_message, message_id)
+        if conversation_id is None:
+            conversation_id = await self.call(self.service.get_conversation_id, message_id)
+        if message is not None and conversation_id is not None:
+            self.publish(conversation_id, {'event': event, 'message': list(message)})
+
+    # Accounts
+
+    async def op_register(self, session, username, password, email='', confirm_password=None):
+        return await asyncio.wrap_future(self.service.register_async(username, password, email, confirm_password))
+
+    async def op_login(self, session, username, password):
+        user = await asyncio.wrap_future(self.service.login_async(username, password))
+        await self.op_logout(session)
+        session.user_id = user['id']
+        # Direct messages reach the user wherever they come from; groups are subscribed here
+        self.subscribe(session, user_channel(user['id']))
+        for group_id in await self.call(self.service.user_group_ids, user['id']):
+            self.subscribe(session, chat_db.group_conversation_id(group_id))
+        return user
+
+    async def op_logout(self, session):
+        """Stop acting as the user; they go offline unless they have other sessions"""
+        user_id, session.user_id = session.user_id, None
+        self.unsubscribe_all(session)
+        if user_id is not None:
+            self.left(user_id)
+
+    async def op_heartbeat(self, session):
+        """Any request keeps the user online (see Session.handle); send this when there is nothing else"""
+
+    async def op_presence(self, session):
+        """Follow presence: an event with everyone online now, then one for each batch of changes"""
+        self.subscribe(session, PRESENCE_CHANNEL)
+        online = set(self.presence.online())
+        for tracker in self.remote_presence.values():
+            online.update(tracker.online())
+        # Sent before the response, so the client has it when the response arrives
+        session.send({'event': 'presence', 'snapshot': True, 'online': list(online), 'offline': []}, session.codec)
+
+    async def op_list_users(self, session, search=''):
+        return await self.call(self.service.list_users, None, search)
+
+    # Groups
+
+    async def op_list_groups(self, session, search=''):
+        return await self.call(self.service.list_groups, session.user_id, search)
+
+    async def op_create_group(self, session, name, description=''):
+        group_id = await self.call(self.service.create_group, session.user_id, name, description)
+        self.subscribe(session, chat_db.group_conversation_id(group_id))
+        return group_id
+
+    async def op_add_group_member(self, session, group_id, user_id, is_admin=False):
+        await self.check_access(session, chat_db.group_conversation_id(group_id))
+        await self.call(self.service.add_group_member, group_id, user_id, is_admin)
+        # Connected sessions of the new member start receiving the group's messages
+        conversation_id = chat_db.group_conversation_id(group_id)
+        self.join(user_id, conversation_id)
+        if self.broker is not None:
+            self.broker.send({'op': 'join', 'user_id': user_id, 'conversation_id': conversation_id})
+
+    async def op_get_group_name(self, session, group_id):
+        await self.check_access(session, chat_db.group_conversation_id(group_id))
+        return await self.call(self.service.get_group_name, group_id)
+
+    # Messages
+
+    async def op_send(self, session, message, receiver_id=None, group_id=None, client_id=None):
+        future = await self.call(self.service.queue_message, session.user_id, message,
+                                 receiver_id=receiver_id, group_id=group_id, client_id=client_id)
+        message_id = await asyncio.wrap_future(future)
+        await self.publish_message(message_id, conversation_id=self.conversation_id(session, receiver_id, group_id))
+        return message_id
+
+    async def op_upload_start(self, session, file_name, size):
+        if size > MAX_ATTACHMENT_SIZE:
+            raise ChatError("File size too large! Maximum size is 50MB.")
+        upload_id = uuid.uuid4().hex
+        # The stored attachment keeps the base name of the file it is copied from
+        directory = os.path.join(self.upload_dir, upload_id)
+        os.makedirs(directory)
+        session.uploads[upload_id] = open(os.path.join(directory, os.path.basename(file_name)), 'wb')
+        return upload_id
+
+    async def op_upload_chunk(self, session, upload_id, data):
+        upload = session.uploads[upload_id]
+        upload.write(base64.b64decode(data))
+        if upload.tell() > MAX_ATTACHMENT_SIZE:
+            await self.op_upload_cancel(session, upload_id)
+            raise ChatError("File size too large! Maximum size is 50MB.")
+
+    async def op_upload_cancel(self, session, upload_id):
+        upload = session.uploads.pop(upload_id, None)
+        if upload is not None:
+            upload.close()
+            shutil.rmtree(os.path.dirname(upload.name), ignore_errors=True)
+
+    async def op_upload_finish(self, session, upload_id, message='', receiver_id=None, group_id=None):
+        upload = session.uploads.pop(upload_id)
+        upload.close()
+        try:
+            message_id = await self.call(self.service.attach_file, session.user_id, upload.name, message,
+                                         receiver_id=receiver_id, group_id=group_id)
+        finally:
+            shutil.rmtree(os.path.dirname(upload.name), ignore_errors=True)
+        await self.publish_message(message_id, conversation_id=self.conversation_id(session, receiver_id, group_id))
+        return message_id
+
+    async def op_history(self, session, conversation_id, after_id=0):
+        await self.check_access(session, conversation_id)
+        return await self.call(self.service.history, conversation_id, after_id)
+
+    async def op_history_page(self, session, conversation_id, before_id=None, after_id=None, limit=50):
+        await self.check_access(session, conversation_id)
+        return await self.call(self.service.history_page, conversation_id, before_id, after_id, limit)
+
+    async def op_get_message(self, session, message_id):
+        conversation_id = await self.call(self.service.get_conversation_id, message_id)
+        if conversation_id is None:
+            return None
+        await self.check_access(session, conversation_id)
+        return await self.call(self.service.get_message, message_id)
+
+    async def op_edit(self, session, message_id, message):
+        await self.call(self.service.edit_message, session.user_id, message_id, message)
+        await self.publish_message(message_id, 'changed')
+
+    async def op_delete(self, session, message_id):
+        await self.call(self.service.delete_message, session.user_id, message_id)
+        await self.publish_message(message_id, 'changed')
+
+    async def op_latest_message_id(self, session):
+        return await self.call(self.service.latest_message_id)
+
+    async def op_messages_since(self, session, after_id, limit=500):
+        return await self.call(self.service.messages_since, after_id, limit, session.user_id)
+
+    async def op_change_marker(self, session):
+        return await self.call(self.service.change_marker)
+
+    async def op_changes_since(self, session, seq):
+        return await self.call(self.service.changes_since, seq, session.user_id)
+
+    async def op_mark_read(self, session, conversation_id, message_id=None):
+        # Only queues a write, so it needs no database worker. The user has no cursor in
+        # conversations they are not part of, so those are left alone.
+        await asyncio.wrap_future(self.service.mark_read(session.user_id, conversation_id, message_id))
+
+    async def op_unread_counts(self, session):
+        return await self.call(self.service.unread_counts, session.user_id)
+
+    async def op_search(self, session, text, limit=20, offset=0):
+        return await self.call(self.service.search_messages, session.user_id, text, limit, offset)
+
+    async def op_subscribe(self, session, conversation_ids):
+        for conversation_id in conversation_ids:
+            await self.check_access(session, conversation_id)
+            self.subscribe(session, conversation_id)
+
+    async def op_unsubscribe(self, session, conversation_ids):
+        for conversation_id in conversation_ids:
+            self.unsubscribe(session, conversation_id)
+
+    def close(self):
+        self.database_pool.shutdown(wait=True)
+
+
+def run_worker(args, broker=None, reuse_port=False):
+    service = ChatService(args.database, attachments_dir=args.attachments, durability=args.durability)
+    server = ChatServer(service, broker)
+    try:
+        asyncio.run(server.serve(args.listen, reuse_port=reuse_port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        service.close()
+
+
+def run_broker(path):
+    try:
+        asyncio.run(Broker().serve(path))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--listen', default='127.0.0.1:8765', help="host:port or Unix socket path")
+    parser.add_argument('--database', default=chat_db.DATABASE_PATH)
+    parser.add_argument('--attachments', default=ATTACHMENTS_DIR)
+    parser.add_argument('--durability', choices=('normal', 'full'), default='normal')
+    parser.add_argument('--workers', type=int, default=1, help="worker processes sharing a TCP port")
+    parser.add_argument('--broker', help="Unix socket of the event relay between workers "
+                                         "(default: chat-broker-<port>.sock in the temp directory)")
+    args = parser.parse_args()
+
+    print(f"Serving {args.database} on {args.listen}")
+    if args.workers == 1:
+        run_worker(args, args.broker)
+        return
+
+    kind, *where = chat_protocol.parse_address(args.listen)
+    if kind != 'tcp':
+        parser.error("several workers can only share a TCP port")
+    broker = args.broker or os.path.join(tempfile.gettempdir(), f"chat-broker-{where[1]}.sock")
+
+    # Upgrade the schema once, before the workers open the database together
+    db = chat_db.ConnectionManager(args.database)
+    chat_db.migrate(db.writer())
+    db.close()
+
+    processes = [multiprocessing.Process(target=run_broker, args=(broker,), name='chat-broker')]
+    processes += [multiprocessing.Process(target=run_worker, args=(args, broker, True), name=f'chat-worker-{i}')
+                  for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,608 @@
+import collections
+import concurrent.futures
+import math
+import os
+import sqlite3
+import sys
+import time
+
+import chat_db
+from chat_blobs import BlobStore
+from chat_events import ChangeNotifier
+from chat_passwords import hash_password, needs_rehash, verify_password
+from chat_presence import HEARTBEAT_INTERVAL, PRESENCE_TTL
+from chat_writes import WriteQueue
+
+ATTACHMENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'attachments')
+MAX_ATTACHMENT_SIZE = 50 * 1024 * 1024
+ATTACHMENT_WORKERS = 3
+PASSWORD_WORKERS = 2
+# Newest matches of a search that are ranked; older ones are never returned
+SEARCH_WINDOW = 1000
+
+# A row of chat_db.MESSAGE_COLUMNS
+Message = collections.namedtuple('Message', ['sender_id', 'message', 'file_path', 'file_type', 'timestamp',
+                                             'edited', 'deleted', 'id', 'sender_name'])
+
+# A search match: the Message, its conversation and the text around the match
+SearchResult = collections.namedtuple('SearchResult', ['message', 'conversation_id', 'snippet', 'score'])
+
+# One page of SearchResults; truncated is True if older matches lay beyond SEARCH_WINDOW
+SearchPage = collections.namedtuple('SearchPage', ['results', 'truncated'])
+
+# Okapi BM25 term frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class ChatError(Exception):
+    """A request that cannot be carried out; the message is meant for the user"""
+
+
+def bm25_score(text, phrase, average_length):
+    """BM25 of a text matching one phrase, without the IDF factor
+
+    The IDF is the same for every match of a single phrase, so it does not change the
+    order; leaving it out avoids counting all matches in the whole index.
+    """
+    frequency = text.lower().count(phrase.lower())
+    length_norm = 1 - BM25_B + BM25_B * len(text) / average_length
+    return frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+
+
+def make_snippet(text, phrase, width=60):
+    """The part of text around the first match of phrase, with the match in [brackets]"""
+    start = text.lower().find(phrase.lower())
+    if start < 0:
+        return text[:width] + ('…' if len(text) > width else '')
+    end = start + len(phrase)
+    context = max(width - len(phrase), 0) // 2
+    before, after = max(start - context, 0), min(end + context, len(text))
+    return (('…' if before > 0 else '') + text[before:start] + '[' + text[start:end] + ']'
+            + text[end:after] + ('…' if after < len(text) else ''))
+
+
+def get_file_type(file_name):
+    """Classify an attachment by its extension"""
+    file_ext = os.path.splitext(file_name)[1].lower()
+    if file_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
+        return 'image'
+    elif file_ext in ['.mp4', '.avi', '.mov', '.wmv']:
+        return 'video'
+    else:
+        return 'document'
+
+
+class ChatService:
+    """Accounts, groups and messages on top of the chat database, without any UI
+
+    Every method takes the ids it acts on explicitly, so one service can be shared by
+    several sessions (or driven from benchmarks). Invalid requests raise ChatError.
+    """
+
+    def __init__(self, path=chat_db.DATABASE_PATH, attachments_dir=ATTACHMENTS_DIR, ordering='submit',
+                 durability='normal', password_cost=None):
+        self.db = chat_db.ConnectionManager(path)
+        self.attachments_dir = attachments_dir
+        self.password_cost = password_cost
+        self.dummy_password_hash = None  # Verified against for unknown usernames
+        self.blobs = BlobStore(attachments_dir)
+
+        # Create or upgrade the schema
+        chat_db.migrate(self.db.writer())
+
+        # Old change entries are only useful to clients that were running at the time
+        chat_db.prune_change_log(self.db.writer())
+        self.collect_attachments()
+
+        # Usernames by id, loaded in bulk
+        self.users = chat_db.UserDirectory(self.db.reader)
+
+        # Wakes waiters when a conversation changes, here or in another client
+        self.notifier = ChangeNotifier(self.db)
+
+        # Copies attachments off the caller's thread; each worker has its own connections
+        self.attachment_pool = concurrent.futures.ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS,
+                                                                     thread_name_prefix='attachment')
+
+        # Password hashing takes tens of milliseconds by design; keep it off the UI thread
+        self.password_pool = concurrent.futures.ThreadPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                                                   thread_name_prefix='password')
+
+        # Message writes share transactions with the writes queued alongside them
+        self.writes = WriteQueue(self.db, ordering=ordering, durability=durability)
+
+        # When each user's heartbeat was last written, to write at most one per interval
+        self.heartbeats_written = {}
+        # Presence writes committed here, and (writes, commits elsewhere, expiry, online ids)
+        # of the latest online_users() query
+        self.presence_writes = 0
+        self.presence_cache = None
+
+    def start(self):
+        """Start watching for changes made by other clients"""
+        self.notifier.start()
+
+    def close(self):
+        self.notifier.stop()
+        # Finish copies in progress; queued ones are dropped
+        self.attachment_pool.shutdown(wait=True, cancel_futures=True)
+        self.password_pool.shutdown(wait=True, cancel_futures=True)
+        self.writes.close()
+        self.db.close()
+
+    # Accounts
+
+    def register(self, username, password, email='', confirm_password=None):
+        """Create an account and return its user id"""
+        username = username.strip()
+        email = email.strip()
+
+        if not username or not password:
+            raise ChatError("Username and password are required!")
+
+        if confirm_password is not None and password != confirm_password:
+            raise ChatError("Passwords do not match!")
+
+        if len(password) < 6:
+            raise ChatError("Password must be at least 6 characters!")
+
+        conn = self.db.writer()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
+                           (username, hash_password(password, self.password_cost), email))
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            raise ChatError("Username already exists!")
+
+        self.users.invalidate()
+        return cursor.lastrowid
+
+    def login(self, username, password):
+        """Check credentials and return the user as {'id', 'username'}"""
+        username = username.strip()
+        if not username or not password:
+            raise ChatError("Please enter username and password!")
+
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT id, username, password FROM users WHERE username = ?", (username,))
+        user = cursor.fetchone()
+        if not user:
+            # Take as long as a wrong password, so that names can't be probed by timing
+            verify_password(password, self.dummy_hash())
+            raise ChatError("Invalid username or password!")
+
+        user_id, username, stored = user
+        if not verify_password(password, stored):
+            raise ChatError("Invalid username or password!")
+
+        # Upgrade legacy and outdated hashes now that the password is known
+        if needs_rehash(stored, self.password_cost):
+            conn = self.db.writer()
+            conn.execute("UPDATE users SET password = ? WHERE id = ? AND password = ?",
+                         (hash_password(password, self.password_cost), user_id, stored))
+            conn.commit()
+
+        return {'id': user_id, 'username': username}
+
+    def dummy_hash(self):
+        if self.dummy_password_hash is None:
+            self.dummy_password_hash = hash_password('', self.password_cost)
+        return self.dummy_password_hash
+
+    def register_async(self, username, password, email='', confirm_password=None):
+        """register() on the password worker pool; return a Future of the user id"""
+        return self.password_pool.submit(self.register, username, password, email, confirm_password)
+
+    def login_async(self, username, password):
+        """login() on the password worker pool; return a Future of the user"""
+        return self.password_pool.submit(self.login, username, password)
+
+    def list_users(self, exclude_id=None, search=''):
+        """(id, username) of every user, optionally filtered by a substring of the name"""
+        search = search.lower()
+        return [(user_id, username) for user_id, username in self.users.users()
+                if user_id != exclude_id and search in username.lower()]
+
+    # Presence
+
+    def heartbeat(self, user_id):
+        """Keep a user online for PRESENCE_TTL seconds; call as often as convenient
+
+        Heartbeats closer together than HEARTBEAT_INTERVAL are absorbed here, and the
+        rest are queued like message writes, so they share commits with other writes.
+        """
+        now = time.monotonic()
+        if now - self.heartbeats_written.get(user_id, -HEARTBEAT_INTERVAL) < HEARTBEAT_INTERVAL:
+            return
+        self.heartbeats_written[user_id] = now
+        future = self.writes.submit("""
+            INSERT INTO presence (user_id, last_seen) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET last_seen = excluded.last_seen
+        """, (user_id, time.time()))
+        future.add_done_callback(self.presence_written)
+
+    def go_offline(self, user_id):
+        """Take a user offline now rather than when their heartbeat expires"""
+        self.heartbeats_written.pop(user_id, None)
+        future = self.writes.submit("DELETE FROM presence WHERE user_id = ?", (user_id,))
+        future.add_done_callback(self.presence_written)
+        return future
+
+    def presence_written(self, future):
+        self.presence_writes += 1
+
+    def online_users(self):
+        """Ids of the users with a heartbeat in the last PRESENCE_TTL seconds
+
+        The presence table is only read again after a presence write here, a commit by
+        another process (seen by the notifier) or once the oldest heartbeat read has
+        expired, so calling this on a timer costs nothing while presence is unchanged.
+        """
+        writes, commits, now = self.presence_writes, self.notifier.commits, time.time()
+        if self.presence_cache is not None:
+            cached_writes, cached_commits, expires, online = self.presence_cache
+            if (cached_writes, cached_commits) == (writes, commits) and now < expires:
+                return online
+
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT user_id, last_seen FROM presence WHERE last_seen > ?", (now - PRESENCE_TTL,))
+        rows = cursor.fetchall()
+        online = frozenset(user_id for user_id, last_seen in rows)
+        expires = min((last_seen for user_id, last_seen in rows), default=math.inf) + PRESENCE_TTL
+        self.presence_cache = (writes, commits, expires, online)
+        return online
+
+    def get_user_id(self, username):
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    # Groups
+
+    def create_group(self, owner_id, name, description=''):
+        """Create a group with its creator as admin and return the group id"""
+        name = name.strip()
+        description = description.strip()
+        if not name:
+            raise ChatError("Group name is required!")
+
+        conn = self.db.writer()
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO groups (name, description, created_by) VALUES (?, ?, ?)",
+                       (name, description, owner_id))
+        group_id = cursor.lastrowid
+
+        # Add creator as admin
+        cursor.execute("INSERT INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, TRUE)",
+                       (group_id, owner_id))
+        conn.commit()
+        return group_id
+
+    def add_group_member(self, group_id, user_id, is_admin=False):
+        conn = self.db.writer()
+        conn.execute("INSERT OR IGNORE INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, ?)",
+                     (group_id, user_id, is_admin))
+        conn.commit()
+
+    def list_groups(self, user_id, search=''):
+        """(id, name, description, member_count) of the groups a user belongs to"""
+        cursor = self.db.reader().cursor()
+        cursor.execute(chat_db.GROUP_LIST_QUERY, (user_id, f'%{search.lower()}%'))
+        return cursor.fetchall()
+
+    def get_group_id(self, user_id, name):
+        """Id of a group with this name that the user belongs to"""
+        cursor = self.db.reader().cursor()
+        cursor.execute('''
+            SELECT g.id FROM groups g
+            INNER JOIN group_members gm ON g.id = gm.group_id
+            WHERE gm.user_id = ? AND g.name = ?
+        ''', (user_id, name))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def get_group_name(self, group_id):
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT name FROM groups WHERE id = ?", (group_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def user_group_ids(self, user_id):
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT group_id FROM group_members WHERE user_id = ?", (user_id,))
+        return [group_id for (group_id,) in cursor.fetchall()]
+
+    def is_group_member(self, group_id, user_id):
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT 1 FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id))
+        return cursor.fetchone() is not None
+
+    def can_access(self, user_id, conversation_id):
+        """Whether a user takes part in a conversation"""
+        kind, _, key = conversation_id.partition(':')
+        if kind == 'g':
+            return key.isdigit() and self.is_group_member(int(key), user_id)
+        if kind == 'u':
+            return str(user_id) in key.split(':')
+        return False
+
+    # Messages
+
+    def send_message(self, sender_id, message, receiver_id=None, group_id=None, file_path=None,
+                     file_type=None, client_id=None):
+        """Store a message to a user or a group and return its id"""
+        return self.queue_message(sender_id, message, receiver_id=receiver_id, group_id=group_id,
+                                  file_path=file_path, file_type=file_type, client_id=client_id).result()
+
+    def queue_message(self, sender_id, message, receiver_id=None, group_id=None, file_path=None,
+                      file_type=None, client_id=None):
+        """send_message() without waiting; return a Future of the message id
+
+        The Future resolves once the message is committed. Messages queued together are
+        committed together (see chat_writes.WriteQueue), so senders with many messages
+        should queue them all before waiting.
+
+        client_id is an optional id chosen by the sender (see chat_outbox). Sending again
+        with the same one stores nothing and returns the id of the message already stored,
+        so messages can be retried safely when the outcome of an attempt is unknown.
+        """
+        if receiver_id is None and group_id is None:
+            raise ChatError("Please select a user or group to chat with!")
+        if not message and not file_path:
+            raise ChatError("Message is empty!")
+        if group_id is not None and not self.is_group_member(group_id, sender_id):
+            raise ChatError("You are not a member of this group!")
+
+        if group_id is not None:
+            conversation_id = chat_db.group_conversation_id(group_id)
+        else:
+            conversation_id = chat_db.direct_conversation_id(sender_id, receiver_id)
+
+        if client_id is not None:
+            # The no-op update makes RETURNING report the stored row on a repeat
+            future = self.writes.submit("""
+                INSERT INTO messages (sender_id, receiver_id, group_id, conversation_id, message, file_path,
+                                      file_type, client_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (sender_id, client_id) WHERE client_id IS NOT NULL
+                DO UPDATE SET client_id = excluded.client_id
+                RETURNING id
+            """, (sender_id, receiver_id, group_id, conversation_id, message, file_path, file_type, client_id),
+                result='returning')
+        else:
+            future = self.writes.submit("""
+                INSERT INTO messages (sender_id, receiver_id, group_id, conversation_id, message, file_path,
+                                      file_type)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (sender_id, receiver_id, group_id, conversation_id, message, file_path, file_type),
+                result='lastrowid')
+        self.notify_when_written(future, conversation_id)
+        return future
+
+    def notify_when_written(self, future, conversation_id):
+        """Wake the conversation's waiters once a queued write has committed"""
+        def done(future):
+            if future.exception() is None:
+                self.notifier.notify(conversation_id)
+        future.add_done_callback(done)
+
+    def store_attachment(self, source_path, on_progress=None):
+        """Put a file into the attachment store; return (stored path, file type)
+
+        Identical content is stored once (see chat_blobs.BlobStore) and the stored name
+        is registered in attachment_files, where messages referencing it are counted.
+        on_progress(copied, total) is called while the file is copied.
+        """
+        # Check file size (limit to 50MB)
+        if os.path.getsize(source_path) > MAX_ATTACHMENT_SIZE:
+            raise ChatError("File size too large! Maximum size is 50MB.")
+
+        file_path, digest, size = self.blobs.store(source_path, on_progress)
+
+        # Refreshing created_at keeps collect_attachments() off a name about to be reused
+        conn = self.db.writer()
+        conn.execute("""
+            INSERT INTO attachment_files (file_path, digest, size) VALUES (?, ?, ?)
+            ON CONFLICT (file_path) DO UPDATE SET created_at = CURRENT_TIMESTAMP
+        """, (file_path, digest, size))
+        conn.commit()
+        return file_path, get_file_type(file_path)
+
+    def attach_file(self, sender_id, source_path, message='', receiver_id=None, group_id=None,
+                    on_progress=None):
+        """Store a file and send it as a message; return the message id
+
+        The message row is only inserted once the file is completely stored. If that
+        fails, the unreferenced file is reclaimed later by collect_attachments().
+        """
+        file_path, file_type = self.store_attachment(source_path, on_progress)
+        return self.send_message(sender_id, message, receiver_id=receiver_id, group_id=group_id,
+                                 file_path=file_path, file_type=file_type)
+
+    def collect_attachments(self, grace='-1 hour'):
+        """Delete stored files that no message references any more; return how many
+
+        Files registered within the grace period are kept, as their message may still
+        be on its way.
+        """
+        conn = self.db.writer()
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT file_path FROM attachment_files
+            WHERE refcount <= 0 AND created_at < datetime('now', ?)
+        """, (grace,))
+        removed = 0
+        for (file_path,) in cursor.fetchall():
+            cursor.execute("""
+                DELETE FROM attachment_files
+                WHERE file_path = ? AND refcount <= 0 AND created_at < datetime('now', ?)
+            """, (file_path, grace))
+            conn.commit()
+            if cursor.rowcount:
+                self.blobs.remove(file_path)
+                removed += 1
+        return removed
+
+    def attach_file_async(self, sender_id, source_path, message='', receiver_id=None, group_id=None,
+                          on_progress=None):
+        """attach_file() on the attachment worker pool; return a Future of the message id
+
+        Several attachments are stored concurrently. on_progress and the Future's done
+        callbacks run on a worker thread.
+        """
+        return self.attachment_pool.submit(self.attach_file, sender_id, source_path, message,
+                                           receiver_id=receiver_id, group_id=group_id,
+                                           on_progress=on_progress)
+
+    def history(self, conversation_id, after_id=0):
+        """Every message of a conversation after after_id, in ascending id order"""
+        cursor = self.db.reader().cursor()
+        cursor.execute(chat_db.HISTORY_QUERY, (conversation_id, after_id))
+        return [Message(*row) for row in cursor.fetchall()]
+
+    def history_page(self, conversation_id, before_id=None, after_id=None, limit=50):
+        """A page of a conversation in ascending id order
+
+        Without before_id/after_id this is the latest page; otherwise the page just
+        before or after the given message id.
+        """
+        cursor = self.db.reader().cursor()
+        if after_id is not None:
+            cursor.execute(chat_db.NEWER_PAGE_QUERY, (conversation_id, after_id, limit))
+            return [Message(*row) for row in cursor.fetchall()]
+
+        if before_id is not None:
+            cursor.execute(chat_db.OLDER_PAGE_QUERY, (conversation_id, before_id, limit))
+        else:
+            cursor.execute(chat_db.LATEST_PAGE_QUERY, (conversation_id, limit))
+        return [Message(*row) for row in reversed(cursor.fetchall())]
+
+    def get_message(self, message_id):
+        cursor = self.db.reader().cursor()
+        cursor.execute(chat_db.MESSAGE_QUERY, (message_id,))
+        row = cursor.fetchone()
+        return Message(*row) if row else None
+
+    def edit_message(self, user_id, message_id, message):
+        """Change the text of one of the user's own text messages"""
+        message = message.strip()
+        if not message:
+            raise ChatError("Message is empty!")
+
+        current = self.get_message(message_id)
+        if current is None or current.deleted or current.sender_id != user_id:
+            raise ChatError("You can only edit your own messages!")
+        if current.file_path:
+            raise ChatError("Cannot edit messages with file attachments!")
+
+        self.writes.submit("UPDATE messages SET message = ?, edited = TRUE WHERE id = ?",
+                           (message, message_id)).result()
+        self.notifier.notify(self.get_conversation_id(message_id))
+
+    def delete_message(self, user_id, message_id):
+        """Soft-delete one of the user's own messages"""
+        deleted = self.writes.submit(
+            "UPDATE messages SET deleted = TRUE WHERE id = ? AND sender_id = ? AND deleted = FALSE",
+            (message_id, user_id), result='rowcount').result()
+        if deleted == 0:
+            raise ChatError("You can only delete your own messages!")
+        self.notifier.notify(self.get_conversation_id(message_id))
+
+    def get_conversation_id(self, message_id):
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT conversation_id FROM messages WHERE id = ?", (message_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+    def latest_message_id(self):
+        """Id of the newest message; pass it to messages_since() later"""
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        return cursor.fetchone()[0]
+
+    def messages_since(self, after_id, limit=500, user_id=None):
+        """(Message, conversation id) of the messages after after_id, oldest first
+
+        All conversations, or with user_id only those the user takes part in.
+        """
+        cursor = self.db.reader().cursor()
+        if user_id is None:
+            cursor.execute(chat_db.FEED_QUERY, (after_id, limit))
+        else:
+            cursor.execute(chat_db.USER_FEED_QUERY, (after_id, user_id, user_id, user_id, limit))
+        return [(Message(*row[:-1]), row[-1]) for row in cursor.fetchall()]
+
+    def change_marker(self):
+        """Latest entry of the edit/delete log; pass it to changes_since() later"""
+        cursor = self.db.reader().cursor()
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM message_changes")
+        return cursor.fetchone()[0]
+
+    def changes_since(self, seq, user_id=None):
+        """(seq, message_id) of edits and deletes after a change marker, optionally in one user's conversations"""
+        cursor = self.db.reader().cursor()
+        if user_id is None:
+            cursor.execute("SELECT seq, message_id FROM message_changes WHERE seq > ? ORDER BY seq", (seq,))
+        else:
+            cursor.execute(chat_db.USER_CHANGES_QUERY, (seq, user_id, user_id, user_id))
+        return cursor.fetchall()
+
+    # Read state
+
+    def mark_read(self, user_id, conversation_id, message_id=None):
+        """Record that a user has read a conversation up to message_id (default: its latest message)
+
+        Read cursors only move forward. Returns a Future that resolves once the cursor is
+        stored; nothing needs to wait for it.
+        """
+        future = self.writes.submit(chat_db.MARK_READ_QUERY,
+                                    (sys.maxsize if message_id is None else message_id, conversation_id, user_id))
+        self.notify_when_written(future, conversation_id)
+        return future
+
+    def unread_counts(self, user_id):
+        """Unread messages of each of the user's conversations that has any, by conversation id"""
+        cursor = self.db.reader().cursor()
+        cursor.execute(chat_db.UNREAD_COUNTS_QUERY, (user_id,))
+        return dict(cursor.fetchall())
+
+    def total_unread(self, user_id):
+        """Unread messages over all of the user's conversations"""
+        return sum(self.unread_counts(user_id).values())
+
+    def search_messages(self, user_id, text, limit=20, offset=0):
+        """Messages containing text in the user's conversations, best matches first
+
+        The SEARCH_WINDOW newest matches are ranked by BM25, newer first among equal
+        scores; page through them with offset. Ranking only those keeps common words
+        fast, but older matches are never returned: the SearchPage says whether there
+        were any, so the caller can ask for a more specific text.
+        """
+        text = text.strip()
+        if len(text) < 3:
+            raise ChatError("Please enter at least 3 characters to search!")
+
+        # The text is one quoted phrase, matched as a substring and never parsed as a query
+        phrase = '"' + text.replace('"', '""') + '"'
+        scopes = [f'"[u{user_id}]"'] + [f'"[g{group_id}]"' for group_id in self.user_group_ids(user_id)]
+        query = f"message : {phrase} AND participants : ({' OR '.join(scopes)})"
+
+        cursor = self.db.reader().cursor()
+        # One more than the window tells whether it cut off older matches
+        cursor.execute(chat_db.SEARCH_QUERY, (query, SEARCH_WINDOW + 1))
+        matches = [(Message(*row[:9]), row[9]) for row in cursor.fetchall()]
+        truncated = len(matches) > SEARCH_WINDOW
+        del matches[SEARCH_WINDOW:]
+        if not matches:
+            return SearchPage([], False)
+
+        average_length = max(sum(len(msg.message) for msg, conversation_id in matches) / len(matches), 1)
+        results = [SearchResult(msg, conversation_id, make_snippet(msg.message, text),
+                                bm25_score(msg.message, text, average_length))
+                   for msg, conversation_id in matches]
+        results.sort(key=lambda result: (-result.score, -result.message.id))
+        return SearchPage(results[offset:offset + limit], truncated)
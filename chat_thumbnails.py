@@ -0,0 +1,131 @@
+import collections
+import concurrent.futures
+import hashlib
+import os
+import re
+import uuid
+
+from PIL import Image, ImageOps, ImageTk
+
+THUMBNAIL_SIZE = (240, 240)
+
+# Digest directories of the attachment store (see chat_blobs.BlobStore)
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+def content_key(file_path):
+    """Cache key of a file's content
+
+    Files in the attachment store are named by their SHA-256 digest already; other
+    files are keyed by path, size and modification time so that changes are noticed.
+    """
+    digest = os.path.basename(os.path.dirname(file_path))
+    if DIGEST_PATTERN.fullmatch(digest):
+        return digest
+    stat = os.stat(file_path)
+    return hashlib.sha256(f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+
+def make_thumbnail(file_path, cache_path, size=THUMBNAIL_SIZE):
+    """Downscaled copy of an image, read from or written to the disk cache"""
+    if os.path.exists(cache_path):
+        with Image.open(cache_path) as cached:
+            cached.load()
+            return cached
+
+    with Image.open(file_path) as image:
+        # JPEG decodes straight to a smaller scale; the rest is reduced in integer steps
+        # before the final resample
+        image.draft('RGB', size)
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(size, reducing_gap=2.0)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_path = f"{cache_path}.{uuid.uuid4().hex}.part"
+    try:
+        image.save(temp_path, 'PNG')
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # The cache is an optimization; show the thumbnail anyway
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return image
+
+
+class ThumbnailCache:
+    """Image previews for the chat, decoded off the Tk thread
+
+    Thumbnails are generated once on a worker pool and kept on disk under cache_dir,
+    keyed by content hash. The PhotoImages made from them are held in an LRU bounded
+    by memory_budget bytes (4 bytes per pixel). Full-size images are never decoded on
+    the Tk thread.
+    """
+
+    def __init__(self, root, cache_dir, size=THUMBNAIL_SIZE, workers=2, memory_budget=32 * 1024 * 1024):
+        self.root = root
+        self.cache_dir = cache_dir
+        self.size = size
+        self.memory_budget = memory_budget
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnail')
+        self.photos = collections.OrderedDict()  # file path -> (PhotoImage, bytes)
+        self.memory_used = 0
+        self.waiting = {}  # file path -> callbacks to run once loaded
+        self.failed = set()
+
+    def cache_path(self, file_path):
+        key = content_key(file_path)
+        width, height = self.size
+        return os.path.join(self.cache_dir, key[:2], f"{key}_{width}x{height}.png")
+
+    def get(self, file_path, on_ready=None):
+        """PhotoImage of a thumbnail if it is in memory; otherwise start loading it
+
+        Returns None while loading (on_ready() is called on the Tk thread once it is
+        available) and for files that cannot be previewed.
+        """
+        entry = self.photos.get(file_path)
+        if entry is not None:
+            self.photos.move_to_end(file_path)
+            return entry[0]
+        if file_path in self.failed:
+            return None
+
+        callbacks = self.waiting.get(file_path)
+        if callbacks is None:
+            callbacks = self.waiting[file_path] = []
+            future = self.pool.submit(self.load, file_path)
+            future.add_done_callback(lambda f: self.root.after(0, self.finish, file_path, f))
+        if on_ready is not None:
+            callbacks.append(on_ready)
+        return None
+
+    def load(self, file_path):
+        """Worker: the thumbnail as a PIL image"""
+        return make_thumbnail(file_path, self.cache_path(file_path), self.size)
+
+    def finish(self, file_path, future):
+        """Tk thread: turn a loaded thumbnail into a PhotoImage and notify the waiters"""
+        callbacks = self.waiting.pop(file_path, [])
+        try:
+            image = future.result()
+        except Exception:
+            # Missing, unreadable or not an image
+            self.failed.add(file_path)
+            return
+
+        photo = ImageTk.PhotoImage(image)
+        cost = image.width * image.height * 4
+        self.photos[file_path] = (photo, cost)
+        self.memory_used += cost
+        while self.memory_used > self.memory_budget and len(self.photos) > 1:
+            _, evicted_cost = self.photos.popitem(last=False)[1]
+            self.memory_used -= evicted_cost
+
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,307 @@
+"""Streaming export and import of chat history
+
+Writes users, groups, memberships and messages of a chat database as a stream of
+records, and loads such a stream into another (or the same) database. Both directions
+run in constant memory: rows are read with fetchmany() and written in batches.
+
+    python chat_transfer.py export chat_app.db history.ndjson.gz
+    python chat_transfer.py import chat_app.db history.ndjson.gz
+
+Records are newline-delimited JSON, or MessagePack with --format msgpack (needs the
+msgpack package); a .gz file name compresses either. Attachment files are referenced
+by path and not copied.
+"""
+import argparse
+import contextlib
+import gzip
+import json
+import sqlite3
+import sys
+import time
+
+import chat_db
+
+try:
+    import msgpack
+except ImportError:  # Optional; only needed for --format msgpack
+    msgpack = None
+
+FORMAT_NAME = 'cacasians-chat'
+FORMAT_VERSION = 1
+FORMATS = ('ndjson', 'msgpack')
+
+# Columns written for each record type, in export order
+RECORD_COLUMNS = {
+    'user': ('id', 'username', 'password', 'email', 'created_at'),
+    'group': ('id', 'name', 'description', 'created_by', 'created_at'),
+    'member': ('group_id', 'user_id', 'is_admin', 'joined_at'),
+    'message': ('id', 'sender_id', 'receiver_id', 'group_id', 'message', 'file_path', 'file_type',
+                'timestamp', 'edited', 'deleted'),
+}
+
+EXPORT_QUERIES = {
+    'user': "SELECT id, username, password, email, created_at FROM users ORDER BY id",
+    'group': "SELECT id, name, description, created_by, created_at FROM groups ORDER BY id",
+    'member': "SELECT group_id, user_id, is_admin, joined_at FROM group_members ORDER BY id",
+    'message': """
+        SELECT id, sender_id, receiver_id, group_id, message, file_path, file_type, timestamp, edited, deleted
+        FROM messages ORDER BY id
+    """,
+}
+
+# Work done per inserted message that import postpones until the end of the load
+DEFERRED_INDEXES = ('idx_messages_history',)
+DEFERRED_TRIGGERS = ('messages_fts_insert', 'messages_group_activity', 'messages_count_unread')
+
+
+def open_stream(path, mode, file_format):
+    """Binary file object for a record stream, gzip-compressed if the name ends in .gz"""
+    if file_format == 'msgpack' and msgpack is None:
+        raise RuntimeError("The msgpack format needs the msgpack package (pip install msgpack)")
+    if path == '-':
+        return contextlib.nullcontext(sys.stdout.buffer if 'w' in mode else sys.stdin.buffer)
+    if path.endswith('.gz'):
+        # Level 1: several times faster than the default for a small loss in size
+        return gzip.open(path, mode + 'b', compresslevel=1) if 'w' in mode else gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+
+class RecordWriter:
+    def __init__(self, stream, file_format):
+        self.stream = stream
+        self.file_format = file_format
+        self.packer = msgpack.Packer() if file_format == 'msgpack' else None
+
+    def write(self, record):
+        if self.packer is not None:
+            self.stream.write(self.packer.pack(record))
+        else:
+            self.stream.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode())
+            self.stream.write(b'\n')
+
+
+def read_records(stream, file_format):
+    """Records of a stream, one at a time"""
+    if file_format == 'msgpack':
+        yield from msgpack.Unpacker(stream, raw=False)
+        return
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def export_history(conn, stream, file_format='ndjson', batch_size=10000):
+    """Write every user, group, membership and message to stream; return the counts"""
+    writer = RecordWriter(stream, file_format)
+    writer.write({'type': 'header', 'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+                  'schema_version': chat_db.get_schema_version(conn)})
+
+    counts = {}
+    cursor = conn.cursor()
+    for record_type, query in EXPORT_QUERIES.items():
+        columns = RECORD_COLUMNS[record_type]
+        cursor.execute(query)
+        count = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                record = {'type': record_type}
+                record.update(zip(columns, row))
+                writer.write(record)
+            count += len(rows)
+        counts[record_type] = count
+    return counts
+
+
+class Importer:
+    """Loads a record stream into a database in one transaction
+
+    Users are matched by username, so importing into a database that already has some
+    of them merges their conversations; groups and messages are always added. Ids are
+    renumbered as needed; only the user and group id maps are held in memory.
+    """
+
+    def __init__(self, conn, batch_size=10000, defer_indexes=True):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.batch_size = batch_size
+        self.defer_indexes = defer_indexes
+
+        self.user_ids = {}  # exported id -> id in this database
+        self.group_ids = {}
+        self.members = []
+        self.messages = []
+        self.counts = {record_type: 0 for record_type in RECORD_COLUMNS}
+        self.first_message_id = None
+        self.deferred_sql = []
+
+    def run(self, records):
+        records = iter(records)
+        header = next(records, None)
+        if not header or header.get('type') != 'header' or header.get('format') != FORMAT_NAME:
+            raise ValueError("Not a chat history export")
+        if header.get('version', 0) > FORMAT_VERSION:
+            raise ValueError(f"Export format version {header['version']} is newer than this application supports")
+
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            self.first_message_id = self.cursor.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+            if self.defer_indexes:
+                self.defer()
+            for record in records:
+                handler = getattr(self, f"add_{record.get('type')}", None)
+                if handler is None:
+                    raise ValueError(f"Unknown record type: {record.get('type')!r}")
+                handler(record)
+            self.flush_members()
+            self.flush_messages()
+            if self.defer_indexes:
+                self.catch_up()
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        return self.counts
+
+    def defer(self):
+        """Drop the index and triggers that would otherwise be updated row by row"""
+        names = DEFERRED_INDEXES + DEFERRED_TRIGGERS
+        self.cursor.execute(f"""
+            SELECT type, name, sql FROM sqlite_master
+            WHERE name IN ({', '.join('?' * len(names))})
+        """, names)
+        self.deferred_sql = self.cursor.fetchall()
+        for object_type, name, sql in self.deferred_sql:
+            self.cursor.execute(f"DROP {object_type.upper()} {name}")
+
+    def catch_up(self):
+        """Do the work of the deferred triggers for the imported rows, then restore them"""
+        # messages_fts_insert: index the live imported messages in one pass
+        participants = chat_db.PARTICIPANTS_SQL.format(row='')
+        self.cursor.execute(f"""
+            INSERT INTO messages_fts (rowid, message, participants)
+            SELECT id, message, {participants} FROM messages
+            WHERE id >= ? AND deleted = FALSE AND message IS NOT NULL
+        """, (self.first_message_id,))
+
+        # messages_count_unread: imported history starts out read by its participants
+        chat_db.count_history_as_read(self.cursor, self.first_message_id)
+
+        for object_type, name, sql in self.deferred_sql:
+            self.cursor.execute(sql)
+
+        # messages_group_activity: latest message of every imported group
+        self.cursor.executemany("""
+            UPDATE groups SET last_activity = COALESCE(
+                (SELECT timestamp FROM messages WHERE conversation_id = ? ORDER BY id DESC LIMIT 1),
+                last_activity)
+            WHERE id = ?
+        """, [(chat_db.group_conversation_id(group_id), group_id) for group_id in self.group_ids.values()])
+
+    def add_user(self, record):
+        self.cursor.execute("SELECT id FROM users WHERE username = ?", (record['username'],))
+        existing = self.cursor.fetchone()
+        if existing:
+            self.user_ids[record['id']] = existing[0]
+            return
+        self.cursor.execute("INSERT INTO users (username, password, email, created_at) VALUES (?, ?, ?, ?)",
+                            (record['username'], record['password'], record['email'], record['created_at']))
+        self.user_ids[record['id']] = self.cursor.lastrowid
+        self.counts['user'] += 1
+
+    def add_group(self, record):
+        self.cursor.execute("INSERT INTO groups (name, description, created_by, created_at) VALUES (?, ?, ?, ?)",
+                            (record['name'], record['description'], self.user_ids.get(record['created_by']),
+                             record['created_at']))
+        self.group_ids[record['id']] = self.cursor.lastrowid
+        self.counts['group'] += 1
+
+    def add_member(self, record):
+        group_id = self.group_ids.get(record['group_id'])
+        user_id = self.user_ids.get(record['user_id'])
+        if group_id is None or user_id is None:
+            return
+        self.members.append((group_id, user_id, record['is_admin'], record['joined_at']))
+        if len(self.members) >= self.batch_size:
+            self.flush_members()
+
+    def add_message(self, record):
+        if self.members:
+            # Messages follow the memberships in an export; store those first, as the export had them
+            self.flush_members()
+        sender_id = self.user_ids.get(record['sender_id'])
+        receiver_id = self.user_ids.get(record['receiver_id'])
+        group_id = self.group_ids.get(record['group_id'])
+        if record['group_id'] is not None:
+            if group_id is None:
+                return
+            conversation_id = chat_db.group_conversation_id(group_id)
+        elif sender_id is not None and receiver_id is not None:
+            conversation_id = chat_db.direct_conversation_id(sender_id, receiver_id)
+        else:
+            return
+        self.messages.append((sender_id, receiver_id, group_id, conversation_id, record['message'],
+                              record['file_path'], record['file_type'], record['timestamp'], record['edited'],
+                              record['deleted']))
+        if len(self.messages) >= self.batch_size:
+            self.flush_messages()
+
+    def flush_members(self):
+        self.cursor.executemany("""
+            INSERT OR IGNORE INTO group_members (group_id, user_id, is_admin, joined_at) VALUES (?, ?, ?, ?)
+        """, self.members)
+        self.counts['member'] += len(self.members)
+        self.members = []
+
+    def flush_messages(self):
+        self.cursor.executemany("""
+            INSERT INTO messages (sender_id, receiver_id, group_id, conversation_id, message, file_path,
+                                  file_type, timestamp, edited, deleted)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.messages)
+        self.counts['message'] += len(self.messages)
+        self.messages = []
+
+
+def import_history(conn, stream, file_format='ndjson', batch_size=10000, defer_indexes=True):
+    """Load an export into conn in a single transaction; return the counts of records added"""
+    return Importer(conn, batch_size, defer_indexes).run(read_records(stream, file_format))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=('export', 'import'))
+    parser.add_argument('database', help="chat database file")
+    parser.add_argument('path', help="export file; - for stdout/stdin")
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help="update the indexes row by row instead of after the load (small imports)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'export':
+        conn = sqlite3.connect(args.database)
+        with open_stream(args.path, 'w', args.format) as stream:
+            counts = export_history(conn, stream, args.format, args.batch_size)
+    else:
+        # Autocommit mode: the importer manages its transaction itself
+        conn = sqlite3.connect(args.database, isolation_level=None)
+        chat_db.migrate(conn)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA cache_size = -262144")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        with open_stream(args.path, 'r', args.format) as stream:
+            counts = import_history(conn, stream, args.format, args.batch_size,
+                                    defer_indexes=not args.keep_indexes)
+    conn.close()
+
+    summary = ', '.join(f"{count} {record_type}s" for record_type, count in counts.items())
+    print(f"{args.command.capitalize()}ed {summary} in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
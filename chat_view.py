@@ -0,0 +1,429 @@
+import difflib
+import tkinter as tk
+
+
+def sync_listbox(listbox, shown, wanted):
+    """Change a Listbox from showing shown to showing wanted with few inserts and deletes
+
+    Both are lists of (key, label) pairs in display order; rows are matched by key.
+    Returns wanted, to be passed as shown next time.
+    """
+    matcher = difflib.SequenceMatcher(None, [key for key, label in shown], [key for key, label in wanted],
+                                      autojunk=False)
+    # From the end backwards, so that earlier indexes stay valid
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        if tag == 'equal':
+            for offset in range(i2 - i1):
+                label = wanted[j1 + offset][1]
+                if shown[i1 + offset][1] != label:
+                    listbox.delete(i1 + offset)
+                    listbox.insert(i1 + offset, label)
+            continue
+        if i2 > i1:
+            listbox.delete(i1, i2 - 1)
+        if j2 > j1:
+            listbox.insert(i1, *[label for key, label in wanted[j1:j2]])
+    return list(wanted)
+
+
+class MessageBubble:
+    """A reusable message widget; rebound to a different row as the view scrolls"""
+
+    def __init__(self, view):
+        self.view = view
+        self.row = None
+
+        self.frame = tk.Frame(view.viewport, bg='#1a1a2e')
+        self.content_frame = tk.Frame(self.frame, relief='raised', bd=1)
+        self.info_label = tk.Label(self.content_frame, font=('Arial', 8), fg='#cccccc', anchor='w')
+        self.info_label.pack(fill='x', padx=5, pady=(2, 0))
+        self.image_label = tk.Label(self.content_frame, bd=0, cursor='hand2')
+        self.photo = None  # Keeps the displayed thumbnail alive even if the cache drops it
+        self.msg_label = tk.Label(self.content_frame, font=('Arial', 10), fg='white',
+                                  wraplength=300, justify='left', anchor='w')
+        self.msg_label.pack(fill='x', padx=5, pady=(0, 5))
+
+        for widget in (self.frame, self.content_frame, self.info_label, self.image_label, self.msg_label):
+            view.bind_scrolling(widget)
+            widget.bind("<Button-3>", self.on_context_menu)
+        self.msg_label.bind("<Button-1>", self.on_click)
+        self.image_label.bind("<Button-1>", self.on_click)
+
+    def show(self, row):
+        """Display a row in this bubble"""
+        if row is self.row:
+            return
+        self.row = row
+
+        # Determine message alignment and color
+        bg_color = '#e94560' if row['own'] else '#0f3460'
+        self.content_frame.pack_configure(side='right' if row['own'] else 'left', padx=10, pady=2,
+                                          fill='none' if row['own'] else 'x')
+        self.content_frame.config(bg=bg_color)
+        self.info_label.config(text=row['info'], bg=bg_color)
+        self.msg_label.config(text=row['text'], bg=bg_color,
+                              cursor='hand2' if row['file_path'] else '')
+
+        # Inline preview once the thumbnail is loaded; the view re-renders the row then
+        self.photo = self.view.get_thumbnail(row) if row.get('image') else None
+        if self.photo is not None:
+            self.image_label.config(image=self.photo, bg=bg_color)
+            self.image_label.pack(padx=5, pady=(2, 2), anchor='w', before=self.msg_label)
+        else:
+            self.image_label.config(image='')
+            self.image_label.pack_forget()
+
+    def on_context_menu(self, event):
+        if self.row is not None and self.view.on_context_menu:
+            self.view.on_context_menu(self.row, event)
+
+    def on_click(self, event):
+        if self.row is not None and self.row['file_path'] and self.view.on_open:
+            self.view.on_open(self.row)
+
+
+class VirtualChatView:
+    """Chat message list that only creates widgets for the rows on screen
+
+    Rows are dicts with at least 'id', 'own', 'info', 'text' and 'file_path', kept in
+    ascending id order. Rows with 'pending' set (messages still being sent) always stay
+    at the end, after the newest loaded message, and rows with an 'image' path show an
+    inline preview from the thumbnails cache (a chat_thumbnails.ThumbnailCache).
+
+    Only a window of max_rows is held in memory; older and newer pages are fetched with
+    the load_older(before_id, limit) and load_newer(after_id, limit) callbacks when the
+    user scrolls near either end. Bubble widgets are pooled and rebound to other rows
+    instead of being destroyed.
+    """
+
+    def __init__(self, parent, load_older=None, load_newer=None, on_context_menu=None, on_open=None,
+                 thumbnails=None, page_size=50, max_rows=300, overscan=3, scroll_step=40):
+        self.load_older = load_older
+        self.load_newer = load_newer
+        self.on_context_menu = on_context_menu
+        self.on_open = on_open
+        self.thumbnails = thumbnails
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.overscan = overscan
+        self.scroll_step = scroll_step
+
+        self.frame = tk.Frame(parent, bg='#0f3460')
+        self.viewport = tk.Frame(self.frame, bg='#0f3460')
+        self.scrollbar = tk.Scrollbar(self.frame, command=self.yview)
+        self.viewport.pack(side='left', fill='both', expand=True)
+        self.scrollbar.pack(side='right', fill='y')
+
+        self.rows = []
+        self.index_by_id = {}
+        self.has_older = False
+        self.has_newer = False
+
+        # Scroll position: first visible row and how many pixels of it are hidden above
+        self.top = 0
+        self.offset = 0
+        self.following = True  # Keep the last row pinned to the bottom
+
+        self.heights = {}
+        self.visible = {}  # row id -> bubble
+        self.pool = []
+        self.measure_bubble = None
+        self.loading = False
+        self.render_pending = False
+
+        self.bind_scrolling(self.viewport)
+        self.viewport.bind('<Configure>', self.on_resize)
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def bind_scrolling(self, widget):
+        widget.bind('<MouseWheel>', lambda e: self.scroll(-e.delta // 120 * self.scroll_step))
+        widget.bind('<Button-4>', lambda e: self.scroll(-self.scroll_step))
+        widget.bind('<Button-5>', lambda e: self.scroll(self.scroll_step))
+
+    # Row window
+
+    def set_rows(self, rows, has_older):
+        """Replace the content with rows (typically the latest page) and show the bottom"""
+        self.rows = list(rows)
+        self.has_older = has_older
+        self.has_newer = False
+        self.heights.clear()
+        self.reindex()
+        self.scroll_to_bottom()
+
+    def clear(self):
+        self.set_rows([], False)
+
+    def get_row(self, row_id):
+        index = self.index_by_id.get(row_id)
+        return self.rows[index] if index is not None else None
+
+    def append_rows(self, rows):
+        """Add newly arrived rows at the end, following them if the bottom was in view"""
+        if not rows:
+            return
+        if self.has_newer:
+            # The newest rows are not loaded; they will be fetched when scrolling down
+            return
+
+        # New messages go above the ones still being sent
+        index = len(self.rows)
+        while index > 0 and self.rows[index - 1].get('pending'):
+            index -= 1
+        self.insert_rows(index, rows)
+
+    def add_pending_row(self, row):
+        """Show a message that is still being sent below the loaded ones"""
+        if self.has_newer:
+            return
+        self.insert_rows(len(self.rows), [row])
+
+    def insert_rows(self, index, rows):
+        follow = self.following or self.at_bottom()
+        self.rows[index:index] = rows
+        self.reindex()
+        if follow:
+            self.trim_older()
+            self.scroll_to_bottom()
+        else:
+            self.trim_newer()
+            self.schedule_render()
+
+    def update_row(self, row):
+        """Replace a loaded row after an edit"""
+        index = self.index_by_id.get(row['id'])
+        if index is None:
+            return
+        self.rows[index] = row
+        self.heights.pop(row['id'], None)
+        self.schedule_render()
+
+    def remove_row(self, row_id):
+        """Drop a loaded row after a delete"""
+        index = self.index_by_id.pop(row_id, None)
+        if index is None:
+            return
+        del self.rows[index]
+        self.heights.pop(row_id, None)
+        if index < self.top:
+            self.top -= 1
+        self.reindex()
+        self.schedule_render()
+
+    def get_thumbnail(self, row):
+        """Thumbnail of a row's image, or None while it is still being loaded"""
+        if self.thumbnails is None:
+            return None
+        return self.thumbnails.get(row['image'], lambda: self.thumbnail_ready(row['id']))
+
+    def thumbnail_ready(self, row_id):
+        row = self.get_row(row_id)
+        if row is not None:
+            # A new row object makes the bubbles showing it redraw
+            self.update_row(dict(row))
+
+    def reindex(self):
+        self.index_by_id = {row['id']: index for index, row in enumerate(self.rows)}
+        self.top = max(0, min(self.top, len(self.rows) - 1))
+
+    def trim_older(self):
+        """Keep at most max_rows in memory by dropping rows above the visible area"""
+        excess = min(len(self.rows) - self.max_rows, self.top - self.overscan)
+        if excess > 0:
+            for row in self.rows[:excess]:
+                self.heights.pop(row['id'], None)
+            del self.rows[:excess]
+            self.top -= excess
+            self.has_older = True
+            self.reindex()
+
+    def trim_newer(self):
+        """Keep at most max_rows in memory by dropping rows below the visible area"""
+        last_needed = self.top + self.rows_in_view() + self.overscan
+        excess = min(len(self.rows) - self.max_rows, len(self.rows) - last_needed)
+        if excess > 0:
+            # Pending rows go too, so that the last row is a loaded message to page from
+            while excess < len(self.rows) and self.rows[-excess - 1].get('pending'):
+                excess += 1
+            for row in self.rows[-excess:]:
+                self.heights.pop(row['id'], None)
+            del self.rows[-excess:]
+            self.has_newer = True
+            self.reindex()
+
+    def fetch_pages(self):
+        """Load the neighbouring page when the visible area gets close to either end"""
+        if self.loading or not self.rows:
+            return
+        self.loading = True
+        try:
+            if self.has_older and self.load_older and self.top < self.overscan:
+                older = self.load_older(self.rows[0]['id'], self.page_size)
+                self.has_older = len(older) == self.page_size
+                if older:
+                    self.rows[:0] = older
+                    self.top += len(older)
+                    self.reindex()
+                    self.trim_newer()
+                    self.schedule_render()
+            elif (self.has_newer and self.load_newer
+                  and self.top + self.rows_in_view() + self.overscan >= len(self.rows)):
+                newer = self.load_newer(self.rows[-1]['id'], self.page_size)
+                self.has_newer = len(newer) == self.page_size
+                if newer:
+                    self.rows.extend(newer)
+                    self.reindex()
+                    self.trim_older()
+                    self.schedule_render()
+        finally:
+            self.loading = False
+
+    # Geometry
+
+    def row_height(self, index):
+        """Height of a row, measuring it with an off-screen bubble the first time"""
+        row = self.rows[index]
+        height = self.heights.get(row['id'])
+        if height is None:
+            if self.measure_bubble is None:
+                self.measure_bubble = MessageBubble(self)
+            self.measure_bubble.show(row)
+            self.measure_bubble.frame.update_idletasks()
+            height = self.heights[row['id']] = self.measure_bubble.frame.winfo_reqheight()
+        return height
+
+    def rows_in_view(self):
+        """Number of rows from the top row that fit in the viewport"""
+        height = self.viewport.winfo_height()
+        y = -self.offset
+        index = self.top
+        while index < len(self.rows) and y < height:
+            y += self.row_height(index)
+            index += 1
+        return index - self.top
+
+    def at_bottom(self):
+        if self.has_newer:
+            return False
+        height = self.viewport.winfo_height()
+        y = -self.offset
+        for index in range(self.top, len(self.rows)):
+            y += self.row_height(index)
+            if y > height + 1:
+                return False
+        return True
+
+    def scroll_to_bottom(self):
+        """Position the view so that the last row sits at the bottom of the viewport"""
+        height = self.viewport.winfo_height()
+        self.top, self.offset = max(len(self.rows) - 1, 0), 0
+        used = 0
+        for index in range(len(self.rows) - 1, -1, -1):
+            used += self.row_height(index)
+            self.top = index
+            if used >= height:
+                self.offset = used - height
+                break
+        self.following = True
+        self.schedule_render()
+
+    def scroll(self, pixels):
+        """Scroll by a number of pixels; positive values move towards newer messages"""
+        if not self.rows:
+            return
+        if pixels > 0 and self.at_bottom():
+            self.fetch_pages()
+            return
+
+        self.offset += pixels
+        while self.offset < 0 and self.top > 0:
+            self.top -= 1
+            self.offset += self.row_height(self.top)
+        while self.top < len(self.rows) - 1 and self.offset >= self.row_height(self.top):
+            self.offset -= self.row_height(self.top)
+            self.top += 1
+        self.offset = max(self.offset, 0)
+
+        self.following = False
+        if pixels > 0 and self.at_bottom():
+            self.scroll_to_bottom()
+        self.fetch_pages()
+        self.schedule_render()
+
+    def yview(self, *args):
+        """Scrollbar command"""
+        if not self.rows:
+            return
+        if args[0] == 'moveto':
+            fraction = min(max(float(args[1]), 0.0), 1.0)
+            self.top, self.offset = min(int(fraction * len(self.rows)), len(self.rows) - 1), 0
+            self.following = False
+            if self.at_bottom():
+                self.scroll_to_bottom()
+            self.fetch_pages()
+            self.schedule_render()
+        elif args[0] == 'scroll':
+            amount = int(args[1])
+            if args[2] == 'pages':
+                self.scroll(amount * max(self.viewport.winfo_height() - self.scroll_step, self.scroll_step))
+            else:
+                self.scroll(amount * self.scroll_step)
+
+    def on_resize(self, event):
+        # Wrapping does not depend on the width, but bubbles must be re-laid out
+        if self.following:
+            self.scroll_to_bottom()
+        else:
+            self.schedule_render()
+
+    # Rendering
+
+    def schedule_render(self):
+        """Coalesce several changes into one render pass"""
+        if not self.render_pending:
+            self.render_pending = True
+            self.viewport.after_idle(self.render)
+
+    def render(self):
+        """Place bubbles for the visible rows plus overscan; recycle the rest"""
+        self.render_pending = False
+        height = self.viewport.winfo_height()
+
+        wanted = {}
+        y = -self.offset
+        index = self.top
+        extra = 0
+        while index < len(self.rows) and (y < height or extra < self.overscan):
+            if y >= height:
+                extra += 1
+            wanted[self.rows[index]['id']] = (index, y)
+            y += self.row_height(index)
+            index += 1
+
+        # Release bubbles whose rows scrolled out of the window
+        for row_id in list(self.visible):
+            if row_id not in wanted:
+                bubble = self.visible.pop(row_id)
+                bubble.frame.place_forget()
+                self.pool.append(bubble)
+
+        for row_id, (index, y) in wanted.items():
+            bubble = self.visible.get(row_id)
+            if bubble is None:
+                bubble = self.pool.pop() if self.pool else MessageBubble(self)
+                self.visible[row_id] = bubble
+            bubble.show(self.rows[index])
+            bubble.frame.place(x=0, y=y, relwidth=1)
+
+        self.update_scrollbar()
+
+    def update_scrollbar(self):
+        if not self.rows:
+            self.scrollbar.set(0, 1)
+            return
+        total = len(self.rows)
+        first = (self.top + self.offset / max(self.row_height(self.top), 1)) / total
+        last = min(first + self.rows_in_view() / total, 1.0)
+        self.scrollbar.set(first, last)
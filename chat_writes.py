@@ -0,0 +1,150 @@
+import collections
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+
+# PRAGMA synchronous of the write connection for each durability level
+DURABILITY_LEVELS = {
+    # Committed writes survive an application crash; the latest may be lost on power failure
+    'normal': 'NORMAL',
+    # Every commit is on disk before it is acknowledged
+    'full': 'FULL',
+}
+
+ORDERINGS = ('submit', 'grouped')
+
+# One queued statement; result names the cursor attribute its Future resolves to, if any,
+# or is 'returning' for the first value the statement returns (INSERT ... RETURNING id)
+Write = collections.namedtuple('Write', ['sql', 'params', 'result', 'future'])
+
+
+class WriteQueue:
+    """Group commit for the chat's writes
+
+    Writes are executed by a single thread with its own writer connection. Everything
+    queued while one transaction runs goes into the next one, so concurrent and
+    pipelined writers share commits instead of paying one each. When a burst is under
+    way (more than one write waiting), the thread waits up to max_delay seconds for
+    more, up to max_batch writes per transaction; a lone write is committed at once.
+
+    Each write has a Future that resolves once its transaction has committed. If a
+    transaction fails, its writes are retried one by one so only the failing ones
+    report the error.
+
+    ordering='submit' executes writes exactly in the order they were queued, with
+    executemany() for consecutive runs of the same statement. 'grouped' runs every
+    write of one statement in a batch together, which helps mixed bulk loads but may
+    reorder writes of different statements within a transaction.
+    """
+
+    def __init__(self, db, max_batch=256, max_delay=0.002, ordering='submit', durability='normal'):
+        if ordering not in ORDERINGS:
+            raise ValueError(f"ordering must be one of {', '.join(ORDERINGS)}")
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"durability must be one of {', '.join(DURABILITY_LEVELS)}")
+
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.ordering = ordering
+        self.durability = durability
+
+        self.queue = queue.SimpleQueue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name='write-queue', daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params=(), result=None):
+        """Queue a write; return a Future of its lastrowid, rowcount or returned value (per result), else None"""
+        if self.closed:
+            raise RuntimeError("The write queue is closed")
+        future = concurrent.futures.Future()
+        self.queue.put(Write(sql, params, result, future))
+        return future
+
+    def close(self):
+        """Commit everything queued so far and stop the write thread"""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+
+    def run(self):
+        conn = self.db.writer()
+        conn.execute(f"PRAGMA synchronous = {DURABILITY_LEVELS[self.durability]}")
+        closing = False
+        while not closing:
+            write = self.queue.get()
+            if write is None:
+                break
+            batch = [write]
+            closing = self.collect(batch)
+            batch = [write for write in batch if write.future.set_running_or_notify_cancel()]
+            if batch:
+                self.commit(conn, batch)
+
+    def collect(self, batch):
+        """Add the writes already waiting, and during a burst those arriving within max_delay
+
+        Returns True if the queue was closed meanwhile.
+        """
+        deadline = None
+        while len(batch) < self.max_batch:
+            try:
+                if deadline is None:
+                    write = self.queue.get_nowait()
+                else:
+                    write = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                if deadline is None and len(batch) > 1 and self.max_delay > 0:
+                    deadline = time.monotonic() + self.max_delay
+                    continue
+                break
+            if write is None:
+                return True
+            batch.append(write)
+        return False
+
+    def commit(self, conn, batch):
+        """Run a batch in one transaction and resolve its Futures"""
+        try:
+            results = self.execute(conn.cursor(), batch)
+            conn.commit()
+        except Exception as error:
+            conn.rollback()
+            if len(batch) > 1:
+                for write in batch:
+                    self.commit(conn, [write])
+            else:
+                batch[0].future.set_exception(error)
+            return
+
+        for write, result in zip(batch, results):
+            write.future.set_result(result)
+
+    def execute(self, cursor, batch):
+        """Execute the writes of a batch; return their results in batch order"""
+        if self.ordering == 'grouped':
+            positions = {}
+            for index, write in enumerate(batch):
+                positions.setdefault(write.sql, []).append(index)
+            runs = positions.values()
+        else:
+            runs = [[index for index, write in group]
+                    for sql, group in itertools.groupby(enumerate(batch), key=lambda item: item[1].sql)]
+
+        results = [None] * len(batch)
+        for run in runs:
+            writes = [batch[index] for index in run]
+            if len(writes) > 1 and all(write.result is None for write in writes):
+                cursor.executemany(writes[0].sql, [write.params for write in writes])
+                continue
+            for index, write in zip(run, writes):
+                cursor.execute(write.sql, write.params)
+                if write.result == 'returning':
+                    results[index] = cursor.fetchone()[0]
+                elif write.result is not None:
+                    results[index] = getattr(cursor, write.result)
+        return results
@@ -1,20 +1,30 @@
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog, simpledialog
-import sqlite3
-import hashlib
+from tkinter import ttk, messagebox, filedialog
 import datetime
 import threading
 import time
 import os
-import shutil
-from PIL import Image, ImageTk
 import json
+import chat_db
+from chat_service import SEARCH_WINDOW, ChatService, ChatError, get_file_type
+from chat_client import ChatClient
+from chat_outbox import Outbox
+from chat_view import VirtualChatView, sync_listbox
+from chat_index import SubstringIndex
+from chat_cache import HistoryCache
+from chat_events import ANY_CONVERSATION
+from chat_thumbnails import ThumbnailCache
 import urllib.request
 import urllib.error
 import webbrowser
 
 class ChatApplication:
     VERSION = "1.2.0"
+    PAGE_SIZE = 50
+    FILTER_DELAY_MS = 150
+    PRESENCE_REFRESH_MS = 2000
+    FEED_LIMIT = 500
+    HISTORY_CACHE_BYTES = 16 * 1024 * 1024
     UPDATE_URL = "https://github.com/jcfrancisco0103/Cacasians-Chat-Application/releases"  # Example URL
     
     def __init__(self):
@@ -31,6 +41,9 @@ class ChatApplication:
         self.current_chat_partner = None
         self.current_group = None
         
+        # A login or registration is being checked in the background
+        self.auth_pending = False
+        
         # Chat mode: 'user' or 'group'
         self.chat_mode = 'user'
         
@@ -38,8 +51,37 @@ class ChatApplication:
         self.chat_refresh_thread = None
         self.refresh_chat = False
         
-        # Message tracking for edit/delete
-        self.message_widgets = {}
+        # Incremental refresh state: conversation on screen, and the newest message and
+        # change-log sequence applied to the view and the history cache
+        self.loaded_conversation = None
+        self.last_message_id = 0
+        self.last_change_seq = 0
+        
+        # Attachments being copied in the background, by the (negative) id of their pending row
+        self.pending_uploads = {}
+        self.pending_counter = 0
+        
+        # Messages saved locally and sent in the background, by client id, with their pending row
+        self.outbox = None
+        self.pending_sends = {}
+        
+        # Sidebar directories, loaded once and filtered in memory as the user types
+        self.user_rows = {}  # user id -> username
+        self.group_rows = {}  # group id -> (id, name, description, member_count)
+        self.user_index = SubstringIndex()
+        self.group_index = SubstringIndex()
+        self.listed_items = []  # ((kind, id), label) pairs shown in the sidebar, in order
+        self.filter_job = None
+        
+        # Unread messages by conversation id, for the sidebar badges
+        self.unread_counts = {}
+        
+        # Ids of the users online, refreshed while logged in
+        self.online_users = frozenset()
+        self.presence_job = None
+        
+        # Latest rows of the conversations opened recently, kept current as changes come in
+        self.history_cache = HistoryCache(self.HISTORY_CACHE_BYTES)
         
         # Create main container
         self.main_frame = tk.Frame(self.root, bg='#1a1a2e')
@@ -49,67 +91,17 @@ class ChatApplication:
         self.show_login_screen()
         
     def init_database(self):
-        """Initialize SQLite database"""
-        self.conn = sqlite3.connect('chat_app.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        
-        # Create users table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                email TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create groups table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS groups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL,
-                description TEXT,
-                created_by INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (created_by) REFERENCES users (id)
-            )
-        ''')
-        
-        # Create group members table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS group_members (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER,
-                user_id INTEGER,
-                joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                is_admin BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (group_id) REFERENCES groups (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                UNIQUE(group_id, user_id)
-            )
-        ''')
-        
-        # Create messages table (updated for group support)
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER,
-                receiver_id INTEGER,
-                group_id INTEGER,
-                message TEXT,
-                file_path TEXT,
-                file_type TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                edited BOOLEAN DEFAULT FALSE,
-                deleted BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (sender_id) REFERENCES users (id),
-                FOREIGN KEY (receiver_id) REFERENCES users (id),
-                FOREIGN KEY (group_id) REFERENCES groups (id)
-            )
-        ''')
-        
-        self.conn.commit()
+        """Initialize the chat service on top of the SQLite database, or a chat server"""
+        # CHAT_SERVER=host:port (or a Unix socket path) connects to chat_server.py
+        server_address = os.environ.get('CHAT_SERVER')
+        if server_address:
+            self.service = ChatClient(server_address)
+        else:
+            self.service = ChatService(chat_db.DATABASE_PATH)
+        self.service.start()
+        
+        # Inline image previews, shared by every chat view
+        self.thumbnails = ThumbnailCache(self.root, os.path.join(self.service.attachments_dir, 'thumbnails'))
     
     def check_for_updates(self):
         """Check for application updates"""
@@ -202,25 +194,16 @@ class ChatApplication:
             name = name_entry.get().strip()
             description = desc_text.get(1.0, tk.END).strip()
             
-            if not name:
-                messagebox.showerror("Error", "Group name is required!")
-                return
-            
             try:
-                # Create group
-                self.cursor.execute("INSERT INTO groups (name, description, created_by) VALUES (?, ?, ?)",
-                                   (name, description, self.current_user['id']))
-                group_id = self.cursor.lastrowid
-                
-                # Add creator as admin
-                self.cursor.execute("INSERT INTO group_members (group_id, user_id, is_admin) VALUES (?, ?, TRUE)",
-                                   (group_id, self.current_user['id']))
-                self.conn.commit()
+                self.service.create_group(self.current_user['id'], name, description)
                 
                 dialog.destroy()
                 messagebox.showinfo("Success", f"Group '{name}' created successfully! 🎉")
-                self.load_groups()
+                if self.chat_mode == 'group':
+                    self.refresh_groups()
                 
+            except ChatError as e:
+                messagebox.showerror("Error", str(e))
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to create group: {str(e)}")
         
@@ -234,8 +217,122 @@ class ChatApplication:
         cancel_btn.pack(side='right', padx=10)
         self.animate_button(cancel_btn)
     
+    def search_messages_dialog(self):
+        """Show the message search dialog"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Search Messages")
+        dialog.geometry("600x450")
+        dialog.configure(bg='#1a1a2e')
+        dialog.transient(self.root)
+        
+        # Center the dialog
+        dialog.geometry("+%d+%d" % (self.root.winfo_rootx() + 100, self.root.winfo_rooty() + 100))
+        
+        # Search bar
+        search_bar = tk.Frame(dialog, bg='#1a1a2e')
+        search_bar.pack(fill='x', padx=15, pady=15)
+        query_entry = tk.Entry(search_bar, font=('Arial', 12), bg='#0f3460', fg='white', 
+                              insertbackground='white', relief='flat', bd=5)
+        query_entry.pack(side='left', fill='x', expand=True)
+        query_entry.focus_set()
+        
+        # Results, one per line; double-click opens the conversation
+        results_listbox = tk.Listbox(dialog, bg='#0f3460', fg='white', font=('Arial', 11),
+                                     selectbackground='#e94560', relief='flat', bd=0, highlightthickness=0)
+        results_listbox.pack(fill='both', expand=True, padx=15)
+        
+        more_btn = tk.Button(dialog, text="⬇️ More Results", font=('Arial', 10, 'bold'), 
+                            bg='#0f3460', fg='white', relief='flat', bd=0, pady=6, padx=10)
+        self.animate_button(more_btn)
+        
+        results = []
+        
+        def show_page(offset):
+            query = query_entry.get()
+            try:
+                page = self.service.search_messages(self.current_user['id'], query,
+                                                    limit=self.PAGE_SIZE, offset=offset)
+            except ChatError as e:
+                messagebox.showerror("Error", str(e), parent=dialog)
+                return
+            
+            if offset == 0:
+                results.clear()
+                results_listbox.delete(0, tk.END)
+            for result in page.results:
+                msg = result.message
+                sender = "You" if msg.sender_id == self.current_user['id'] else msg.sender_name
+                time_str = datetime.datetime.strptime(msg.timestamp, '%Y-%m-%d %H:%M:%S').strftime('%d %b %H:%M')
+                title = self.conversation_title(result.conversation_id)
+                results.append(result)
+                snippet = ' '.join(result.snippet.split())
+                results_listbox.insert(tk.END, f"{title} • {sender} • {time_str}:  {snippet}")
+            if offset == 0 and not page.results:
+                results_listbox.insert(tk.END, "No messages found")
+            if page.truncated and len(page.results) < self.PAGE_SIZE:
+                # After the last result, so list positions still match results
+                results_listbox.insert(tk.END, f"Only the {SEARCH_WINDOW} newest matches are shown; "
+                                               "search for longer text to find older messages")
+            
+            # Offer the next page only when this one was full
+            if len(page.results) == self.PAGE_SIZE:
+                more_btn.config(command=lambda: show_page(offset + len(page.results)))
+                more_btn.pack(pady=10)
+            else:
+                more_btn.pack_forget()
+        
+        def open_result(event):
+            selection = results_listbox.curselection()
+            if selection and selection[0] < len(results):
+                self.open_conversation(results[selection[0]].conversation_id)
+                dialog.destroy()
+        
+        search_btn = tk.Button(search_bar, text="🔎 Search", font=('Arial', 11, 'bold'), 
+                              bg='#e94560', fg='white', command=lambda: show_page(0),
+                              relief='flat', bd=0, padx=10)
+        search_btn.pack(side='right', padx=(10, 0))
+        self.animate_button(search_btn, '#ff6b7a', '#e94560')
+        
+        query_entry.bind('<Return>', lambda e: show_page(0))
+        results_listbox.bind('<Double-Button-1>', open_result)
+    
+    def conversation_title(self, conversation_id):
+        """Short name of a conversation for lists"""
+        kind, *ids = conversation_id.split(':')
+        if kind == 'g':
+            return f"👥 {self.service.get_group_name(int(ids[0]))}"
+        return f"👤 {self.service.users.get(self.conversation_partner(conversation_id))}"
+    
+    def conversation_partner(self, conversation_id):
+        """The other user of a direct conversation"""
+        user_ids = [int(user_id) for user_id in conversation_id.split(':')[1:]]
+        others = [user_id for user_id in user_ids if user_id != self.current_user['id']]
+        return others[0] if others else self.current_user['id']
+    
+    def open_conversation(self, conversation_id):
+        """Show a conversation given by its conversation id"""
+        if conversation_id.startswith('g:'):
+            group_id = int(conversation_id[2:])
+            if group_id in self.group_rows:
+                group_name = self.group_rows[group_id][1]
+            else:
+                group_name = self.service.get_group_name(group_id)
+            self.current_group = group_id
+            self.current_chat_partner = None
+            self.chat_header.config(text=f"💬 Group: {group_name}")
+        else:
+            user_id = self.conversation_partner(conversation_id)
+            username = self.service.users.get(user_id)
+            self.current_group = None
+            self.current_chat_partner = {'id': user_id, 'username': username}
+            self.chat_header.config(text=f"💬 Chat with {username}")
+        self.load_chat_history()
+    
     def clear_frame(self):
         """Clear all widgets from main frame"""
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+            self.filter_job = None
         for widget in self.main_frame.winfo_children():
             widget.destroy()
     
@@ -411,59 +508,46 @@ class ChatApplication:
         back_btn.pack(side='right', padx=15)
         self.animate_button(back_btn)
     
-    def hash_password(self, password):
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
-    
     def register(self):
-        """Register new user"""
-        username = self.reg_username_entry.get().strip()
-        email = self.reg_email_entry.get().strip()
-        password = self.reg_password_entry.get()
-        confirm_password = self.reg_confirm_entry.get()
-        
-        if not username or not password:
-            messagebox.showerror("Error", "Username and password are required!")
-            return
-        
-        if password != confirm_password:
-            messagebox.showerror("Error", "Passwords do not match!")
+        """Register new user; the password is hashed on a worker thread"""
+        if self.auth_pending:
             return
-        
-        if len(password) < 6:
-            messagebox.showerror("Error", "Password must be at least 6 characters!")
+        self.auth_pending = True
+        future = self.service.register_async(self.reg_username_entry.get(), self.reg_password_entry.get(),
+                                             email=self.reg_email_entry.get(),
+                                             confirm_password=self.reg_confirm_entry.get())
+        future.add_done_callback(lambda f: self.root.after(0, self.on_register_done, f))
+    
+    def on_register_done(self, future):
+        """Tk thread: report the outcome of register()"""
+        self.auth_pending = False
+        error = future.exception()
+        if error is not None:
+            messagebox.showerror("Error", str(error))
             return
         
-        try:
-            hashed_password = self.hash_password(password)
-            self.cursor.execute("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
-                               (username, hashed_password, email))
-            self.conn.commit()
-            messagebox.showinfo("Success", "Account created successfully! 🎉")
-            self.show_login_screen()
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Error", "Username already exists!")
+        messagebox.showinfo("Success", "Account created successfully! 🎉")
+        self.show_login_screen()
     
     def login(self):
-        """Login user"""
-        username = self.username_entry.get().strip()
-        password = self.password_entry.get()
-        
-        if not username or not password:
-            messagebox.showerror("Error", "Please enter username and password!")
+        """Login user; the password is checked on a worker thread"""
+        if self.auth_pending:
+            return
+        self.auth_pending = True
+        future = self.service.login_async(self.username_entry.get(), self.password_entry.get())
+        future.add_done_callback(lambda f: self.root.after(0, self.on_login_done, f))
+    
+    def on_login_done(self, future):
+        """Tk thread: open the chat after a successful login()"""
+        self.auth_pending = False
+        error = future.exception()
+        if error is not None:
+            messagebox.showerror("Error", str(error))
             return
         
-        hashed_password = self.hash_password(password)
-        self.cursor.execute("SELECT id, username FROM users WHERE username = ? AND password = ?",
-                           (username, hashed_password))
-        user = self.cursor.fetchone()
-        
-        if user:
-            self.current_user = {'id': user[0], 'username': user[1]}
-            messagebox.showinfo("Welcome", f"Welcome back, {username}! 🎉")
-            self.show_chat_screen()
-        else:
-            messagebox.showerror("Error", "Invalid username or password!")
+        self.current_user = future.result()
+        messagebox.showinfo("Welcome", f"Welcome back, {self.current_user['username']}! 🎉")
+        self.show_chat_screen()
     
     def show_chat_screen(self):
         """Display main chat interface"""
@@ -484,15 +568,22 @@ class ChatApplication:
                                 font=('Arial', 18, 'bold'), fg='#e94560', bg='#16213e')
         welcome_label.pack(side='left', padx=20, pady=20)
         
-        # Status indicator
-        status_label = tk.Label(top_bar, text="🟢 Online", 
-                               font=('Arial', 12), fg='#4CAF50', bg='#16213e')
-        status_label.pack(side='left', padx=(0, 20), pady=20)
+        # Status indicator, set once presence is known
+        self.status_label = tk.Label(top_bar, text="⚪ Connecting…", 
+                                    font=('Arial', 12), fg='#aaaaaa', bg='#16213e')
+        self.status_label.pack(side='left', padx=(0, 20), pady=20)
         
         # Right side buttons frame
         right_buttons = tk.Frame(top_bar, bg='#16213e')
         right_buttons.pack(side='right', padx=20, pady=20)
         
+        # Message search button
+        search_btn = tk.Button(right_buttons, text="🔎 Search Messages", font=('Arial', 10, 'bold'), 
+                              bg='#0f3460', fg='white', command=self.search_messages_dialog,
+                              relief='flat', bd=0, pady=6, padx=10)
+        search_btn.pack(side='left', padx=(0, 10))
+        self.animate_button(search_btn)
+        
         # Check for Updates button
         update_btn = tk.Button(right_buttons, text="🔄 Check Updates", font=('Arial', 10, 'bold'), 
                               bg='#0f3460', fg='white', command=self.check_for_updates,
@@ -568,6 +659,13 @@ class ChatApplication:
         self.items_listbox.pack(side='left', fill='both', expand=True)
         items_scrollbar.pack(side='right', fill='y')
         self.items_listbox.bind('<<ListboxSelect>>', self.select_item)
+        self.listed_items = []
+        
+        # Rows are formatted for the user logged in; start the cache and the feed afresh
+        self.history_cache.clear()
+        self.last_change_seq = self.service.change_marker()
+        self.last_message_id = self.service.latest_message_id()
+        self.open_outbox()
         
         # Right panel - Chat area
         right_panel = tk.Frame(content_frame, bg='#16213e', relief='raised', bd=2)
@@ -586,14 +684,15 @@ class ChatApplication:
         chat_display_frame = tk.Frame(right_panel, bg='#16213e')
         chat_display_frame.pack(fill='both', expand=True, padx=10, pady=10)
         
-        self.chat_text = tk.Text(chat_display_frame, bg='#0f3460', fg='white', 
-                                font=('Arial', 11), wrap='word', state='disabled',
-                                relief='flat', bd=0, highlightthickness=0)
-        chat_scrollbar = tk.Scrollbar(chat_display_frame, command=self.chat_text.yview)
-        self.chat_text.configure(yscrollcommand=chat_scrollbar.set)
-        
-        self.chat_text.pack(side='left', fill='both', expand=True)
-        chat_scrollbar.pack(side='right', fill='y')
+        # Only the visible messages get widgets; older pages load while scrolling up
+        self.chat_view = VirtualChatView(chat_display_frame,
+                                         load_older=self.load_older_messages,
+                                         load_newer=self.load_newer_messages,
+                                         on_context_menu=self.show_message_menu,
+                                         on_open=lambda row: self.open_file(row['file_path']),
+                                         thumbnails=self.thumbnails,
+                                         page_size=self.PAGE_SIZE)
+        self.chat_view.pack(fill='both', expand=True)
         
         # Message input area with enhanced styling
         input_frame = tk.Frame(right_panel, bg='#16213e', height=80)
@@ -623,7 +722,12 @@ class ChatApplication:
         
         # Load users and start chat refresh
         self.refresh_users()
+        self.refresh_unread()
         self.start_chat_refresh()
+        
+        # Announce the user, then look who is online once the heartbeat is stored
+        self.service.heartbeat(self.current_user['id'])
+        self.presence_job = self.root.after(100, self.refresh_presence)
     
     def switch_chat_mode(self, mode):
         """Switch between user and group chat modes"""
@@ -640,7 +744,6 @@ class ChatApplication:
             self.create_group_frame.pack(fill='x', pady=5)
         
         # Clear current selection and refresh list
-        self.current_user = None
         self.current_group = None
         self.current_chat_partner = None
         self.refresh_items()
@@ -648,11 +751,9 @@ class ChatApplication:
     
     def clear_chat(self):
         """Clear the chat display"""
-        self.chat_label.config(text="💬 Select a user or group to start chatting")
-        self.chat_text.config(state='normal')
-        self.chat_text.delete(1.0, tk.END)
-        self.chat_text.config(state='disabled')
-        self.message_widgets.clear()
+        self.chat_header.config(text="💬 Select a user or group to start chatting")
+        self.chat_view.clear()
+        self.loaded_conversation = None
     
     def refresh_items(self):
         """Refresh the items list based on current chat mode"""
@@ -662,287 +763,253 @@ class ChatApplication:
             self.refresh_groups()
     
     def refresh_groups(self):
-        """Refresh the groups list"""
-        self.items_listbox.delete(0, tk.END)
-        
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT g.id, g.name, g.description, COUNT(gm.user_id) as member_count
-            FROM groups g
-            LEFT JOIN group_members gm ON g.id = gm.group_id
-            INNER JOIN group_members ugm ON g.id = ugm.group_id
-            WHERE ugm.user_id = ?
-            GROUP BY g.id, g.name, g.description
-            ORDER BY g.name
-        ''', (self.current_user_id,))
-        
-        groups = cursor.fetchall()
-        for group in groups:
-            group_id, name, description, member_count = group
-            display_text = f"🏢 {name} ({member_count} members)"
-            if description:
-                display_text += f" - {description[:30]}..."
-            self.items_listbox.insert(tk.END, display_text)
-            
-    def refresh_users(self):
-        """Refresh the users list"""
-        self.items_listbox.delete(0, tk.END)
-        
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id, username FROM users WHERE id != ?', (self.current_user_id,))
-        users = cursor.fetchall()
-        
-        for user in users:
-            user_id, username = user
-            # Add online status indicator (simplified - always show as online for demo)
-            self.items_listbox.insert(tk.END, f"🟢 {username}")
+        """Reload the groups of the current user and show those matching the search box"""
+        groups = self.service.list_groups(self.current_user['id'])
+        self.group_rows = {group[0]: group for group in groups}
+        self.group_index.update({group_id: group[1] for group_id, group in self.group_rows.items()})
+        self.apply_filter()
     
-    def select_item(self, event):
-        """Handle item selection based on current chat mode"""
-        if self.chat_mode == 'user':
-            self.select_user(event)
+    def group_label(self, group):
+        """Sidebar text of a (id, name, description, member_count) row"""
+        group_id, name, description, member_count = group
+        display_text = f"🏢 {name} ({member_count} members)"
+        if description:
+            display_text += f" - {description[:30]}..."
+        return display_text + self.unread_badge(chat_db.group_conversation_id(group_id))
+    
+    def unread_badge(self, conversation_id):
+        """Sidebar suffix with the unread count of a conversation"""
+        count = self.unread_counts.get(conversation_id)
+        return f"  🔴 {count}" if count else ""
+    
+    def refresh_unread(self):
+        """Reload the unread counts and show them on the sidebar rows, the tabs and the window title"""
+        self.unread_counts = self.service.unread_counts(self.current_user['id'])
+        # The conversation on screen is read as it arrives, whether or not that is stored yet
+        self.unread_counts.pop(self.loaded_conversation, None)
+        
+        totals = {'u': 0, 'g': 0}
+        for conversation_id, count in self.unread_counts.items():
+            totals[conversation_id[0]] += count
+        self.users_tab_btn.config(text="👥 Users" + (f" ({totals['u']})" if totals['u'] else ""))
+        self.groups_tab_btn.config(text="🏢 Groups" + (f" ({totals['g']})" if totals['g'] else ""))
+        total = totals['u'] + totals['g']
+        title = f"Cacasians Chat Application v{self.VERSION}"
+        self.root.title(f"({total}) {title}" if total else title)
+        self.apply_filter()
+    
+    def refresh_presence(self):
+        """Heartbeat, and show who is online if that changed; runs every PRESENCE_REFRESH_MS"""
+        self.presence_job = self.root.after(self.PRESENCE_REFRESH_MS, self.refresh_presence)
+        # The service sends or stores only one heartbeat per interval
+        self.service.heartbeat(self.current_user['id'])
+        # Pushed by the server, or re-read locally only when the database changed
+        online = self.service.online_users()
+        if online == self.online_users:
+            return
+        self.online_users = online
+        if self.current_user['id'] in online:
+            self.status_label.config(text="🟢 Online", fg='#4CAF50')
         else:
-            self.select_group(event)
+            self.status_label.config(text="🔴 Offline", fg='#e94560')
+        self.apply_filter()
     
-    def select_group(self, event):
-        """Handle group selection"""
-        selection = self.items_listbox.curselection()
-        if selection:
-            selected_text = self.items_listbox.get(selection[0])
-            group_name = selected_text.split(' ', 1)[1].split(' (')[0]  # Extract group name
-            
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM groups WHERE name = ?', (group_name,))
-            result = cursor.fetchone()
+    def stop_presence(self):
+        """Stop heartbeating and go offline right away rather than when the heartbeat expires"""
+        if self.presence_job is not None:
+            self.root.after_cancel(self.presence_job)
+            self.presence_job = None
+        if self.current_user:
+            self.service.go_offline(self.current_user['id'])
+        self.online_users = frozenset()
+    
+    def mark_loaded_read(self, rows):
+        """Move the read cursor of the conversation on screen to the newest of its rows"""
+        # Sending a message moves the sender's cursor already
+        if rows and not rows[-1]['own']:
+            self.service.mark_read(self.current_user['id'], self.loaded_conversation, rows[-1]['id'])
             
-            if result:
-                self.current_group = result[0]
-                self.current_user = None  # Clear user selection
-                self.current_chat_partner = None
-                self.chat_label.config(text=f"💬 Group: {group_name}")
-                self.refresh_chat()
-    
-    def select_user(self, event):
-        """Handle user selection for chat"""
+    def refresh_users(self):
+        """Reload the user directory and show the users matching the search box"""
+        self.user_rows = dict(self.service.list_users(exclude_id=self.current_user['id']))
+        self.user_index.update(self.user_rows)
+        self.apply_filter()
+    
+    def select_item(self, event):
+        """Open the conversation of the selected user or group"""
         selection = self.items_listbox.curselection()
-        if selection:
-            selected_text = self.items_listbox.get(selection[0])
-            username = selected_text.split(' ', 1)[1]  # Remove the status indicator
-            
-            cursor = self.conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE username = ?', (username,))
-            result = cursor.fetchone()
-            
-            if result:
-                self.current_user = result[0]
-                self.current_group = None
-                self.current_chat_partner = {'id': result[0], 'username': username}
-                self.chat_label.config(text=f"💬 Chat with {username}")
-                self.refresh_chat()
+        if not selection:
+            return
+        kind, item_id = self.listed_items[selection[0]][0]
+        if kind == 'group':
+            self.open_conversation(chat_db.group_conversation_id(item_id))
+        else:
+            self.open_conversation(chat_db.direct_conversation_id(self.current_user['id'], item_id))
     
     def filter_items(self, event):
-        """Filter items based on current chat mode"""
+        """Filter the list once typing pauses, not on every keystroke"""
+        if self.filter_job is not None:
+            self.root.after_cancel(self.filter_job)
+        self.filter_job = self.root.after(self.FILTER_DELAY_MS, self.apply_filter)
+    
+    def apply_filter(self):
+        """Show the users or groups matching the search text, changing only the rows that differ"""
+        self.filter_job = None
+        search = self.search_entry.get()
         if self.chat_mode == 'user':
-            self.filter_users(event)
+            matches = self.user_index.search(search)
+            # Directory order (by name) is kept
+            wanted = [(('user', user_id), ("🟢" if user_id in self.online_users else "⚪") + f" {username}"
+                       + self.unread_badge(chat_db.direct_conversation_id(self.current_user['id'], user_id)))
+                      for user_id, username in self.user_rows.items() if user_id in matches]
         else:
-            self.filter_groups(event)
-    
-    def filter_groups(self, event):
-        """Filter groups based on search text"""
-        search_text = self.search_entry.get().lower()
-        self.items_listbox.delete(0, tk.END)
-        
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT g.id, g.name, g.description, COUNT(gm.user_id) as member_count
-            FROM groups g
-            LEFT JOIN group_members gm ON g.id = gm.group_id
-            INNER JOIN group_members ugm ON g.id = ugm.group_id
-            WHERE ugm.user_id = ? AND LOWER(g.name) LIKE ?
-            GROUP BY g.id, g.name, g.description
-            ORDER BY g.name
-        ''', (self.current_user_id, f'%{search_text}%'))
-        
-        groups = cursor.fetchall()
-        for group in groups:
-            group_id, name, description, member_count = group
-            display_text = f"🏢 {name} ({member_count} members)"
-            if description:
-                display_text += f" - {description[:30]}..."
-            self.items_listbox.insert(tk.END, display_text)
-    
-    def filter_users(self, event):
-        """Filter users based on search text"""
-        search_text = self.search_entry.get().lower()
-        self.items_listbox.delete(0, tk.END)
-        
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id, username FROM users WHERE id != ? AND LOWER(username) LIKE ?', 
-                      (self.current_user_id, f'%{search_text}%'))
-        users = cursor.fetchall()
-        
-        for user in users:
-            user_id, username = user
-            self.items_listbox.insert(tk.END, f"🟢 {username}")
+            matches = self.group_index.search(search)
+            wanted = [(('group', group_id), self.group_label(group))
+                      for group_id, group in self.group_rows.items() if group_id in matches]
+        self.listed_items = sync_listbox(self.items_listbox, self.listed_items, wanted)
     
     def refresh_chat(self):
         """Refresh the chat display"""
         self.load_chat_history()
     
+    def get_conversation_id(self):
+        """Identify the conversation currently on screen"""
+        if self.current_chat_partner:
+            return chat_db.direct_conversation_id(self.current_user['id'], self.current_chat_partner['id'])
+        if self.current_group:
+            return chat_db.group_conversation_id(self.current_group)
+        return None
+    
     def load_chat_history(self):
-        """Load chat history with selected user or group"""
+        """Load the latest page of the chat with the selected user or group"""
         if not self.current_chat_partner and not self.current_group:
             return
         
-        self.chat_text.config(state='normal')
-        self.chat_text.delete(1.0, tk.END)
-        self.message_widgets.clear()
-        
-        cursor = self.conn.cursor()
-        
-        if self.current_chat_partner:
-            # Load user chat history
-            cursor.execute("""
-                SELECT sender_id, message, file_path, file_type, timestamp, edited, deleted, id
-                FROM messages 
-                WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
-                AND deleted = FALSE AND group_id IS NULL
-                ORDER BY timestamp
-            """, (self.current_user['id'], self.current_chat_partner['id'],
-                  self.current_chat_partner['id'], self.current_user['id']))
+        self.loaded_conversation = self.get_conversation_id()
+        cached = self.history_cache.get(self.loaded_conversation)
+        if cached is not None:
+            # Kept current by update_chat_history; no need to read anything
+            rows, has_older = cached
         else:
-            # Load group chat history
-            cursor.execute("""
-                SELECT sender_id, message, file_path, file_type, timestamp, edited, deleted, id
-                FROM messages 
-                WHERE group_id = ? AND deleted = FALSE
-                ORDER BY timestamp
-            """, (self.current_group,))
-        
-        messages = cursor.fetchall()
-        
-        for msg in messages:
-            sender_id, message, file_path, file_type, timestamp, edited, deleted, msg_id = msg
-            
-            # Get sender name
-            if sender_id == self.current_user['id']:
-                sender = "You"
-            elif self.current_chat_partner:
-                sender = self.current_chat_partner['username']
-            else:
-                # For group chats, get the sender's username
-                cursor.execute("SELECT username FROM users WHERE id = ?", (sender_id,))
-                sender_result = cursor.fetchone()
-                sender = sender_result[0] if sender_result else "Unknown"
-            
-            # Format timestamp
-            time_str = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').strftime('%H:%M')
-            
-            # Create message frame
-            msg_frame = tk.Frame(self.chat_text, bg='#1a1a2e')
-            
-            # Determine message alignment and color
-            is_own_message = sender_id == self.current_user['id']
-            bg_color = '#e94560' if is_own_message else '#0f3460'
-            align = 'right' if is_own_message else 'left'
-            
-            # Message content frame
-            content_frame = tk.Frame(msg_frame, bg=bg_color, relief='raised', bd=1)
-            content_frame.pack(side=align, padx=10, pady=2, fill='x' if not is_own_message else 'none')
-            
-            # Sender and time info
-            info_text = f"{sender} • {time_str}"
-            if edited:
-                info_text += " (edited)"
-            
-            info_label = tk.Label(content_frame, text=info_text, font=('Arial', 8), 
-                                 fg='#cccccc', bg=bg_color, anchor='w')
-            info_label.pack(fill='x', padx=5, pady=(2, 0))
-            
-            # Message text or file info
-            if file_path:
-                file_name = os.path.basename(file_path)
-                file_icon = self.get_file_icon(file_type)
-                display_text = f"{file_icon} {file_name}"
-                if message:
-                    display_text = f"{message}\n{display_text}"
-            else:
-                display_text = message
-            
-            msg_label = tk.Label(content_frame, text=display_text, font=('Arial', 10), 
-                               fg='white', bg=bg_color, wraplength=300, justify='left', anchor='w')
-            msg_label.pack(fill='x', padx=5, pady=(0, 5))
-            
-            # Store message widget for context menu
-            self.message_widgets[msg_id] = {
-                'frame': content_frame,
-                'label': msg_label,
-                'sender_id': sender_id,
-                'message': message,
-                'file_path': file_path
-            }
-            
-            # Add context menu for own messages
-            if is_own_message:
-                self.add_message_context_menu(msg_label, msg_id)
-            
-            # Add click handler for file messages
-            if file_path:
-                msg_label.bind("<Button-1>", lambda e, path=file_path: self.open_file(path))
-                msg_label.config(cursor="hand2")
-            
-            # Insert message frame into chat
-            self.chat_text.window_create(tk.END, window=msg_frame)
-            self.chat_text.insert(tk.END, '\n')
-        
-        self.chat_text.config(state='disabled')
-        self.chat_text.see(tk.END)
+            messages = self.service.history_page(self.loaded_conversation, limit=self.PAGE_SIZE)
+            rows = [self.make_message_row(msg) for msg in messages]
+            has_older = len(messages) == self.PAGE_SIZE
+            self.history_cache.put(self.loaded_conversation, rows, has_older)
+        self.chat_view.set_rows(rows, has_older=has_older)
+        self.add_pending_rows()
+        self.mark_loaded_read(rows)
+        self.refresh_unread()
     
-    def add_message_context_menu(self, start_pos, end_pos, message_id, message_text, file_path):
-        """Add context menu for message editing/deletion"""
-        def show_context_menu(event):
-            context_menu = tk.Menu(self.root, tearoff=0, bg='#16213e', fg='white')
-            
-            if not file_path:  # Only allow editing text messages
-                context_menu.add_command(label="✏️ Edit Message", 
-                                       command=lambda: self.edit_message(message_id, message_text))
-            
-            context_menu.add_command(label="🗑️ Delete Message", 
-                                   command=lambda: self.delete_message(message_id))
-            
-            try:
-                context_menu.tk_popup(event.x_root, event.y_root)
-            finally:
-                context_menu.grab_release()
-        
-        # Bind right-click to the message line
-        self.chat_text.tag_add(f"msg_{message_id}", start_pos, end_pos)
-        self.chat_text.tag_bind(f"msg_{message_id}", "<Button-3>", show_context_menu)
+    def add_pending_rows(self):
+        """Show the messages and uploads still being sent in the loaded conversation, oldest first"""
+        rows = [self.make_pending_row(upload) for upload in self.pending_uploads.values()
+                if upload['conversation_id'] == self.loaded_conversation]
+        rows += [self.make_outbox_row(send) for send in self.pending_sends.values()
+                 if send['entry'].conversation_id == self.loaded_conversation]
+        # Pending ids count down from -1 as rows are created
+        for row in sorted(rows, key=lambda row: -row['id']):
+            self.chat_view.add_pending_row(row)
     
-    def edit_message(self, message_id, current_text):
-        """Edit a message"""
-        new_text = simpledialog.askstring("Edit Message", "Enter new message:", initialvalue=current_text)
+    def load_older_messages(self, before_id, limit):
+        """Chat view callback: the page of messages just before before_id"""
+        messages = self.service.history_page(self.loaded_conversation, before_id=before_id, limit=limit)
+        return [self.make_message_row(msg) for msg in messages]
+    
+    def load_newer_messages(self, after_id, limit):
+        """Chat view callback: the page of messages just after after_id"""
+        messages = self.service.history_page(self.loaded_conversation, after_id=after_id, limit=limit)
+        return [self.make_message_row(msg) for msg in messages]
+    
+    def update_chat_history(self):
+        """Apply new messages and edits/deletes since the last refresh to the view and the history cache"""
+        if not self.current_user:
+            return
         
-        if new_text and new_text != current_text:
-            try:
-                self.cursor.execute("UPDATE messages SET message = ?, edited = TRUE WHERE id = ?",
-                                   (new_text, message_id))
-                self.conn.commit()
-                self.load_chat_history()
-                messagebox.showinfo("Success", "Message edited successfully! ✏️")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to edit message: {str(e)}")
+        user_id = self.current_user['id']
+        changes = self.service.changes_since(self.last_change_seq, user_id=user_id)
+        if changes:
+            self.last_change_seq = changes[-1][0]
+            # Rows neither on screen nor cached are read fresh when needed
+            changed_ids = {message_id for seq, message_id in changes
+                           if self.chat_view.get_row(message_id) or self.history_cache.has_message(message_id)}
+            for msg_id in changed_ids:
+                msg = self.service.get_message(msg_id)
+                if msg is None or msg.deleted:
+                    self.chat_view.remove_row(msg_id)
+                    self.history_cache.remove_row(msg_id)
+                else:
+                    row = self.make_message_row(msg)
+                    self.chat_view.update_row(row)
+                    self.history_cache.update_row(row)
+        
+        new_messages = self.service.messages_since(self.last_message_id, limit=self.FEED_LIMIT, user_id=user_id)
+        if len(new_messages) == self.FEED_LIMIT:
+            # Too far behind to catch up message by message; start over from the latest pages
+            self.history_cache.clear()
+            self.last_change_seq = self.service.change_marker()
+            self.last_message_id = self.service.latest_message_id()
+            self.load_chat_history()
+            self.refresh_unread()
+            return
+        if not new_messages:
+            if changes:
+                # A deleted message may have been unread
+                self.refresh_unread()
+            return
+        
+        self.last_message_id = new_messages[-1][0].id
+        new_rows = {}
+        for msg, conversation_id in new_messages:
+            if conversation_id == self.loaded_conversation or conversation_id in self.history_cache:
+                new_rows.setdefault(conversation_id, []).append(self.make_message_row(msg))
+        for conversation_id, rows in new_rows.items():
+            self.history_cache.append_rows(conversation_id, rows)
+            if conversation_id == self.loaded_conversation:
+                # The latest page may have been read after some of these were sent
+                self.chat_view.append_rows([row for row in rows if not self.chat_view.get_row(row['id'])])
+                self.mark_loaded_read(rows)
+        self.refresh_unread()
     
-    def delete_message(self, message_id):
-        """Delete a message"""
-        if messagebox.askyesno("Confirm Delete", "Are you sure you want to delete this message?"):
-            try:
-                self.cursor.execute("UPDATE messages SET deleted = TRUE WHERE id = ?", (message_id,))
-                self.conn.commit()
-                self.load_chat_history()
-                messagebox.showinfo("Success", "Message deleted successfully! 🗑️")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to delete message: {str(e)}")
+    def format_message_info(self, sender, timestamp, edited):
+        """Build the 'sender • time' line shown above a message"""
+        time_str = datetime.datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').strftime('%H:%M')
+        info_text = f"{sender} • {time_str}"
+        if edited:
+            info_text += " (edited)"
+        return info_text
+    
+    def format_message_text(self, message, file_path, file_type):
+        """Build the body text shown for a message"""
+        if file_path:
+            file_name = os.path.basename(file_path)
+            file_icon = self.get_file_icon(file_type)
+            display_text = f"{file_icon} {file_name}"
+            if message:
+                display_text = f"{message}\n{display_text}"
+        else:
+            display_text = message
+        return display_text
+    
+    def make_message_row(self, msg):
+        """Turn a messages row into the display row used by the chat view"""
+        sender_id, message, file_path, file_type, timestamp, edited, deleted, msg_id, sender_name = msg
+        
+        # Get sender name; the history queries join it in
+        if sender_id == self.current_user['id']:
+            sender = "You"
+        else:
+            sender = sender_name or self.service.users.get(sender_id)
+        
+        return {
+            'id': msg_id,
+            'sender_id': sender_id,
+            'message': message,
+            'file_path': file_path,
+            'own': sender_id == self.current_user['id'],
+            'image': file_path if file_type == 'image' else None,
+            'info': self.format_message_info(sender, timestamp, edited),
+            'text': self.format_message_text(message, file_path, file_type)
+        }
     
     def send_message(self):
         """Send message to selected user or group"""
@@ -954,26 +1021,87 @@ class ChatApplication:
         if not message:
             return
         
+        # Saved locally and shown at once; the outbox sends it in the background
         try:
-            cursor = self.conn.cursor()
-            if self.current_chat_partner:
-                # Send to user
-                cursor.execute("""
-                    INSERT INTO messages (sender_id, receiver_id, message) 
-                    VALUES (?, ?, ?)
-                """, (self.current_user['id'], self.current_chat_partner['id'], message))
-            else:
-                # Send to group
-                cursor.execute("""
-                    INSERT INTO messages (sender_id, group_id, message) 
-                    VALUES (?, ?, ?)
-                """, (self.current_user['id'], self.current_group, message))
-            
-            self.conn.commit()
-            self.message_entry.delete(0, tk.END)
-            self.load_chat_history()
+            entry = self.outbox.add(message, **self.get_recipient())
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send message: {str(e)}")
+            return
+        self.message_entry.delete(0, tk.END)
+        self.track_pending_send(entry)
+    
+    def open_outbox(self):
+        """Start sending the user's saved messages, including those left from an earlier session"""
+        # Callbacks run on the outbox thread; hand them over to the Tk thread
+        self.outbox = Outbox(
+            self.service, self.current_user['id'],
+            on_sent=lambda entry, message_id: self.root.after(0, self.on_message_sent, entry),
+            on_failed=lambda entry, error: self.root.after(0, self.on_message_failed, entry, error),
+            on_retry=lambda entry, error, delay: self.root.after(0, self.on_message_retry, entry))
+        for entry in self.outbox.pending():
+            self.track_pending_send(entry)
+    
+    def close_outbox(self):
+        """Stop sending; unsent messages are kept for the next login"""
+        if self.outbox is not None:
+            # Its callbacks wait for this thread, so don't wait for it
+            self.outbox.close(wait=False)
+            self.outbox = None
+        self.pending_sends.clear()
+    
+    def track_pending_send(self, entry):
+        """Show a pending bubble for an outbox message until the service has stored it"""
+        self.pending_counter += 1
+        send = {'id': -self.pending_counter, 'entry': entry, 'status': 'sending…'}
+        self.pending_sends[entry.client_id] = send
+        if entry.conversation_id == self.loaded_conversation:
+            self.chat_view.add_pending_row(self.make_outbox_row(send))
+    
+    def make_outbox_row(self, send):
+        """Display row for a message waiting in the outbox"""
+        return {
+            'id': send['id'],
+            'sender_id': self.current_user['id'],
+            'message': send['entry'].message,
+            'file_path': None,
+            'own': True,
+            'pending': True,
+            'info': f"You • {send['status']}",
+            'text': send['entry'].message
+        }
+    
+    def on_message_sent(self, entry):
+        """Replace the pending bubble with the stored message, with its id and timestamp"""
+        send = self.pending_sends.pop(entry.client_id, None)
+        if send is None:
+            return
+        if entry.conversation_id == self.loaded_conversation:
+            self.chat_view.remove_row(send['id'])
+            # Same callback, so both changes show up in the same frame
+            self.update_chat_history()
+    
+    def on_message_failed(self, entry, error):
+        send = self.pending_sends.pop(entry.client_id, None)
+        if send is None:
+            return
+        if entry.conversation_id == self.loaded_conversation:
+            self.chat_view.remove_row(send['id'])
+        messagebox.showerror("Error", f"Failed to send message: {str(error)}")
+    
+    def on_message_retry(self, entry):
+        """Mark a bubble whose message could not be delivered yet; the outbox keeps trying"""
+        send = self.pending_sends.get(entry.client_id)
+        if send is None or send['status'] != 'sending…':
+            return
+        send['status'] = 'waiting to send…'
+        if entry.conversation_id == self.loaded_conversation:
+            self.chat_view.update_row(self.make_outbox_row(send))
+    
+    def get_recipient(self):
+        """Keyword arguments addressing the selected user or group in the chat service"""
+        if self.current_chat_partner:
+            return {'receiver_id': self.current_chat_partner['id']}
+        return {'group_id': self.current_group}
     
     def attach_file(self):
         """Attach file to message"""
@@ -992,63 +1120,71 @@ class ChatApplication:
         )
         
         if file_path:
-            # Get file info
-            file_name = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-            
-            # Check file size (limit to 50MB)
-            if file_size > 50 * 1024 * 1024:
-                messagebox.showerror("Error", "File size too large! Maximum size is 50MB.")
-                return
-            
-            # Determine file type
-            file_ext = os.path.splitext(file_name)[1].lower()
-            if file_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-                file_type = 'image'
-            elif file_ext in ['.mp4', '.avi', '.mov', '.wmv']:
-                file_type = 'video'
-            else:
-                file_type = 'document'
-            
-            # Create attachments directory if it doesn't exist
-            attachments_dir = os.path.join(os.path.dirname(__file__), 'attachments')
-            os.makedirs(attachments_dir, exist_ok=True)
-            
-            # Copy file to attachments directory
-            new_path = os.path.join(attachments_dir, f"{int(time.time())}_{file_name}")
-            shutil.copy2(file_path, new_path)
-            
             # Get optional message text
             message_text = self.message_entry.get().strip()
-            
-            try:
-                cursor = self.conn.cursor()
-                if self.current_chat_partner:
-                    # Send file to user
-                    cursor.execute("""
-                        INSERT INTO messages (sender_id, receiver_id, message, file_path, file_type) 
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (self.current_user['id'], self.current_chat_partner['id'], 
-                          message_text, new_path, file_type))
-                else:
-                    # Send file to group
-                    cursor.execute("""
-                        INSERT INTO messages (sender_id, group_id, message, file_path, file_type) 
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (self.current_user['id'], self.current_group, 
-                          message_text, new_path, file_type))
-                
-                self.conn.commit()
-                
-                self.message_entry.delete(0, tk.END)
-                self.load_chat_history()
-                messagebox.showinfo("Success", f"File '{file_name}' attached successfully!")
-                
-            except Exception as e:
-                # Clean up copied file if database insert fails
-                if os.path.exists(new_path):
-                    os.remove(new_path)
-                messagebox.showerror("Error", f"Failed to attach file: {str(e)}")
+            self.message_entry.delete(0, tk.END)
+            self.start_upload(file_path, message_text)
+    
+    def start_upload(self, file_path, message_text):
+        """Copy an attachment in the background, showing a pending bubble until it is sent"""
+        # Real message ids are positive, so pending rows can never clash with them
+        self.pending_counter += 1
+        pending_id = -self.pending_counter
+        upload = {
+            'id': pending_id,
+            'conversation_id': self.get_conversation_id(),
+            'file_name': os.path.basename(file_path),
+            'message': message_text,
+            'percent': 0
+        }
+        self.pending_uploads[pending_id] = upload
+        self.chat_view.add_pending_row(self.make_pending_row(upload))
+        
+        # Both callbacks run on a worker thread; hand them over to the Tk thread
+        future = self.service.attach_file_async(
+            self.current_user['id'], file_path, message_text,
+            on_progress=lambda copied, total: self.root.after(0, self.on_upload_progress,
+                                                              pending_id, copied, total),
+            **self.get_recipient())
+        future.add_done_callback(lambda f: self.root.after(0, self.on_upload_done, pending_id, f))
+    
+    def make_pending_row(self, upload):
+        """Display row for an attachment that is still being copied"""
+        return {
+            'id': upload['id'],
+            'sender_id': self.current_user['id'],
+            'message': upload['message'],
+            'file_path': None,
+            'own': True,
+            'pending': True,
+            'info': f"You • sending {upload['percent']}%",
+            'text': self.format_message_text(upload['message'], upload['file_name'],
+                                             get_file_type(upload['file_name']))
+        }
+    
+    def on_upload_progress(self, pending_id, copied, total):
+        upload = self.pending_uploads.get(pending_id)
+        percent = copied * 100 // total if total else 100
+        if upload is None or percent == upload['percent']:
+            return
+        upload['percent'] = percent
+        if upload['conversation_id'] == self.loaded_conversation:
+            self.chat_view.update_row(self.make_pending_row(upload))
+    
+    def on_upload_done(self, pending_id, future):
+        upload = self.pending_uploads.pop(pending_id, None)
+        if upload is None:
+            return
+        if upload['conversation_id'] == self.loaded_conversation:
+            self.chat_view.remove_row(pending_id)
+        
+        error = future.exception()
+        if isinstance(error, ChatError):
+            messagebox.showerror("Error", str(error))
+        elif error is not None:
+            messagebox.showerror("Error", f"Failed to attach '{upload['file_name']}': {str(error)}")
+        else:
+            self.update_chat_history()
     
     def get_file_icon(self, file_type):
         """Get appropriate icon for file type"""
@@ -1069,26 +1205,26 @@ class ChatApplication:
         except Exception as e:
             messagebox.showerror("Error", f"Failed to open file: {str(e)}")
     
-    def add_message_context_menu(self, widget, msg_id):
-        """Add context menu to message widget"""
-        context_menu = tk.Menu(self.root, tearoff=0)
-        context_menu.add_command(label="✏️ Edit", command=lambda: self.edit_message(msg_id))
-        context_menu.add_command(label="🗑️ Delete", command=lambda: self.delete_message(msg_id))
+    def show_message_menu(self, row, event):
+        """Chat view callback: context menu for own messages"""
+        if not row['own'] or row.get('pending'):
+            return
         
-        def show_context_menu(event):
-            try:
-                context_menu.tk_popup(event.x_root, event.y_root)
-            finally:
-                context_menu.grab_release()
+        context_menu = tk.Menu(self.root, tearoff=0)
+        context_menu.add_command(label="✏️ Edit", command=lambda: self.edit_message(row['id']))
+        context_menu.add_command(label="🗑️ Delete", command=lambda: self.delete_message(row['id']))
         
-        widget.bind("<Button-3>", show_context_menu)  # Right click
+        try:
+            context_menu.tk_popup(event.x_root, event.y_root)
+        finally:
+            context_menu.grab_release()
     
     def edit_message(self, msg_id):
         """Edit a message"""
-        if msg_id not in self.message_widgets:
+        msg_data = self.chat_view.get_row(msg_id)
+        if msg_data is None:
             return
-        
-        msg_data = self.message_widgets[msg_id]
+
         if msg_data['file_path']:
             messagebox.showwarning("Warning", "Cannot edit messages with file attachments!")
             return
@@ -1122,12 +1258,11 @@ class ChatApplication:
             new_message = text_var.get().strip()
             if new_message and new_message != msg_data['message']:
                 try:
-                    cursor = self.conn.cursor()
-                    cursor.execute("UPDATE messages SET message = ?, edited = TRUE WHERE id = ?", 
-                                 (new_message, msg_id))
-                    self.conn.commit()
+                    self.service.edit_message(self.current_user['id'], msg_id, new_message)
                     dialog.destroy()
-                    self.load_chat_history()
+                    self.update_chat_history()
+                except ChatError as e:
+                    messagebox.showerror("Error", str(e))
                 except Exception as e:
                     messagebox.showerror("Error", f"Failed to edit message: {str(e)}")
             else:
@@ -1148,10 +1283,10 @@ class ChatApplication:
         """Delete a message"""
         if messagebox.askyesno("Confirm Delete", "Are you sure you want to delete this message?"):
             try:
-                cursor = self.conn.cursor()
-                cursor.execute("UPDATE messages SET deleted = TRUE WHERE id = ?", (msg_id,))
-                self.conn.commit()
-                self.load_chat_history()
+                self.service.delete_message(self.current_user['id'], msg_id)
+                self.update_chat_history()
+            except ChatError as e:
+                messagebox.showerror("Error", str(e))
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to delete message: {str(e)}")
     
@@ -1162,17 +1297,26 @@ class ChatApplication:
             self.chat_refresh_thread.start()
     
     def refresh_chat_loop(self):
-        """Background loop to refresh chat every 2 seconds"""
+        """Background loop that refreshes the chat and the history cache whenever anything changes"""
+        version = self.service.notifier.version(ANY_CONVERSATION)
         while self.refresh_chat:
-            time.sleep(2)
-            if (self.current_chat_partner or self.current_group) and self.refresh_chat:
-                self.root.after(0, self.load_chat_history)
+            # The timeout only bounds how long a logout goes unnoticed
+            new_version = self.service.notifier.wait(ANY_CONVERSATION, version, timeout=1.0)
+            if new_version != version and self.refresh_chat:
+                version = new_version
+                self.root.after(0, self.update_chat_history)
     
     def logout(self):
         """Logout current user"""
         self.refresh_chat = False
+        self.stop_presence()
+        self.close_outbox()
         self.current_user = None
         self.current_chat_partner = None
+        self.current_group = None
+        self.loaded_conversation = None
+        self.unread_counts = {}
+        self.root.title(f"Cacasians Chat Application v{self.VERSION}")
         messagebox.showinfo("Goodbye", "Thanks for using Cacasians Chat! 👋")
         self.show_login_screen()
     
@@ -1180,8 +1324,12 @@ class ChatApplication:
         """Start the application"""
         self.root.mainloop()
         self.refresh_chat = False
-        if self.conn:
-            self.conn.close()
+        if self.current_user:
+            # Queued writes are committed by close()
+            self.service.go_offline(self.current_user['id'])
+        self.close_outbox()
+        self.thumbnails.close()
+        self.service.close()
 
 if __name__ == "__main__":
     app = ChatApplication()
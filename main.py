@@ -1,14 +1,16 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-import sqlite3
-import hashlib
 import datetime
 import threading
 import time
 import os
-import shutil
-from PIL import Image, ImageTk
 import json
+import chat_db
+from chat_service import ChatService, get_file_type
+from chat_client import ChatClient
+from chat_outbox import Outbox
+from chat_presence import HEARTBEAT_INTERVAL
+from chat_thumbnails import ThumbnailCache
 
 class ChatApplication:
     def __init__(self):
@@ -28,6 +30,12 @@ class ChatApplication:
         self.chat_refresh_thread = None
         self.refresh_chat = False
         
+        # Messages saved locally and sent in the background
+        self.outbox = None
+        
+        # Heartbeats keep the user shown as online to others
+        self.heartbeat_job = None
+        
         # Create main container
         self.main_frame = tk.Frame(self.root, bg='#1a1a2e')
         self.main_frame.pack(fill='both', expand=True)
@@ -37,38 +45,17 @@ class ChatApplication:
         
     def init_database(self):
         """Initialize SQLite database"""
-        self.conn = sqlite3.connect('chat_app.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        
-        # Create users table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password TEXT NOT NULL,
-                email TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Create messages table
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER,
-                receiver_id INTEGER,
-                message TEXT,
-                file_path TEXT,
-                file_type TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                edited BOOLEAN DEFAULT FALSE,
-                deleted BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (sender_id) REFERENCES users (id),
-                FOREIGN KEY (receiver_id) REFERENCES users (id)
-            )
-        ''')
-        
-        self.conn.commit()
+        # All database access goes through the service, or a chat server if CHAT_SERVER is set
+        server_address = os.environ.get('CHAT_SERVER')
+        if server_address:
+            self.service = ChatClient(server_address)
+        else:
+            self.service = ChatService(chat_db.DATABASE_PATH)
+        
+        # Inline image previews
+        self.thumbnails = ThumbnailCache(self.root, os.path.join(self.service.attachments_dir, 'thumbnails'))
+        self.chat_images = []  # Thumbnails shown in the chat, kept alive while displayed
+        self.reload_pending = False
     
     def clear_frame(self):
         """Clear all widgets from main frame"""
@@ -217,58 +204,35 @@ class ChatApplication:
         back_btn.pack(side='right', padx=10)
         self.animate_button(back_btn)
     
-    def hash_password(self, password):
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
-    
     def register(self):
-        """Register new user"""
-        username = self.reg_username_entry.get().strip()
-        email = self.reg_email_entry.get().strip()
-        password = self.reg_password_entry.get()
-        confirm_password = self.reg_confirm_entry.get()
-        
-        if not username or not password:
-            messagebox.showerror("Error", "Username and password are required!")
-            return
-        
-        if password != confirm_password:
-            messagebox.showerror("Error", "Passwords do not match!")
-            return
-        
-        if len(password) < 6:
-            messagebox.showerror("Error", "Password must be at least 6 characters!")
+        """Register new user; the password is hashed on a worker thread"""
+        future = self.service.register_async(self.reg_username_entry.get(), self.reg_password_entry.get(),
+                                             email=self.reg_email_entry.get(),
+                                             confirm_password=self.reg_confirm_entry.get())
+        future.add_done_callback(lambda f: self.root.after(0, self.on_register_done, f))
+    
+    def on_register_done(self, future):
+        """Report the result of a background registration"""
+        error = future.exception()
+        if error is not None:
+            messagebox.showerror("Error", str(error))
             return
-        
-        try:
-            hashed_password = self.hash_password(password)
-            self.cursor.execute("INSERT INTO users (username, password, email) VALUES (?, ?, ?)",
-                               (username, hashed_password, email))
-            self.conn.commit()
-            messagebox.showinfo("Success", "Account created successfully!")
-            self.show_login_screen()
-        except sqlite3.IntegrityError:
-            messagebox.showerror("Error", "Username already exists!")
+        messagebox.showinfo("Success", "Account created successfully!")
+        self.show_login_screen()
     
     def login(self):
-        """Login user"""
-        username = self.username_entry.get().strip()
-        password = self.password_entry.get()
-        
-        if not username or not password:
-            messagebox.showerror("Error", "Please enter username and password!")
+        """Login user; the password is checked on a worker thread"""
+        future = self.service.login_async(self.username_entry.get(), self.password_entry.get())
+        future.add_done_callback(lambda f: self.root.after(0, self.on_login_done, f))
+    
+    def on_login_done(self, future):
+        """Open the chat after a background login"""
+        error = future.exception()
+        if error is not None:
+            messagebox.showerror("Error", str(error))
             return
-        
-        hashed_password = self.hash_password(password)
-        self.cursor.execute("SELECT id, username FROM users WHERE username = ? AND password = ?",
-                           (username, hashed_password))
-        user = self.cursor.fetchone()
-        
-        if user:
-            self.current_user = {'id': user[0], 'username': user[1]}
-            self.show_chat_screen()
-        else:
-            messagebox.showerror("Error", "Invalid username or password!")
+        self.current_user = future.result()
+        self.show_chat_screen()
     
     def show_chat_screen(self):
         """Display main chat interface"""
@@ -361,23 +325,43 @@ class ChatApplication:
         # Load users and start chat refresh
         self.load_users()
         self.start_chat_refresh()
+        self.keep_online()
+        
+        # Callbacks run on the outbox thread; hand them over to the Tk thread
+        self.outbox = Outbox(self.service, self.current_user['id'],
+                             on_sent=lambda entry, message_id: self.root.after(0, self.schedule_history_reload),
+                             on_failed=lambda entry, error: self.root.after(0, self.on_send_failed, error))
+    
+    def on_send_failed(self, error):
+        self.schedule_history_reload()
+        messagebox.showerror("Error", f"Failed to send message: {str(error)}")
+    
+    def close_outbox(self):
+        """Stop sending; unsent messages are kept for the next login"""
+        if self.outbox is not None:
+            # Its callbacks wait for this thread, so don't wait for it
+            self.outbox.close(wait=False)
+            self.outbox = None
+    
+    def keep_online(self):
+        """Heartbeat every HEARTBEAT_INTERVAL while logged in"""
+        self.service.heartbeat(self.current_user['id'])
+        self.heartbeat_job = self.root.after(int(HEARTBEAT_INTERVAL * 1000), self.keep_online)
     
     def load_users(self):
         """Load all users except current user"""
         self.users_listbox.delete(0, tk.END)
-        self.cursor.execute("SELECT id, username FROM users WHERE id != ?", (self.current_user['id'],))
-        users = self.cursor.fetchall()
+        # (id, username) of every row, in list order
+        self.listed_users = self.service.list_users(exclude_id=self.current_user['id'])
         
-        for user in users:
+        for user in self.listed_users:
             self.users_listbox.insert(tk.END, user[1])
             
     def select_user(self, event):
         """Select user to chat with"""
         selection = self.users_listbox.curselection()
         if selection:
-            username = self.users_listbox.get(selection[0])
-            self.cursor.execute("SELECT id FROM users WHERE username = ?", (username,))
-            user_id = self.cursor.fetchone()[0]
+            user_id, username = self.listed_users[selection[0]]
             self.current_chat_partner = {'id': user_id, 'username': username}
             self.chat_header.config(text=f"Chatting with {username}")
             self.load_chat_history()
@@ -389,20 +373,14 @@ class ChatApplication:
         
         self.chat_text.config(state='normal')
         self.chat_text.delete(1.0, tk.END)
+        self.chat_images = []
         
-        self.cursor.execute("""
-            SELECT sender_id, message, file_path, file_type, timestamp, edited, deleted, id
-            FROM messages 
-            WHERE ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
-            AND deleted = FALSE
-            ORDER BY timestamp
-        """, (self.current_user['id'], self.current_chat_partner['id'],
-              self.current_chat_partner['id'], self.current_user['id']))
-        
-        messages = self.cursor.fetchall()
+        conversation_id = chat_db.direct_conversation_id(self.current_user['id'],
+                                                         self.current_chat_partner['id'])
+        messages = self.service.history(conversation_id)
         
         for msg in messages:
-            sender_id, message, file_path, file_type, timestamp, edited, deleted, msg_id = msg
+            sender_id, message, file_path, file_type, timestamp, edited, deleted, msg_id, sender_name = msg
             sender = "You" if sender_id == self.current_user['id'] else self.current_chat_partner['username']
             
             # Format timestamp
@@ -419,13 +397,36 @@ class ChatApplication:
             
             self.chat_text.insert(tk.END, display_text + "\n")
             
+            # Preview images once their thumbnail is ready
+            if file_type == 'image':
+                photo = self.thumbnails.get(file_path, self.schedule_history_reload)
+                if photo is not None:
+                    self.chat_images.append(photo)
+                    self.chat_text.image_create(tk.END, image=photo, padx=4, pady=2)
+                    self.chat_text.insert(tk.END, "\n")
+            
             # Add right-click menu for own messages
             if sender_id == self.current_user['id']:
                 self.add_message_context_menu(msg_id)
         
+        # Messages still in the outbox go last until they are stored
+        for entry in self.outbox.pending():
+            if entry.conversation_id == conversation_id:
+                self.chat_text.insert(tk.END, f"[--:--] You: {entry.message} (sending…)\n")
+        
         self.chat_text.config(state='disabled')
         self.chat_text.see(tk.END)
     
+    def schedule_history_reload(self):
+        """Reload the chat once for any number of thumbnails that became ready"""
+        if not self.reload_pending:
+            self.reload_pending = True
+            self.root.after_idle(self.reload_history)
+    
+    def reload_history(self):
+        self.reload_pending = False
+        self.load_chat_history()
+    
     def add_message_context_menu(self, message_id):
         """Add context menu for message editing/deletion"""
         # This is a simplified version - in a full implementation,
@@ -442,17 +443,14 @@ class ChatApplication:
         if not message:
             return
         
+        # Saved locally and shown at once; the outbox sends it in the background
         try:
-            self.cursor.execute("""
-                INSERT INTO messages (sender_id, receiver_id, message) 
-                VALUES (?, ?, ?)
-            """, (self.current_user['id'], self.current_chat_partner['id'], message))
-            self.conn.commit()
-            
-            self.message_entry.delete(0, tk.END)
-            self.load_chat_history()
+            self.outbox.add(message, receiver_id=self.current_chat_partner['id'])
         except Exception as e:
             messagebox.showerror("Error", f"Failed to send message: {str(e)}")
+            return
+        self.message_entry.delete(0, tk.END)
+        self.load_chat_history()
     
     def attach_file(self):
         """Attach file to message"""
@@ -471,37 +469,20 @@ class ChatApplication:
         )
         
         if file_path:
-            # Create attachments directory if it doesn't exist
-            attachments_dir = "attachments"
-            if not os.path.exists(attachments_dir):
-                os.makedirs(attachments_dir)
-            
-            # Copy file to attachments directory
-            filename = os.path.basename(file_path)
-            new_path = os.path.join(attachments_dir, f"{int(time.time())}_{filename}")
-            shutil.copy2(file_path, new_path)
-            
-            # Determine file type
-            file_ext = os.path.splitext(filename)[1].lower()
-            if file_ext in ['.png', '.jpg', '.jpeg', '.gif', '.bmp']:
-                file_type = 'image'
-            elif file_ext in ['.mp4', '.avi', '.mov', '.wmv']:
-                file_type = 'video'
-            else:
-                file_type = 'document'
-            
-            try:
-                self.cursor.execute("""
-                    INSERT INTO messages (sender_id, receiver_id, message, file_path, file_type) 
-                    VALUES (?, ?, ?, ?, ?)
-                """, (self.current_user['id'], self.current_chat_partner['id'], 
-                      f"Sent a {file_type}", new_path, file_type))
-                self.conn.commit()
-                
-                self.load_chat_history()
-                messagebox.showinfo("Success", "File attached successfully!")
-            except Exception as e:
-                messagebox.showerror("Error", f"Failed to attach file: {str(e)}")
+            # Copied in the background so the window stays responsive
+            file_type = get_file_type(file_path)
+            future = self.service.attach_file_async(self.current_user['id'], file_path, f"Sent a {file_type}",
+                                                    receiver_id=self.current_chat_partner['id'])
+            future.add_done_callback(lambda f: self.root.after(0, self.on_attach_done, f))
+    
+    def on_attach_done(self, future):
+        """Report the result of a background attachment"""
+        error = future.exception()
+        if error is not None:
+            messagebox.showerror("Error", f"Failed to attach file: {str(error)}")
+            return
+        self.load_chat_history()
+        messagebox.showinfo("Success", "File attached successfully!")
     
     def start_chat_refresh(self):
         """Start background thread to refresh chat"""
@@ -519,6 +500,11 @@ class ChatApplication:
     def logout(self):
         """Logout current user"""
         self.refresh_chat = False
+        self.close_outbox()
+        if self.heartbeat_job is not None:
+            self.root.after_cancel(self.heartbeat_job)
+            self.heartbeat_job = None
+        self.service.go_offline(self.current_user['id'])
         self.current_user = None
         self.current_chat_partner = None
         self.show_login_screen()
@@ -527,8 +513,12 @@ class ChatApplication:
         """Start the application"""
         self.root.mainloop()
         self.refresh_chat = False
-        if self.conn:
-            self.conn.close()
+        if self.current_user:
+            # Queued writes are committed by close()
+            self.service.go_offline(self.current_user['id'])
+        self.close_outbox()
+        self.thumbnails.close()
+        self.service.close()
 
 if __name__ == "__main__":
     app = ChatApplication()
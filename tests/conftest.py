@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root, as for the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Cheap hashes, as in the benchmarks: tests register many users
+TEST_PASSWORD_COST = {'n': 2 ** 10, 'r': 8, 'p': 1}
+
+
+@pytest.fixture
+def service(tmp_path):
+    from chat_service import ChatService
+    service = ChatService(str(tmp_path / 'chat.db'), attachments_dir=str(tmp_path / 'attachments'),
+                          password_cost=TEST_PASSWORD_COST)
+    yield service
+    service.close()
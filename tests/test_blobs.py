@@ -0,0 +1,94 @@
+import os
+
+import chat_blobs
+from chat_blobs import BlobStore
+
+
+def write_file(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_identical_content_is_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'))
+    first, digest, size = store.store(write_file(tmp_path / 'a' / 'photo.jpg', b'same bytes'))
+    second, second_digest, _ = store.store(write_file(tmp_path / 'b' / 'copy.jpg', b'same bytes'))
+    again, _, _ = store.store(write_file(tmp_path / 'c' / 'photo.jpg', b'same bytes'))
+
+    assert digest == second_digest and size == len(b'same bytes')
+    assert os.path.dirname(first) == os.path.dirname(second) == store.blob_dir(digest)
+    assert again == first
+    assert sorted(os.listdir(store.blob_dir(digest))) == ['copy.jpg', 'photo.jpg']
+    # Both names share one file on disk
+    assert os.stat(first).st_ino == os.stat(second).st_ino
+
+    _, other_digest, _ = store.store(write_file(tmp_path / 'd' / 'photo.jpg', b'other bytes'))
+    assert other_digest != digest
+
+
+def test_unchanged_source_is_not_read_again(tmp_path, monkeypatch):
+    store = BlobStore(str(tmp_path / 'store'))
+    source = write_file(tmp_path / 'photo.jpg', b'x' * 1000)
+    stored, digest, _ = store.store(source)
+
+    progress = []
+    monkeypatch.setattr(chat_blobs.hashlib, 'sha256', None)
+    assert store.store(source, on_progress=lambda copied, total: progress.append(copied)) == (stored, digest, 1000)
+    assert progress == [1000]
+
+
+def test_copy_when_links_are_unsupported(tmp_path, monkeypatch):
+    def no_link(source, target):
+        raise OSError("Invalid cross-device link")
+
+    store = BlobStore(str(tmp_path / 'store'))
+    first, digest, _ = store.store(write_file(tmp_path / 'a.txt', b'content'))
+    monkeypatch.setattr(chat_blobs.os, 'link', no_link)
+
+    # A reflink when the filesystem can clone
+    reflinked = []
+    monkeypatch.setattr(chat_blobs, 'reflink', lambda source, target: reflinked.append(target) or False)
+    second, _, _ = store.store(write_file(tmp_path / 'b.txt', b'content'))
+    assert len(reflinked) == 1
+    # Else a plain copy, without leftover temporary files
+    assert open(second, 'rb').read() == b'content'
+    assert os.stat(first).st_ino != os.stat(second).st_ino
+    assert sorted(os.listdir(store.blob_dir(digest))) == ['a.txt', 'b.txt']
+
+
+def test_remove_prunes_empty_directories(tmp_path):
+    store = BlobStore(str(tmp_path / 'store'))
+    first, digest, _ = store.store(write_file(tmp_path / 'a.txt', b'content'))
+    second, _, _ = store.store(write_file(tmp_path / 'b.txt', b'content'))
+
+    store.remove(first)
+    assert os.listdir(store.blob_dir(digest)) == ['b.txt']
+    store.remove(second)
+    assert not os.path.exists(os.path.dirname(os.path.dirname(store.blob_dir(digest))))
+    assert os.path.isdir(store.root)
+
+
+def test_attachments_are_collected_once_no_message_references_them(service, tmp_path):
+    alice, bob = (service.register(username, 'password1') for username in ('alice', 'bob'))
+    source = write_file(tmp_path / 'photo.jpg', b'image bytes')
+    first = service.attach_file(alice, source, receiver_id=bob)
+    second = service.attach_file(alice, source, receiver_id=bob)
+    file_path = service.get_message(first).file_path
+
+    def refcount():
+        return service.db.reader().execute(
+            "SELECT refcount FROM attachment_files WHERE file_path = ?", (file_path,)).fetchone()
+
+    assert refcount() == (2,)
+    service.delete_message(alice, first)
+    assert refcount() == (1,)
+    # A cutoff an hour ahead makes files registered just now collectable
+    assert service.collect_attachments(grace='+1 hour') == 0
+    assert os.path.exists(file_path)
+
+    service.delete_message(alice, second)
+    assert refcount() == (0,)
+    assert service.collect_attachments(grace='+1 hour') == 1
+    assert refcount() is None
+    assert not os.path.exists(file_path)
@@ -0,0 +1,59 @@
+import concurrent.futures
+import threading
+
+from chat_outbox import Outbox
+
+
+class UnansweredService:
+    """Leaves the first attempt of every message unanswered, like a dead connection"""
+
+    def __init__(self):
+        self.attempts = []
+        self.stored = {}
+
+    def queue_message(self, sender_id, message, receiver_id=None, group_id=None, client_id=None):
+        self.attempts.append(client_id)
+        future = concurrent.futures.Future()
+        if self.attempts.count(client_id) > 1:
+            future.set_result(self.stored.setdefault(client_id, len(self.stored) + 1))
+        return future
+
+
+class LostConnectionService(UnansweredService):
+    """Fails the first attempt of every message with ConnectionError"""
+
+    def queue_message(self, sender_id, message, receiver_id=None, group_id=None, client_id=None):
+        if client_id not in self.attempts:
+            self.attempts.append(client_id)
+            raise ConnectionError("Connection to the chat server was lost")
+        return super().queue_message(sender_id, message, receiver_id, group_id, client_id)
+
+
+def send_through(service, tmp_path):
+    sent = threading.Event()
+    retries = []
+    outbox = Outbox(service, 1, path=str(tmp_path / 'outbox.db'), retry_delay=0.01, send_timeout=0.05,
+                    on_sent=lambda entry, message_id: sent.set(),
+                    on_retry=lambda entry, error, delay: retries.append(error))
+    try:
+        entry = outbox.add('hello', receiver_id=2)
+        assert sent.wait(5)
+        assert outbox.pending() == []
+    finally:
+        outbox.close()
+    return entry, retries
+
+
+def test_unanswered_send_is_retried(tmp_path):
+    service = UnansweredService()
+    entry, retries = send_through(service, tmp_path)
+    assert isinstance(retries[0], concurrent.futures.TimeoutError)
+    assert service.attempts == [entry.client_id, entry.client_id]
+    assert list(service.stored) == [entry.client_id]
+
+
+def test_lost_connection_is_retried(tmp_path):
+    service = LostConnectionService()
+    entry, retries = send_through(service, tmp_path)
+    assert isinstance(retries[0], ConnectionError)
+    assert list(service.stored) == [entry.client_id]
@@ -0,0 +1,76 @@
+import time
+
+from chat_presence import PresenceTracker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_heartbeat_after_lapsed_ttl_comes_back_online():
+    clock = Clock()
+    tracker = PresenceTracker(ttl=60, clock=clock)
+    assert tracker.heartbeat(1)
+    clock.now = 30
+    assert not tracker.heartbeat(1)
+    # The TTL ran out but no sweep has removed the user yet
+    clock.now = 95
+    assert not tracker.is_online(1)
+    assert tracker.online() == []
+    assert tracker.heartbeat(1)
+    assert tracker.expire() == []
+    assert tracker.is_online(1)
+
+
+def test_expire_takes_lapsed_users_offline_in_order():
+    clock = Clock()
+    tracker = PresenceTracker(ttl=60, clock=clock)
+    tracker.heartbeat(1)
+    clock.now = 10
+    tracker.heartbeat(2)
+    clock.now = 65
+    assert tracker.expire() == [1]
+    assert tracker.online() == [2]
+
+
+def test_local_presence_is_read_again_only_after_changes(service, monkeypatch):
+    alice, bob = (service.register(username, 'password1') for username in ('alice', 'bob'))
+    assert service.online_users() == frozenset()
+
+    service.heartbeat(alice)
+    service.writes.submit("SELECT 1").result()  # Queued after the heartbeat
+    assert service.online_users() == {alice}
+
+    # Unchanged presence is served without a query
+    monkeypatch.setattr(service.db, 'reader', None)
+    assert service.online_users() == {alice}
+    monkeypatch.undo()
+
+    service.go_offline(alice).result()
+    assert service.online_users() == frozenset()
+
+
+def test_local_presence_sees_other_processes(service, tmp_path):
+    from chat_service import ChatService
+    from conftest import TEST_PASSWORD_COST
+    alice = service.register('alice', 'password1')
+    assert service.online_users() == frozenset()
+    service.start()
+    commits = service.notifier.commits
+
+    other = ChatService(service.db.path, attachments_dir=str(tmp_path / 'attachments'),
+                        password_cost=TEST_PASSWORD_COST)
+    try:
+        other.heartbeat(alice)
+        other.writes.submit("SELECT 1").result()
+    finally:
+        other.close()
+    for _ in range(100):
+        if service.notifier.commits != commits:
+            break
+        time.sleep(0.01)
+    assert service.online_users() == {alice}
@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+import chat_protocol
+
+
+def read_frame(data):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await chat_protocol.read_frame(reader)
+    return asyncio.run(read())
+
+
+def test_frame_round_trip():
+    frame = chat_protocol.encode_frame({'id': 1, 'op': 'send', 'args': {'message': 'héllo'}})
+    assert read_frame(frame) == ({'id': 1, 'op': 'send', 'args': {'message': 'héllo'}}, chat_protocol.JSON)
+
+
+def test_end_of_stream_between_frames():
+    assert read_frame(b'') == (None, None)
+
+
+def test_truncated_frame():
+    frame = chat_protocol.encode_frame({'id': 1, 'op': 'latest_message_id', 'args': {}})
+    with pytest.raises(chat_protocol.ProtocolError):
+        read_frame(frame[:-3])
+
+
+def test_invalid_json_body():
+    body = b'{"id": 1, "op":'
+    with pytest.raises(chat_protocol.ProtocolError):
+        read_frame(chat_protocol.HEADER.pack(len(body), chat_protocol.JSON) + body)
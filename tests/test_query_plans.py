@@ -0,0 +1,9 @@
+import sqlite3
+
+import chat_db
+
+
+def test_hot_queries_use_their_indexes():
+    conn = sqlite3.connect(':memory:')
+    assert chat_db.migrate(conn) == len(chat_db.MIGRATIONS)
+    chat_db.check_query_plans(conn)
@@ -0,0 +1,39 @@
+import pytest
+
+import chat_service
+from chat_service import ChatError
+
+
+@pytest.fixture
+def users(service):
+    return [service.register(username, 'password1') for username in ('alice', 'bob')]
+
+
+def test_search_ranks_matches_in_own_conversations(service, users):
+    alice, bob = users
+    service.send_message(alice, 'lunch lunch lunch today?', receiver_id=bob)
+    service.send_message(bob, 'no lunch for me', receiver_id=alice)
+    service.send_message(bob, 'unrelated', receiver_id=alice)
+    carol = service.register('carol', 'password1')
+    service.send_message(carol, 'lunch with dave', receiver_id=service.register('dave', 'password1'))
+
+    page = service.search_messages(alice, 'lunch')
+    assert [result.message.message for result in page.results] == ['lunch lunch lunch today?', 'no lunch for me']
+    assert not page.truncated
+    with pytest.raises(ChatError):
+        service.search_messages(alice, 'lu')
+
+
+def test_search_reports_matches_beyond_the_window(service, users, monkeypatch):
+    alice, bob = users
+    monkeypatch.setattr(chat_service, 'SEARCH_WINDOW', 3)
+    for i in range(3):
+        service.send_message(alice, f'report {i}', receiver_id=bob)
+    page = service.search_messages(alice, 'report')
+    assert len(page.results) == 3 and not page.truncated
+
+    service.send_message(alice, 'report 3', receiver_id=bob)
+    page = service.search_messages(alice, 'report', limit=2, offset=2)
+    # The oldest match is left out, and the page says so
+    assert [result.message.message for result in page.results] == ['report 1']
+    assert page.truncated
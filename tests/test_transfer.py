@@ -0,0 +1,107 @@
+import io
+import sqlite3
+
+import chat_db
+import chat_transfer
+
+MESSAGES_QUERY = """
+    SELECT s.username, r.username, g.name, m.message, m.edited, m.deleted
+    FROM messages m JOIN users s ON s.id = m.sender_id
+    LEFT JOIN users r ON r.id = m.receiver_id LEFT JOIN groups g ON g.id = m.group_id
+    ORDER BY m.id
+"""
+MEMBERS_QUERY = """
+    SELECT g.name, u.username, m.is_admin, g.member_count
+    FROM group_members m JOIN groups g ON g.id = m.group_id JOIN users u ON u.id = m.user_id
+    ORDER BY g.name, u.username
+"""
+# Each counter against a count of the messages it stands for
+COUNTERS_QUERY = """
+    SELECT c.user_id, c.conversation_id, c.read_count, s.message_count,
+           (SELECT COUNT(*) FROM messages m
+            WHERE m.conversation_id = c.conversation_id AND m.deleted = FALSE AND m.id <= c.last_read_id),
+           (SELECT COUNT(*) FROM messages m WHERE m.conversation_id = c.conversation_id AND m.deleted = FALSE)
+    FROM read_cursors c JOIN conversation_stats s ON s.conversation_id = c.conversation_id
+"""
+
+
+def seed(service):
+    alice, bob, carol, dave = (service.register(username, 'password1')
+                               for username in ('alice', 'bob', 'carol', 'dave'))
+    group_id = service.create_group(alice, 'team')
+    service.add_group_member(group_id, bob)
+    service.add_group_member(group_id, carol, is_admin=True)
+    service.add_group_member(group_id, dave)
+    ids = [service.send_message(bob, f'direct {i}', receiver_id=alice) for i in range(5)]
+    service.edit_message(bob, ids[1], 'direct 1, edited')
+    service.delete_message(bob, ids[2])
+    for i in range(5):
+        service.send_message(carol, f'group {i}', group_id=group_id)
+    return alice, bob
+
+
+def export(service):
+    stream = io.BytesIO()
+    chat_transfer.export_history(service.db.writer(), stream)
+    return stream.getvalue()
+
+
+def import_into(path, data, defer_indexes=True):
+    conn = sqlite3.connect(path, isolation_level=None)
+    chat_db.migrate(conn)
+    # A small batch size leaves a partial batch of members when the messages start
+    counts = chat_transfer.import_history(conn, io.BytesIO(data), batch_size=3, defer_indexes=defer_indexes)
+    return conn, counts
+
+
+def assert_counters_consistent(conn):
+    for user_id, conversation_id, read_count, message_count, read, live in conn.execute(COUNTERS_QUERY):
+        assert (read_count, message_count) == (read, live), (user_id, conversation_id)
+
+
+def test_round_trip_into_a_fresh_database(service, tmp_path):
+    seed(service)
+    source = service.db.writer()
+    conn, counts = import_into(str(tmp_path / 'copy.db'), export(service))
+
+    assert counts == {'user': 4, 'group': 1, 'member': 4, 'message': 10}
+    assert conn.execute(MESSAGES_QUERY).fetchall() == source.execute(MESSAGES_QUERY).fetchall()
+    assert conn.execute(MEMBERS_QUERY).fetchall() == source.execute(MEMBERS_QUERY).fetchall()
+    # Imported history starts out read
+    assert conn.execute("SELECT COUNT(*) FROM read_cursors").fetchone()[0] == 6
+    assert conn.execute(chat_db.UNREAD_COUNTS_QUERY, (1,)).fetchall() == []
+    assert_counters_consistent(conn)
+
+
+def test_import_keeps_existing_unread_messages(service, tmp_path):
+    alice, bob = seed(service)
+    data = export(service)
+    conversation_id = chat_db.direct_conversation_id(alice, bob)
+    service.mark_read(alice, conversation_id).result()
+    service.send_message(bob, 'unread', receiver_id=alice)
+    service.writes.close()
+
+    conn, counts = import_into(service.db.path, data)
+    assert counts['user'] == 0
+    # The unread message stays unread, and so do the 4 live imported messages after it; the
+    # existing group keeps its unread messages and the imported copy of it starts out read
+    assert dict(conn.execute(chat_db.UNREAD_COUNTS_QUERY, (alice,)).fetchall()) == {
+        conversation_id: 5, chat_db.group_conversation_id(1): 5}
+    assert dict(conn.execute(chat_db.UNREAD_COUNTS_QUERY, (bob,)).fetchall()) == {
+        chat_db.group_conversation_id(1): 5}
+    assert_counters_consistent(conn)
+
+
+def test_members_are_imported_before_the_messages(service, tmp_path):
+    seed(service)
+    # Without deferred work the triggers see the rows in import order, so every member
+    # who did not send to the group has all of its messages unread, dave (the last) too
+    conn, counts = import_into(str(tmp_path / 'copy.db'), export(service), defer_indexes=False)
+    group_unread = conn.execute("""
+        SELECT u.username, s.message_count - c.read_count
+        FROM read_cursors c JOIN conversation_stats s ON s.conversation_id = c.conversation_id
+        JOIN users u ON u.id = c.user_id
+        WHERE c.conversation_id LIKE 'g:%' ORDER BY u.username
+    """).fetchall()
+    assert group_unread == [('alice', 5), ('bob', 5), ('carol', 0), ('dave', 5)]
+    assert_counters_consistent(conn)
@@ -0,0 +1,72 @@
+import chat_db
+
+
+def register(service, *usernames):
+    return [service.register(username, 'password1') for username in usernames]
+
+
+def test_direct_messages_count_for_the_receiver_only(service):
+    alice, bob = register(service, 'alice', 'bob')
+    conversation_id = chat_db.direct_conversation_id(alice, bob)
+    for _ in range(3):
+        service.send_message(bob, 'hi', receiver_id=alice)
+    assert service.unread_counts(alice) == {conversation_id: 3}
+    assert service.unread_counts(bob) == {}
+
+    # Replying reads the conversation
+    service.send_message(alice, 'hello', receiver_id=bob)
+    assert service.unread_counts(alice) == {}
+    assert service.unread_counts(bob) == {conversation_id: 1}
+
+
+def test_read_cursor_moves_forward_only(service):
+    alice, bob = register(service, 'alice', 'bob')
+    conversation_id = chat_db.direct_conversation_id(alice, bob)
+    ids = [service.send_message(bob, f'message {i}', receiver_id=alice) for i in range(5)]
+
+    service.mark_read(alice, conversation_id, ids[2]).result()
+    assert service.unread_counts(alice) == {conversation_id: 2}
+    # Marking an older message, or the same one again, changes nothing
+    service.mark_read(alice, conversation_id, ids[0]).result()
+    service.mark_read(alice, conversation_id, ids[2]).result()
+    assert service.unread_counts(alice) == {conversation_id: 2}
+
+    service.mark_read(alice, conversation_id).result()
+    assert service.unread_counts(alice) == {}
+    assert service.total_unread(alice) == 0
+
+
+def test_edits_keep_and_deletes_adjust_counts(service):
+    alice, bob = register(service, 'alice', 'bob')
+    conversation_id = chat_db.direct_conversation_id(alice, bob)
+    ids = [service.send_message(bob, f'message {i}', receiver_id=alice) for i in range(4)]
+    service.mark_read(alice, conversation_id, ids[1]).result()
+
+    service.edit_message(bob, ids[3], 'edited')
+    assert service.unread_counts(alice) == {conversation_id: 2}
+
+    # Deleting an unread message lowers the count; deleting a read one leaves it
+    service.delete_message(bob, ids[3])
+    assert service.unread_counts(alice) == {conversation_id: 1}
+    service.delete_message(bob, ids[0])
+    assert service.unread_counts(alice) == {conversation_id: 1}
+
+    service.mark_read(alice, conversation_id).result()
+    assert service.unread_counts(alice) == {}
+
+
+def test_group_members_count_from_when_they_joined(service):
+    alice, bob, carol = register(service, 'alice', 'bob', 'carol')
+    group_id = service.create_group(alice, 'team')
+    conversation_id = chat_db.group_conversation_id(group_id)
+    service.add_group_member(group_id, bob)
+    service.send_message(alice, 'before carol', group_id=group_id)
+
+    # A new member has read the history
+    service.add_group_member(group_id, carol)
+    assert service.unread_counts(carol) == {}
+    service.send_message(bob, 'welcome', group_id=group_id)
+    assert service.unread_counts(alice) == {conversation_id: 1}
+    assert service.unread_counts(bob) == {}
+    assert service.unread_counts(carol) == {conversation_id: 1}
+    assert service.total_unread(alice) == 1
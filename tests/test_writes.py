@@ -0,0 +1,118 @@
+import sqlite3
+import threading
+
+import pytest
+
+import chat_db
+from chat_writes import WriteQueue
+
+INSERT_A = "INSERT INTO log (kind) VALUES ('a')"
+INSERT_B = "INSERT INTO log (kind) VALUES (?)"
+
+
+class GatedDatabase(chat_db.ConnectionManager):
+    """A write calling hold() blocks the write thread until release(), so later writes pile up"""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.held = threading.Event()
+        self.released = threading.Event()
+
+    def _open(self, read_only):
+        conn = super()._open(read_only)
+        conn.create_function('hold', 0, self.hold)
+        return conn
+
+    def hold(self):
+        self.held.set()
+        self.released.wait(5)
+        return 0
+
+    def release(self):
+        self.released.set()
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = GatedDatabase(str(tmp_path / 'writes.db'))
+    db.writer().execute("CREATE TABLE log (seq INTEGER PRIMARY KEY, kind TEXT UNIQUE)")
+    db.writer().commit()
+    yield db
+    db.release()
+
+
+def hold(queue, db):
+    """Block the write thread inside a transaction of its own"""
+    future = queue.submit("INSERT INTO log (kind) SELECT 'first' WHERE hold() = 0")
+    assert db.held.wait(5)
+    return future
+
+
+def kinds(db):
+    return [kind for kind, in db.reader().execute("SELECT kind FROM log ORDER BY seq")]
+
+
+def test_submit_ordering_keeps_interleaved_statements_in_order(db):
+    queue = WriteQueue(db, ordering='submit')
+    hold(queue, db)
+    futures = [queue.submit(INSERT_B, ('b1',)), queue.submit(INSERT_A), queue.submit(INSERT_B, ('b2',))]
+    db.release()
+    for future in futures:
+        future.result(5)
+    queue.close()
+    assert kinds(db) == ['first', 'b1', 'a', 'b2']
+
+
+def test_grouped_ordering_runs_each_statement_together(db):
+    queue = WriteQueue(db, ordering='grouped')
+    hold(queue, db)
+    futures = [queue.submit(INSERT_B, ('b1',)), queue.submit(INSERT_A), queue.submit(INSERT_B, ('b2',))]
+    db.release()
+    for future in futures:
+        future.result(5)
+    queue.close()
+    assert kinds(db) == ['first', 'b1', 'b2', 'a']
+
+
+@pytest.mark.parametrize('durability, synchronous', [('normal', 1), ('full', 2)])
+def test_durability_sets_synchronous(db, durability, synchronous):
+    queue = WriteQueue(db, durability=durability)
+    assert queue.submit("PRAGMA synchronous", result='returning').result(5) == synchronous
+    queue.close()
+
+
+def test_unknown_settings_are_refused(db):
+    with pytest.raises(ValueError):
+        WriteQueue(db, ordering='random')
+    with pytest.raises(ValueError):
+        WriteQueue(db, durability='none')
+
+
+def test_failing_write_rejects_only_its_own_future(db):
+    queue = WriteQueue(db)
+    hold(queue, db)
+    before = queue.submit(INSERT_B, ('b1',), result='lastrowid')
+    duplicate = queue.submit(INSERT_B, ('b1',), result='lastrowid')
+    after = queue.submit(INSERT_B, ('b2',), result='lastrowid')
+    db.release()
+    assert before.result(5) == 2
+    with pytest.raises(sqlite3.IntegrityError):
+        duplicate.result(5)
+    assert after.result(5) == 3
+    queue.close()
+    assert kinds(db) == ['first', 'b1', 'b2']
+
+
+def test_close_commits_pending_writes(db):
+    queue = WriteQueue(db)
+    first = hold(queue, db)
+    futures = [queue.submit(INSERT_B, (f'b{i}',)) for i in range(10)]
+    closer = threading.Thread(target=queue.close)
+    closer.start()
+    db.release()
+    closer.join(5)
+    assert not closer.is_alive()
+    assert all(future.done() and future.exception() is None for future in [first] + futures)
+    assert len(kinds(db)) == 11
+    with pytest.raises(RuntimeError):
+        queue.submit(INSERT_A)